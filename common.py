@@ -1,14 +1,22 @@
 # common.py
-from flask import jsonify, request
+from flask import jsonify, request, current_app
 from marshmallow import ValidationError
 from extensions import db
 from functools import wraps
 from flask_jwt_extended import verify_jwt_in_request, get_jwt
+import base64
+import json
 import logging
+import random
 import re
+import time
 import werkzeug.exceptions
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from sqlalchemy import and_, or_, false
+from sqlalchemy.exc import DBAPIError
 from utils.date_utils import to_peru_time, get_peru_now
+from utils.file_handlers import IMAGE_VARIANTS
 
 # Configuración de logging
 logger = logging.getLogger(__name__)
@@ -79,6 +87,40 @@ def handle_db_errors(func):
             return {"message": "Error interno del servidor"}, 500
     return wrapper
 
+# SQLSTATE de Postgres que se resuelven repitiendo la transacción completa
+RETRYABLE_SQLSTATES = ('40P01', '40001')  # deadlock_detected, serialization_failure
+
+def is_retryable_db_error(exc):
+    """True si `exc` es un deadlock o fallo de serialización de Postgres."""
+    if not isinstance(exc, DBAPIError):
+        return False
+    orig = exc.orig
+    return (getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)) in RETRYABLE_SQLSTATES
+
+def retry_on_deadlock(func):
+    """
+    Decorator para endpoints que modifican stock: ante un deadlock o fallo de
+    serialización hace rollback y repite el handler completo con backoff
+    exponencial (DB_RETRY_ATTEMPTS intentos, base DB_RETRY_BACKOFF_MS).
+    Va debajo de handle_db_errors, que convierte el último fallo en un 500.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        intentos = max(int(current_app.config.get('DB_RETRY_ATTEMPTS', 3)), 1)
+        base = int(current_app.config.get('DB_RETRY_BACKOFF_MS', 50)) / 1000
+        for intento in range(1, intentos + 1):
+            try:
+                return func(*args, **kwargs)
+            except DBAPIError as e:
+                db.session.rollback()
+                if not is_retryable_db_error(e) or intento == intentos:
+                    raise
+                espera = base * (2 ** (intento - 1)) * random.uniform(0.5, 1.5)
+                logger.warning(f"Conflicto de concurrencia en {func.__name__} (intento {intento}/{intentos}), "
+                               f"reintentando en {espera * 1000:.0f} ms")
+                time.sleep(espera)
+    return wrapper
+
 def rol_requerido(*roles_permitidos):
     """
     Decorador para restringir acceso basado en roles
@@ -202,8 +244,194 @@ def validate_pagination_params():
         
     return page, per_page
 
+def get_foto_variant(default=None):
+    """
+    Variante de foto solicitada con ?foto=thumb|medium|full.
+    Los listados usan por defecto PRESENTACION_FOTO_DEFAULT_VARIANT (miniatura).
+    """
+    default = default or current_app.config.get('PRESENTACION_FOTO_DEFAULT_VARIANT', 'thumb')
+    variant = request.args.get('foto', default).lower()
+    return variant if variant in IMAGE_VARIANTS else default
+
+# --- Paginación por cursor (keyset) ---
+
+def _cursor_value(value):
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"d": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"dec": str(value)}
+    return value
+
+def _parse_cursor_value(value):
+    if isinstance(value, dict):
+        if "dt" in value:
+            return datetime.fromisoformat(value["dt"])
+        if "d" in value:
+            return date.fromisoformat(value["d"])
+        if "dec" in value:
+            return Decimal(value["dec"])
+    return value
+
+def encode_cursor(values):
+    """Codifica los valores de la última fila (columnas de orden + id) como cursor opaco."""
+    raw = json.dumps([_cursor_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def _cursor_value_for(column, value):
+    """
+    Comprueba que un valor del cursor corresponde al tipo de su columna de orden
+    (lo convierte si es un número compatible); lanza ValueError si no.
+    """
+    if value is None:
+        return None
+    try:
+        expected = column.type.python_type
+    except NotImplementedError:
+        return value
+    if expected is bool:
+        valido = isinstance(value, bool)
+    elif isinstance(value, bool):
+        valido = False
+    elif expected is datetime:
+        valido = isinstance(value, datetime)
+    elif expected is date:
+        valido = isinstance(value, date) and not isinstance(value, datetime)
+    elif expected in (int, float, Decimal):
+        if expected is int:
+            valido = isinstance(value, int)
+        else:
+            valido = isinstance(value, (int, float, Decimal))
+            value = expected(str(value)) if expected is Decimal else float(value)
+    else:
+        valido = isinstance(value, expected)
+    if not valido:
+        raise ValueError(f"valor {value!r} no válido para {getattr(column, 'key', None) or 'la columna de orden'}")
+    return value
+
+def decode_cursor(cursor, keys):
+    """
+    Decodifica un cursor para el orden `keys` [(columna, descendente)]; lanza
+    BadRequest si no es válido o algún valor no es del tipo de su columna.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError("longitud inesperada")
+        return [
+            _cursor_value_for(column, _parse_cursor_value(v))
+            for (column, _), v in zip(keys, values)
+        ]
+    except (ValueError, TypeError, KeyError, ArithmeticError) as e:
+        raise werkzeug.exceptions.BadRequest(f"Cursor inválido: {e}")
+
+def _keyset_after(keys, values):
+    """
+    Condición "fila posterior al cursor" para un orden lexicográfico sobre `keys`
+    [(columna, descendente)], con NULLs al final en cada columna.
+    """
+    condiciones = []
+    prefijo = []
+    for (column, descending), value in zip(keys, values):
+        if value is None:
+            estricta = false()  # Dentro del bloque de NULLs no hay valor "posterior"
+            igual = column.is_(None)
+        else:
+            estricta = or_(column < value if descending else column > value, column.is_(None))
+            igual = column == value
+        condiciones.append(and_(*prefijo, estricta))
+        prefijo.append(igual)
+    return or_(*condiciones)
+
+def _keyset_keys(sort_keys, id_column):
+    # `id` desempata en la misma dirección que la primera columna de orden
+    id_descending = sort_keys[0][1] if sort_keys else False
+    return list(sort_keys) + [(id_column, id_descending)]
+
+def _keyset_ordered(query, keys):
+    """Reemplaza el orden de la consulta por el orden keyset y añade las columnas del cursor."""
+    query = query.order_by(None).order_by(*[
+        column.desc().nulls_last() if descending else column.asc().nulls_last()
+        for column, descending in keys
+    ])
+    return query.add_columns(*[column.label(f'_cursor_{i}') for i, (column, _) in enumerate(keys)])
+
+def iter_keyset_chunks(query, sort_keys, id_column, chunk_size=1000):
+    """
+    Recorre `query` completa en bloques de `chunk_size` filas por keyset (sin
+    OFFSET ni cursores de servidor, compatible con el pooler de Supabase).
+    Produce listas con la entidad de cada fila o, si la consulta selecciona
+    varias entidades/columnas, la fila completa (accesible por nombre).
+    """
+    keys = _keyset_keys(sort_keys, id_column)
+    n_columnas = len(query.column_descriptions)
+    ordered = _keyset_ordered(query, keys)
+    values = None
+    while True:
+        chunk_query = ordered if values is None else ordered.filter(_keyset_after(keys, values))
+        rows = chunk_query.limit(chunk_size).all()
+        if not rows:
+            return
+        yield [row[0] if n_columnas == 1 else row for row in rows]
+        if len(rows) < chunk_size:
+            return
+        values = list(rows[-1][n_columnas:])
+
+class KeysetPage:
+    """Resultado de una página por cursor (equivalente a Pagination de Flask-SQLAlchemy)."""
+
+    def __init__(self, items, per_page, next_cursor, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.has_next = next_cursor is not None
+        self.total = total
+
+def paginate_query(query, sort_keys, id_column, page=None, per_page=None, error_out=False):
+    """
+    Pagina una consulta en uno de dos modos:
+    - Por defecto: page/per_page con OFFSET y COUNT (paginate() de Flask-SQLAlchemy),
+      respetando el orden que ya tenga la consulta.
+    - Con ?cursor= (vacío para la primera página): keyset sobre `sort_keys`
+      [(columna, descendente)] + `id_column`, sin COUNT salvo ?with_total=true.
+    """
+    if per_page is None:
+        page, per_page = validate_pagination_params()
+
+    cursor = request.args.get('cursor')
+    if cursor is None:
+        return query.paginate(page=page or 1, per_page=per_page, error_out=error_out)
+
+    keys = _keyset_keys(sort_keys, id_column)
+
+    total = None
+    if request.args.get('with_total', 'false').lower() == 'true':
+        total = query.order_by(None).count()
+
+    query = _keyset_ordered(query, keys)
+    if cursor:
+        query = query.filter(_keyset_after(keys, decode_cursor(cursor, keys)))
+
+    # Pedir una fila extra para saber si hay página siguiente
+    rows = query.limit(per_page + 1).all()
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(list(rows[-1][1:])) if has_next and rows else None
+    return KeysetPage([row[0] for row in rows], per_page, next_cursor, total)
+
 def create_pagination_response(items, pagination):
-    """Crea respuesta estandarizada con paginación"""
+    """Crea respuesta estandarizada con paginación (por página o por cursor)"""
+    if isinstance(pagination, KeysetPage):
+        meta = {
+            "per_page": pagination.per_page,
+            "next_cursor": pagination.next_cursor,
+            "has_next": pagination.has_next,
+        }
+        if pagination.total is not None:
+            meta["total"] = pagination.total
+        return {"data": items, "pagination": meta}
     return {
         "data": items,
         "pagination": {
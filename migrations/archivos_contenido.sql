@@ -0,0 +1,24 @@
+-- Deduplicación de comprobantes por contenido + contador de referencias
+-- Ejecutar en el SQL Editor de Supabase.
+
+CREATE TABLE IF NOT EXISTS archivos_contenido (
+    id SERIAL PRIMARY KEY,
+    sha256 VARCHAR(64),
+    s3_key VARCHAR(255) NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0 CHECK (ref_count >= 0),
+    created_at TIMESTAMPTZ DEFAULT now(),
+    CONSTRAINT uq_archivo_sha256 UNIQUE (sha256),
+    CONSTRAINT uq_archivo_s3_key UNIQUE (s3_key)
+);
+
+-- Índice para el respaldo por conteo en pagos (claves sin fila en archivos_contenido)
+CREATE INDEX IF NOT EXISTS idx_pago_url_comprobante ON pagos (url_comprobante);
+
+-- Registrar los comprobantes existentes con su número de referencias.
+-- Su hash es desconocido (NULL): no se deduplican, pero sí se cuentan.
+INSERT INTO archivos_contenido (s3_key, ref_count)
+SELECT url_comprobante, COUNT(*)
+FROM pagos
+WHERE url_comprobante IS NOT NULL AND url_comprobante <> ''
+GROUP BY url_comprobante
+ON CONFLICT (s3_key) DO NOTHING;
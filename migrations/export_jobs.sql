@@ -0,0 +1,23 @@
+-- Exportaciones en segundo plano (services/export_jobs.py)
+-- Ejecutar en el SQL Editor de Supabase.
+
+CREATE TABLE IF NOT EXISTS export_jobs (
+    id VARCHAR(36) PRIMARY KEY,
+    usuario_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    tipo VARCHAR(30) NOT NULL,
+    formato VARCHAR(4) NOT NULL DEFAULT 'xlsx',
+    parametros JSON NOT NULL,
+    estado VARCHAR(15) NOT NULL DEFAULT 'pendiente'
+        CHECK (estado IN ('pendiente', 'procesando', 'completado', 'error', 'cancelado', 'expirado')),
+    filas INTEGER,
+    s3_key VARCHAR(255),
+    ruta_local VARCHAR(500),
+    error TEXT,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    expires_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_export_jobs_usuario_estado ON export_jobs (usuario_id, estado);
+CREATE INDEX IF NOT EXISTS idx_export_jobs_expires_at ON export_jobs (expires_at);
@@ -0,0 +1,6 @@
+-- Marca qué fotos de presentaciones tienen variantes thumb/medium.
+-- Los listados firman la miniatura solo si foto_variantes = true; si no, la foto completa.
+-- Las fotos existentes quedan en false hasta que `flask backfill-foto-variantes` genere sus variantes.
+-- Ejecutar en el SQL Editor de Supabase.
+
+ALTER TABLE presentaciones_producto ADD COLUMN IF NOT EXISTS foto_variantes BOOLEAN NOT NULL DEFAULT false;
@@ -0,0 +1,26 @@
+-- Archivo histórico de ventas pagadas antiguas (services/historico.py, flask archivar-ventas).
+-- Mismas columnas que las tablas originales, sin claves foráneas ni defaults.
+-- Si se agrega una columna a ventas/venta_detalles/pagos/movimientos, agregarla también aquí.
+-- Ejecutar en el SQL Editor de Supabase.
+
+CREATE TABLE IF NOT EXISTS ventas_historico (LIKE ventas);
+CREATE TABLE IF NOT EXISTS venta_detalles_historico (LIKE venta_detalles);
+CREATE TABLE IF NOT EXISTS pagos_historico (LIKE pagos);
+CREATE TABLE IF NOT EXISTS movimientos_historico (LIKE movimientos);
+
+-- Los ids se conservan al archivar
+CREATE UNIQUE INDEX IF NOT EXISTS ventas_historico_id_key ON ventas_historico (id);
+CREATE UNIQUE INDEX IF NOT EXISTS venta_detalles_historico_id_key ON venta_detalles_historico (id);
+CREATE UNIQUE INDEX IF NOT EXISTS pagos_historico_id_key ON pagos_historico (id);
+CREATE UNIQUE INDEX IF NOT EXISTS movimientos_historico_id_key ON movimientos_historico (id);
+
+-- Índices para las uniones con las tablas actuales y para decidir si un rango de fechas llega al archivo
+CREATE INDEX IF NOT EXISTS idx_ventas_historico_fecha ON ventas_historico (fecha);
+CREATE INDEX IF NOT EXISTS idx_ventas_historico_cliente_id ON ventas_historico (cliente_id);
+CREATE INDEX IF NOT EXISTS idx_venta_detalles_historico_venta_id ON venta_detalles_historico (venta_id);
+CREATE INDEX IF NOT EXISTS idx_pagos_historico_venta_id ON pagos_historico (venta_id);
+CREATE INDEX IF NOT EXISTS idx_pagos_historico_fecha ON pagos_historico (fecha);
+CREATE INDEX IF NOT EXISTS idx_pagos_historico_fecha_deposito ON pagos_historico (fecha_deposito);
+CREATE INDEX IF NOT EXISTS idx_pagos_historico_url_comprobante ON pagos_historico (url_comprobante);
+CREATE INDEX IF NOT EXISTS idx_movimientos_historico_venta_id ON movimientos_historico (venta_id);
+CREATE INDEX IF NOT EXISTS idx_movimientos_historico_fecha ON movimientos_historico (fecha);
@@ -0,0 +1,17 @@
+-- Respuestas guardadas de peticiones con cabecera Idempotency-Key (services/idempotency.py)
+-- Ejecutar en el SQL Editor de Supabase.
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    id SERIAL PRIMARY KEY,
+    usuario_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    clave VARCHAR(255) NOT NULL,
+    endpoint VARCHAR(100) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    status_code INTEGER NOT NULL,
+    respuesta JSON,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    expires_at TIMESTAMPTZ NOT NULL,
+    CONSTRAINT idempotency_keys_usuario_clave_key UNIQUE (usuario_id, clave)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at);
@@ -0,0 +1,40 @@
+-- Índices para los filtros y ordenaciones de los listados, reportes y login.
+-- Ejecutar en el SQL Editor de Supabase. Comprobar después con
+-- `python scripts/check_query_plans.py` contra una base con datos.
+
+-- CONCURRENTLY evita bloquear escrituras en tablas grandes (no puede ir dentro de una transacción)
+
+-- movimientos: listado por fecha (keyset fecha + id) y filtros por presentación, lote, operación y usuario
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_fecha ON movimientos (fecha, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_presentacion_fecha ON movimientos (presentacion_id, fecha);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_lote_fecha ON movimientos (lote_id, fecha);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_tipo_operacion_fecha ON movimientos (tipo_operacion, fecha);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_usuario_id ON movimientos (usuario_id);
+
+-- ventas: listado por fecha y filtros por almacén, vendedor y cliente
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_fecha ON ventas (fecha, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_almacen_fecha ON ventas (almacen_id, fecha);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_vendedor_fecha ON ventas (vendedor_id, fecha);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_cliente_fecha ON ventas (cliente_id, fecha);
+-- Parcial: solo ventas con saldo (dashboard, saldos de clientes)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_pendientes ON ventas (almacen_id, cliente_id)
+    WHERE estado_pago IN ('pendiente', 'parcial');
+
+-- pagos: por venta (saldos, detalle), listado por fecha y por usuario
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pago_venta_id ON pagos (venta_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pago_fecha ON pagos (fecha, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pago_usuario_fecha ON pagos (usuario_id, fecha);
+
+-- venta_detalles: por venta y reportes por presentación / lote
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_detalle_venta_id ON venta_detalles (venta_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_detalle_presentacion_id ON venta_detalles (presentacion_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_venta_detalle_lote_id ON venta_detalles (lote_id);
+
+-- users: login sin distinguir mayúsculas (lower(username) = lower(:username))
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_lower ON users (lower(username));
+
+ANALYZE movimientos;
+ANALYZE ventas;
+ANALYZE pagos;
+ANALYZE venta_detalles;
+ANALYZE users;
@@ -0,0 +1,12 @@
+-- Columnas de origen en movimientos (venta, pedido, ensamblaje) con índices.
+-- Ejecutar en el SQL Editor de Supabase y luego: flask backfill-movimientos-origen
+-- (rellena las filas existentes a partir del texto de `motivo`).
+
+ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS venta_id INTEGER REFERENCES ventas(id) ON DELETE SET NULL;
+ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS pedido_id INTEGER REFERENCES pedidos(id) ON DELETE SET NULL;
+ALTER TABLE movimientos ADD COLUMN IF NOT EXISTS ensamblaje_id VARCHAR(36);
+
+-- CONCURRENTLY evita bloquear escrituras en tablas grandes (no puede ir dentro de una transacción)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_venta_id ON movimientos (venta_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_pedido_id ON movimientos (pedido_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_movimiento_ensamblaje_id ON movimientos (ensamblaje_id);
@@ -0,0 +1,13 @@
+-- Cola persistente de eliminaciones S3 (procesada por el hilo de services/s3_delete_queue.py)
+-- Ejecutar en el SQL Editor de Supabase.
+
+CREATE TABLE IF NOT EXISTS s3_delete_queue (
+    id BIGSERIAL PRIMARY KEY,
+    s3_key VARCHAR(255) NOT NULL,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    proximo_intento TIMESTAMPTZ DEFAULT now(),
+    ultimo_error TEXT,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_s3_delete_queue_proximo ON s3_delete_queue (proximo_intento);
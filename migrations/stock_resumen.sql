@@ -0,0 +1,27 @@
+-- Stock agregado por (presentacion, almacen) (services/stock_resumen.py).
+-- Ejecutar en el SQL Editor de Supabase. Después del despliegue, correr
+-- `flask reconstruir-stock-resumen` para recoger los cambios hechos entre la
+-- migración y la nueva versión de la API.
+
+CREATE TABLE IF NOT EXISTS stock_resumen (
+    presentacion_id INTEGER NOT NULL REFERENCES presentaciones_producto(id) ON DELETE CASCADE,
+    almacen_id INTEGER NOT NULL REFERENCES almacenes(id) ON DELETE CASCADE,
+    unidades NUMERIC(14, 4) NOT NULL DEFAULT 0,
+    stock_minimo INTEGER NOT NULL DEFAULT 10,
+    capacidad_kg NUMERIC(10, 2) NOT NULL,
+    precio_venta NUMERIC(12, 2) NOT NULL,
+    kg NUMERIC(16, 4) GENERATED ALWAYS AS (unidades * capacidad_kg) STORED,
+    valor_venta NUMERIC(18, 4) GENERATED ALWAYS AS (unidades * precio_venta) STORED,
+    actualizado_en TIMESTAMPTZ DEFAULT now(),
+    PRIMARY KEY (presentacion_id, almacen_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_stock_resumen_almacen ON stock_resumen (almacen_id);
+
+-- Carga inicial
+INSERT INTO stock_resumen (presentacion_id, almacen_id, unidades, stock_minimo, capacidad_kg, precio_venta)
+SELECT i.presentacion_id, i.almacen_id, sum(i.cantidad), max(i.stock_minimo), p.capacidad_kg, p.precio_venta
+FROM inventario i
+JOIN presentaciones_producto p ON p.id = i.presentacion_id
+GROUP BY i.presentacion_id, i.almacen_id, p.capacidad_kg, p.precio_venta
+ON CONFLICT (presentacion_id, almacen_id) DO NOTHING;
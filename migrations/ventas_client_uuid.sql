@@ -0,0 +1,8 @@
+-- UUID generado por el cliente móvil para sincronizar ventas offline (POST /ventas/batch).
+-- Una venta reenviada con un UUID ya aplicado se informa como duplicada en vez de insertarse otra vez.
+-- Ejecutar en el SQL Editor de Supabase.
+
+ALTER TABLE ventas ADD COLUMN IF NOT EXISTS client_uuid VARCHAR(36);
+
+-- CONCURRENTLY evita bloquear escrituras en tablas grandes (no puede ir dentro de una transacción)
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ventas_client_uuid_key ON ventas (client_uuid);
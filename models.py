@@ -16,6 +16,11 @@ class Users(db.Model):
     movimientos = db.relationship('Movimiento', back_populates='usuario')
     almacen = db.relationship('Almacen', backref=db.backref('usuarios', lazy=True))
 
+    __table_args__ = (
+        # Login y validación de duplicados comparan lower(username)
+        Index('idx_users_username_lower', func.lower(username)),
+    )
+
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -42,6 +47,8 @@ class PresentacionProducto(db.Model):
     precio_venta = db.Column(db.Numeric(12, 2), nullable=False)  # Precio al público
     activo = db.Column(db.Boolean, default=True)
     url_foto = db.Column(db.String(255))
+    # True si url_foto tiene variantes thumb/medium (utils/file_handlers.py: variant_key)
+    foto_variantes = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
 
@@ -102,11 +109,12 @@ class Almacen(db.Model):
 class Inventario(db.Model):
     __tablename__ = 'inventario'
     id = db.Column(db.Integer, primary_key=True)  # PK autoincremental
-    presentacion_id = db.Column(db.Integer, db.ForeignKey('presentaciones_producto.id', ondelete='CASCADE'), nullable=False)
-    almacen_id = db.Column(db.Integer, db.ForeignKey('almacenes.id', ondelete='CASCADE'), nullable=False)
+    # active_history: stock_resumen necesita el valor anterior al cambiar estos campos por ORM
+    presentacion_id = db.column_property(db.Column(db.Integer, db.ForeignKey('presentaciones_producto.id', ondelete='CASCADE'), nullable=False), active_history=True)
+    almacen_id = db.column_property(db.Column(db.Integer, db.ForeignKey('almacenes.id', ondelete='CASCADE'), nullable=False), active_history=True)
     lote_id = db.Column(db.Integer, db.ForeignKey('lotes.id', ondelete='SET NULL'))
 
-    cantidad = db.Column(db.Numeric(12, 4), nullable=False, default=0)
+    cantidad = db.column_property(db.Column(db.Numeric(12, 4), nullable=False, default=0), active_history=True)
     stock_minimo = db.Column(db.Integer, nullable=False, default=10)
     created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     ultima_actualizacion = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
@@ -123,6 +131,30 @@ class Inventario(db.Model):
         Index('idx_inventario_almacen', 'almacen_id', 'presentacion_id'),
     )
 
+class StockResumen(db.Model):
+    """
+    Stock agregado por (presentacion, almacen), mantenido en la misma
+    transacción que cada cambio de inventario (services/stock_resumen.py).
+    """
+    __tablename__ = 'stock_resumen'
+    presentacion_id = db.Column(db.Integer, db.ForeignKey('presentaciones_producto.id', ondelete='CASCADE'), primary_key=True)
+    almacen_id = db.Column(db.Integer, db.ForeignKey('almacenes.id', ondelete='CASCADE'), primary_key=True)
+    unidades = db.Column(db.Numeric(14, 4), nullable=False, default=0)
+    stock_minimo = db.Column(db.Integer, nullable=False, default=10)  # El mayor de las filas de inventario del par
+    # Copia de la presentación, para calcular kg y valor sin join
+    capacidad_kg = db.Column(db.Numeric(10, 2), nullable=False)
+    precio_venta = db.Column(db.Numeric(12, 2), nullable=False)
+    kg = db.Column(db.Numeric(16, 4), db.Computed('unidades * capacidad_kg', persisted=True))
+    valor_venta = db.Column(db.Numeric(18, 4), db.Computed('unidades * precio_venta', persisted=True))
+    actualizado_en = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    presentacion = db.relationship('PresentacionProducto')
+    almacen = db.relationship('Almacen')
+
+    __table_args__ = (
+        Index('idx_stock_resumen_almacen', 'almacen_id'),
+    )
+
 class Venta(db.Model):
     __tablename__ = 'ventas'
     id = db.Column(db.Integer, primary_key=True)
@@ -134,6 +166,7 @@ class Venta(db.Model):
     tipo_pago = db.Column(db.String(10), nullable=False)
     estado_pago = db.Column(db.String(15), default='pendiente')
     consumo_diario_kg = db.Column(db.Numeric(10, 2))  # Estimación global para proyecciones
+    client_uuid = db.Column(db.String(36), unique=True)  # UUID generado en el móvil (POST /ventas/batch)
     created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
 
@@ -175,7 +208,15 @@ class Venta(db.Model):
 
     __table_args__ = (
         CheckConstraint("tipo_pago IN ('contado', 'credito')"),
-        CheckConstraint("estado_pago IN ('pendiente', 'parcial', 'pagado')")
+        CheckConstraint("estado_pago IN ('pendiente', 'parcial', 'pagado')"),
+        # Listados ordenados por fecha (keyset fecha + id) y filtros por almacén, vendedor y cliente
+        Index('idx_venta_fecha', 'fecha', 'id'),
+        Index('idx_venta_almacen_fecha', 'almacen_id', 'fecha'),
+        Index('idx_venta_vendedor_fecha', 'vendedor_id', 'fecha'),
+        Index('idx_venta_cliente_fecha', 'cliente_id', 'fecha'),
+        # Ventas con saldo (dashboard, saldos de clientes): una fracción pequeña de la tabla
+        Index('idx_venta_pendientes', 'almacen_id', 'cliente_id',
+              postgresql_where=db.text("estado_pago IN ('pendiente', 'parcial')")),
     )
 
 class VentaDetalle(db.Model):
@@ -193,6 +234,12 @@ class VentaDetalle(db.Model):
     presentacion = db.relationship('PresentacionProducto')
     lote = db.relationship('Lote')
 
+    __table_args__ = (
+        Index('idx_venta_detalle_venta_id', 'venta_id'),
+        Index('idx_venta_detalle_presentacion_id', 'presentacion_id'),
+        Index('idx_venta_detalle_lote_id', 'lote_id'),
+    )
+
     @property
     def total_linea(self):
         return self.cantidad * self.precio_unitario
@@ -283,6 +330,97 @@ class Pago(db.Model):
         CheckConstraint("(depositado = true AND monto_depositado IS NOT NULL AND fecha_deposito IS NOT NULL) OR (depositado = false)"),
         Index('idx_pago_fecha_deposito', 'fecha_deposito'),
         Index('idx_pago_depositado_fecha', 'depositado', 'fecha_deposito'),
+        Index('idx_pago_url_comprobante', 'url_comprobante'),
+        Index('idx_pago_venta_id', 'venta_id'),
+        Index('idx_pago_fecha', 'fecha', 'id'),
+        Index('idx_pago_usuario_fecha', 'usuario_id', 'fecha'),
+    )
+
+class ArchivoContenido(db.Model):
+    """
+    Índice de archivos subidos por contenido (SHA-256 del archivo original).
+    Permite reutilizar la misma clave S3 cuando se sube un comprobante idéntico
+    y lleva la cuenta de cuántos registros la referencian.
+    """
+    __tablename__ = 'archivos_contenido'
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=True)  # NULL para claves anteriores a la deduplicación
+    s3_key = db.Column(db.String(255), nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    __table_args__ = (
+        UniqueConstraint('sha256', name='uq_archivo_sha256'),
+        UniqueConstraint('s3_key', name='uq_archivo_s3_key'),
+        CheckConstraint('ref_count >= 0'),
+    )
+
+class S3DeleteQueue(db.Model):
+    """
+    Cola persistente de objetos S3 pendientes de eliminar.
+    Los endpoints encolan en su misma transacción y un hilo en segundo plano
+    los borra en lotes (delete_objects) con reintentos.
+    """
+    __tablename__ = 's3_delete_queue'
+    id = db.Column(db.BigInteger, primary_key=True)
+    s3_key = db.Column(db.String(255), nullable=False)
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    # NULL = agotó los reintentos; queda para revisión manual
+    proximo_intento = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    ultimo_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    __table_args__ = (
+        Index('idx_s3_delete_queue_proximo', 'proximo_intento'),
+    )
+
+class ExportJob(db.Model):
+    """
+    Exportación en segundo plano (?async=true en los endpoints /exportar).
+    Guarda los filtros con los que se pidió, su estado y dónde quedó el archivo.
+    """
+    __tablename__ = 'export_jobs'
+    id = db.Column(db.String(36), primary_key=True)  # UUID
+    usuario_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    tipo = db.Column(db.String(30), nullable=False)  # ventas, pagos, gastos, clientes, clientes_proyecciones
+    formato = db.Column(db.String(4), nullable=False, default='xlsx')
+    parametros = db.Column(db.JSON, nullable=False)  # {"args": filtros, "claims": sub/rol/almacen_id}
+    estado = db.Column(db.String(15), nullable=False, default='pendiente')
+    filas = db.Column(db.Integer)
+    s3_key = db.Column(db.String(255))  # Resultado en S3...
+    ruta_local = db.Column(db.String(500))  # ...o en disco si S3 no está configurado
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    expires_at = db.Column(db.DateTime(timezone=True))
+
+    __table_args__ = (
+        CheckConstraint("estado IN ('pendiente', 'procesando', 'completado', 'error', 'cancelado', 'expirado')"),
+        Index('idx_export_jobs_usuario_estado', 'usuario_id', 'estado'),
+        Index('idx_export_jobs_expires_at', 'expires_at'),
+    )
+
+class IdempotencyKey(db.Model):
+    """
+    Respuesta guardada de una petición con cabecera Idempotency-Key
+    (ver services/idempotency.py). Un reintento con la misma clave recibe esta
+    respuesta sin volver a ejecutar el endpoint.
+    """
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    clave = db.Column(db.String(255), nullable=False)
+    endpoint = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)  # SHA-256 de método, ruta y cuerpo
+    status_code = db.Column(db.Integer, nullable=False)
+    respuesta = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('usuario_id', 'clave', name='idempotency_keys_usuario_clave_key'),
+        Index('idx_idempotency_keys_expires_at', 'expires_at'),
     )
 
 class Movimiento(db.Model):
@@ -313,6 +451,11 @@ class Movimiento(db.Model):
     cantidad_kg_procesados = db.Column(db.Numeric(10, 2))  # Kg de materia prima utilizados
     eficiencia_conversion = db.Column(db.Numeric(5, 2))  # % de eficiencia en la conversión
     turno_produccion = db.Column(db.String(10))  # "mañana", "tarde", "noche"
+
+    # Operación que originó el movimiento (antes solo se podía deducir del texto de `motivo`)
+    venta_id = db.Column(db.Integer, db.ForeignKey('ventas.id', ondelete='SET NULL'))
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedidos.id', ondelete='SET NULL'))
+    ensamblaje_id = db.Column(db.String(36))  # UUID de la operación de ensamblaje
     
     created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
@@ -338,8 +481,32 @@ class Movimiento(db.Model):
         CheckConstraint("tipo_operacion IN ('produccion', 'venta', 'ajuste', 'merma', 'transferencia', 'ensamblaje') OR tipo_operacion IS NULL"),
         CheckConstraint("turno_produccion IN ('mañana', 'tarde', 'noche') OR turno_produccion IS NULL"),
         CheckConstraint("eficiencia_conversion >= 0 AND eficiencia_conversion <= 100 OR eficiencia_conversion IS NULL"),
+        Index('idx_movimiento_venta_id', 'venta_id'),
+        Index('idx_movimiento_pedido_id', 'pedido_id'),
+        Index('idx_movimiento_ensamblaje_id', 'ensamblaje_id'),
+        Index('idx_movimiento_fecha', 'fecha', 'id'),
+        Index('idx_movimiento_presentacion_fecha', 'presentacion_id', 'fecha'),
+        Index('idx_movimiento_lote_fecha', 'lote_id', 'fecha'),
+        Index('idx_movimiento_tipo_operacion_fecha', 'tipo_operacion', 'fecha'),
+        Index('idx_movimiento_usuario_id', 'usuario_id'),
+    )
+
+# --- Archivo histórico (services/historico.py) ---
+# Ventas pagadas antiguas y sus detalles, pagos y movimientos se mueven a tablas
+# *_historico con las mismas columnas e ids. Sin claves foráneas: la tabla
+# original puede seguir cambiando sin tocar el archivo.
+def _tabla_historica(modelo):
+    return db.Table(
+        f"{modelo.__tablename__}_historico", db.metadata,
+        *[db.Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+          for c in modelo.__table__.columns]
     )
 
+ventas_historico = _tabla_historica(Venta)
+venta_detalles_historico = _tabla_historica(VentaDetalle)
+pagos_historico = _tabla_historica(Pago)
+movimientos_historico = _tabla_historica(Movimiento)
+
 class Gasto(db.Model):
     __tablename__ = 'gastos'
     id = db.Column(db.Integer, primary_key=True)
@@ -476,6 +643,12 @@ class ComandoVozLog(db.Model):
     )
 
 class VistaClienteProyeccion(db.Model):
+    """
+    Vista de la base (definida en Supabase). Se calcula sobre la tabla ventas,
+    así que total_ventas, monto_total_comprado y promedio_compra no incluyen las
+    ventas archivadas (services/historico.py); las fechas de proyección solo usan
+    compras recientes y no se ven afectadas.
+    """
     __tablename__ = 'vista_clientes_proyeccion'
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(255))
@@ -1,8 +1,10 @@
 from .almacen_resource import AlmacenResource
+from .archivo_resource import ArchivoEstadoResource, ColaEliminacionResource
 from .auth_resource import AuthResource
 from .chat_resource import ChatResource
 from .cliente_resource import ClienteExportResource, ClienteResource, ClienteProyeccionResource, ClienteProyeccionExportResource
 from .dashboard_resource import DashboardResource
+from .exportacion_resource import ExportacionListResource, ExportacionResource, ExportacionDescargaResource
 from .gasto_resource import GastoResource, GastoExportResource
 from .produccion_resource import ProduccionResource, ProduccionEnsamblajeResource
 from .inventario_resource import InventarioResource, InventarioGlobalResource
@@ -19,12 +21,14 @@ from .receta_resource import RecetaResource
 from .reporte_financiero_resource import ReporteVentasPresentacionResource, ResumenFinancieroResource, ReporteUnificadoResource, DepositosHistorialResource
 from .reporte_produccion_resource import ReporteProduccionBriquetasResource, ReporteProduccionGeneralResource
 from .user_resource import UserResource
-from .venta_resource import VentaResource, VentaFormDataResource, VentaExportResource, VentaFilterDataResource
+from .venta_resource import VentaResource, VentaBatchResource, VentaFormDataResource, VentaExportResource, VentaFilterDataResource
 from .ventadetalle_resource import VentaDetalleResource
 from .voice_resource import VoiceCommandResource
 
 __all__ = [
     'AlmacenResource',
+    'ArchivoEstadoResource',
+    'ColaEliminacionResource',
     'AuthResource',
     'ChatResource',
     'ClienteExportResource',
@@ -32,6 +36,9 @@ __all__ = [
     'ClienteProyeccionExportResource',
     'ClienteResource',
     'DashboardResource',
+    'ExportacionListResource',
+    'ExportacionResource',
+    'ExportacionDescargaResource',
     'GastoResource',
     'GastoExportResource',
     'InventarioResource',
@@ -61,6 +68,7 @@ __all__ = [
     'ReporteProduccionGeneralResource',
     'UserResource',
     'VentaResource',
+    'VentaBatchResource',
     'VentaFormDataResource',
     'VentaExportResource',
     'VentaFilterDataResource',
@@ -98,6 +106,7 @@ def init_resources(api, limiter=None):
     
     # Ventas
     api.add_resource(VentaResource, '/ventas', '/ventas/<int:venta_id>')
+    api.add_resource(VentaBatchResource, '/ventas/batch')
     api.add_resource(VentaFormDataResource, '/ventas/form-data')
     api.add_resource(VentaDetalleResource, '/ventas/<int:venta_id>/detalles')
     api.add_resource(VentaExportResource, '/ventas/exportar')
@@ -110,6 +119,15 @@ def init_resources(api, limiter=None):
     api.add_resource(PagoDepositoBancarioResource, '/pagos/depositos')
     api.add_resource(PagoExportResource, '/pagos/exportar')
     api.add_resource(CierreCajaResource, '/pagos/cierrecaja')
+
+    # Estado de archivos procesados en segundo plano (fotos y comprobantes)
+    api.add_resource(ArchivoEstadoResource, '/archivos/estado')
+    api.add_resource(ColaEliminacionResource, '/archivos/cola-eliminacion')
+
+    # Exportaciones en segundo plano (?async=true en los endpoints /exportar)
+    api.add_resource(ExportacionListResource, '/exportaciones')
+    api.add_resource(ExportacionResource, '/exportaciones/<string:job_uuid>')
+    api.add_resource(ExportacionDescargaResource, '/exportaciones/<string:job_uuid>/descarga')
     
     # Gastos
     api.add_resource(GastoResource, '/gastos', '/gastos/<int:gasto_id>')
@@ -0,0 +1,60 @@
+# ARCHIVO: resources/archivo_resource.py
+import logging
+
+from flask import request, current_app
+from flask_jwt_extended import jwt_required
+from flask_restful import Resource
+from botocore.exceptions import ClientError
+
+from common import handle_db_errors, rol_requerido
+from services.archivo_service import clave_referenciada
+from services.s3_delete_queue import delete_queue_metrics
+from utils.file_handlers import get_s3_client
+from utils.upload_worker import get_upload_status, ESTADO_COMPLETADO, ESTADO_ERROR, ESTADO_PENDIENTE
+
+logger = logging.getLogger(__name__)
+
+
+class ArchivoEstadoResource(Resource):
+    @jwt_required()
+    @handle_db_errors
+    def get(self):
+        """
+        Estado del procesamiento en segundo plano de un archivo subido.
+        - Parámetro: clave (clave S3 devuelta por el endpoint que recibió el archivo)
+        - Estados: pendiente, completado, error, cancelado
+        """
+        clave = request.args.get('clave')
+        if not clave:
+            return {"error": "El parámetro 'clave' es requerido"}, 400
+
+        status = get_upload_status(clave)
+        if status:
+            return {"clave": clave, **status}, 200
+
+        # La subida pudo procesarse en otro worker: consultar S3 directamente
+        s3_client = get_s3_client()
+        bucket_name = current_app.config.get('S3_BUCKET')
+        if not s3_client or not bucket_name:
+            return {"error": "Almacenamiento no configurado"}, 500
+        try:
+            s3_client.head_object(Bucket=bucket_name, Key=clave)
+            return {"clave": clave, "estado": ESTADO_COMPLETADO, "error": None}, 200
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                # Aún no existe: sigue en proceso si algún registro la usa; una subida
+                # fallida limpia sus referencias y una clave desconocida nunca se subió
+                if clave_referenciada(clave):
+                    return {"clave": clave, "estado": ESTADO_PENDIENTE, "error": None}, 200
+                return {"clave": clave, "estado": ESTADO_ERROR, "error": "El archivo no existe"}, 200
+            logger.error(f"Error consultando estado de {clave} en S3: {e}")
+            return {"error": "No se pudo consultar el estado del archivo"}, 500
+
+
+class ColaEliminacionResource(Resource):
+    @jwt_required()
+    @rol_requerido('admin')
+    @handle_db_errors
+    def get(self):
+        """Métricas de la cola de eliminación S3 (profundidad, reintentos agotados, antigüedad)."""
+        return delete_queue_metrics(), 200
@@ -2,6 +2,7 @@ from flask_restful import Resource, reqparse
 from flask_jwt_extended import create_access_token
 from werkzeug.security import check_password_hash, generate_password_hash
 from models import Users, Almacen
+from sqlalchemy import func
 from extensions import db
 from flask import request, jsonify, abort, current_app
 from datetime import datetime, timezone, timedelta
@@ -32,7 +33,7 @@ class AuthResource(Resource):
                 return {'message': 'La contraseña debe tener al menos 8 caracteres'}, 400
             
             # Find user by username (case insensitive)
-            usuario = Users.query.filter(Users.username.ilike(username)).first()
+            usuario = Users.query.filter(func.lower(Users.username) == username.lower()).first()
             
             # Verificación real de credenciales
             if not usuario or not check_password_hash(usuario.password, password):
@@ -1,14 +1,16 @@
 # ARCHIVO: cliente_resource.py
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import jwt_required
-from flask import request, send_file
+from flask import request
+from werkzeug.exceptions import BadRequest
 from models import Cliente, Pedido, Venta, VistaClienteProyeccion
 from schemas import cliente_schema, clientes_schema, ClienteSchema, pedidos_schema
 from extensions import db
-from common import handle_db_errors, validate_pagination_params, create_pagination_response, rol_requerido
-import pandas as pd
+from common import handle_db_errors, validate_pagination_params, create_pagination_response, rol_requerido, paginate_query
+from utils.export_engine import ExportSpec, export_response
+from services.export_jobs import submit_export_request
+from services.historico import con_historico, historico_alcanzado
 import re
-import io
 import logging
 import calendar
 from sqlalchemy import func, desc, asc, cast, Date, case, text
@@ -58,11 +60,13 @@ class ClienteResource(Resource):
     
             # Paginación con validación
             page, per_page = validate_pagination_params()
-            resultado = query.paginate(page=page, per_page=per_page, error_out=False)
+            resultado = paginate_query(query, [], Cliente.id, page, per_page)
             
             # Respuesta estandarizada
             return create_pagination_response(clientes_schema.dump(resultado.items), resultado), 200
             
+        except BadRequest as e:
+            return {"error": e.description}, 400
         except Exception as e:
             logger.error(f"Error al obtener clientes: {str(e)}")
             db.session.rollback()
@@ -154,8 +158,9 @@ class ClienteResource(Resource):
                 
             cliente = Cliente.query.get_or_404(cliente_id)
             
-            # Verificar si tiene ventas asociadas
-            ventas = Venta.query.filter_by(cliente_id=cliente_id).count()
+            # Verificar si tiene ventas asociadas (también archivadas: el histórico no tiene claves foráneas)
+            V = con_historico(Venta)
+            ventas = db.session.query(func.count(V.id)).filter(V.cliente_id == cliente_id).scalar()
             if ventas > 0:
                 return {
                     "error": "No se puede eliminar cliente con historial de ventas",
@@ -176,66 +181,40 @@ class ClienteResource(Resource):
             return {"error": "Error al procesar la solicitud"}, 500
 
 
+CLIENTE_EXPORT_COLUMNS = [
+    ('ID', lambda c: c.id),
+    ('Nombre', lambda c: c.nombre),
+    ('Teléfono', lambda c: c.telefono),
+    ('Dirección', lambda c: c.direccion),
+    ('Ciudad', lambda c: c.ciudad),
+    ('Saldo Pendiente', lambda c: float(c.saldo_pendiente)),
+    ('Última Compra', lambda c: c.ultima_fecha_compra.strftime('%Y-%m-%d') if c.ultima_fecha_compra else None),
+    ('Frecuencia de Compra', lambda c: c.frecuencia_compra_dias),
+]
+
+def build_clientes_export(args, claims=None):
+    """Clientes para exportar, opcionalmente filtrados por ciudad."""
+    # saldo_pendiente recorre ventas y pagos: se cargan por bloque con SELECT ... IN
+    query = Cliente.query.options(orm.selectinload(Cliente.ventas).selectinload(Venta.pagos))
+    if ciudad := args.get('ciudad'):
+        query = query.filter_by(ciudad=ciudad)
+    return ExportSpec('clientes', 'Clientes', query, CLIENTE_EXPORT_COLUMNS, [], Cliente.id)
+
 class ClienteExportResource(Resource):
     @jwt_required()
     @handle_db_errors
     def get(self):
         """
-        Exporta todos los clientes a un archivo Excel, opcionalmente filtrado por ciudad.
+        Exporta todos los clientes a Excel (o CSV con ?formato=csv), opcionalmente filtrado por ciudad.
         """
         parser = reqparse.RequestParser()
         parser.add_argument('ciudad', type=str, location='args', help='Filtra clientes por ciudad')
         args = parser.parse_args()
-        ciudad = args.get('ciudad')
+        if request.args.get('async', 'false').lower() == 'true':
+            return submit_export_request('clientes', args)
 
         try:
-            # 1. Obtener clientes, aplicando filtro si se proporciona
-            if ciudad:
-                clientes = Cliente.query.filter_by(ciudad=ciudad).all()
-            else:
-                clientes = Cliente.query.all()
-            if not clientes:
-                return {"message": "No hay clientes para exportar"}, 404
-
-            # 2. Serializar los datos con el esquema
-            cliente_schema = ClienteSchema(many=True)
-            data = cliente_schema.dump(clientes)
-
-            # 3. Crear un DataFrame de pandas
-            df = pd.DataFrame(data)
-
-            # 4. Optimizar el DataFrame para el reporte
-            columnas_deseadas = {
-                'id': 'ID',
-                'nombre': 'Nombre',
-                'telefono': 'Teléfono',
-                'direccion': 'Dirección',
-                'ciudad': 'Ciudad',
-                'saldo_pendiente': 'Saldo Pendiente',
-                'ultima_fecha_compra': 'Última Compra',
-                'frecuencia_compra_dias': 'Frecuencia de Compra'
-            }
-            
-            # Filtrar y renombrar columnas
-            df_optimizado = df[list(columnas_deseadas.keys())]
-            df_optimizado = df_optimizado.rename(columns=columnas_deseadas)
-
-
-            # 5. Crear un archivo Excel en memoria
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df_optimizado.to_excel(writer, index=False, sheet_name='Clientes')
-            
-            output.seek(0)
-
-            # 5. Enviar el archivo como respuesta
-            return send_file(
-                output,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name='clientes.xlsx'
-            )
-
+            return export_response(build_clientes_export(args), "No hay clientes para exportar")
         except Exception as e:
             logger.error(f"Error al exportar clientes: {str(e)}")
             return {"error": "Error interno al generar el archivo Excel"}, 500
@@ -290,10 +269,15 @@ class ClienteProyeccionResource(Resource):
                     nombre = d.presentacion.nombre if d.presentacion else 'N/A'
                     productos_counter[nombre] = productos_counter.get(nombre, 0) + int(d.cantidad)
             productos_mas = sorted(productos_counter.items(), key=lambda x: x[1], reverse=True)[:5]
-            monto_total_comprado = float(sum(v.total for v in ventas)) if ventas else 0.0
-            promedio_compra = round(monto_total_comprado / len(ventas), 2) if ventas else 0.0
+            # Totales sobre ventas actuales y archivadas: no cambian al archivar
+            V = con_historico(Venta, historico_alcanzado(Venta.fecha))
+            total_ventas, monto_total = db.session.query(
+                func.count(V.id), func.coalesce(func.sum(V.total), 0)
+            ).filter(V.cliente_id == cliente.id).one()
+            monto_total_comprado = float(monto_total)
+            promedio_compra = round(monto_total_comprado / total_ventas, 2) if total_ventas else 0.0
             estadisticas = {
-                'total_ventas': len(ventas),
+                'total_ventas': total_ventas,
                 'monto_total_comprado': monto_total_comprado,
                 'promedio_compra': promedio_compra,
                 'frecuencia_compra_dias': cliente.frecuencia_compra_dias or 0,
@@ -659,104 +643,92 @@ class ClienteProyeccionResource(Resource):
             'porcentaje_retraso': round((con_retraso / total_clientes) * 100, 1) if total_clientes > 0 else 0
         }
 
+def _proxima_compra(cliente):
+    if cliente.ultima_fecha_compra and cliente.frecuencia_compra_dias and cliente.frecuencia_compra_dias > 0:
+        return (cliente.ultima_fecha_compra + timedelta(days=cliente.frecuencia_compra_dias)).strftime('%Y-%m-%d')
+    return 'N/A'
+
+CLIENTE_PROYECCION_EXPORT_COLUMNS = [
+    ('ID', lambda r: r.Cliente.id),
+    ('Nombre', lambda r: r.Cliente.nombre),
+    ('Teléfono', lambda r: r.Cliente.telefono or 'N/A'),
+    ('Dirección', lambda r: r.Cliente.direccion or 'N/A'),
+    ('Ciudad', lambda r: r.Cliente.ciudad or 'N/A'),
+    ('Saldo Pendiente', lambda r: float(r.Cliente.saldo_pendiente)),
+    ('Última Compra', lambda r: r.Cliente.ultima_fecha_compra.strftime('%Y-%m-%d') if r.Cliente.ultima_fecha_compra else 'N/A'),
+    ('Frecuencia Compra (días)', lambda r: r.Cliente.frecuencia_compra_dias or 0),
+    ('Próxima Compra Estimada', lambda r: _proxima_compra(r.Cliente)),
+    ('Total Ventas', lambda r: r.total_ventas),
+    ('Monto Total Comprado', lambda r: float(r.monto_total_comprado)),
+    ('Promedio por Compra', lambda r: float(r.monto_total_comprado) / r.total_ventas if r.total_ventas > 0 else 0),
+    ('Total Pedidos', lambda r: r.total_pedidos),
+]
+
+def build_clientes_proyeccion_export(args, claims=None):
+    """Clientes con frecuencia de compra calculada y sus totales de ventas/pedidos."""
+    # --- Subconsulta para agregar estadísticas de ventas (incluye las archivadas) ---
+    V = con_historico(Venta, historico_alcanzado(Venta.fecha))
+    venta_stats = db.session.query(
+        V.cliente_id.label('cliente_id'),
+        func.count(V.id).label('total_ventas'),
+        func.sum(V.total).label('monto_total_comprado')
+    ).group_by(V.cliente_id).subquery()
+    
+    # --- Subconsulta para agregar estadísticas de pedidos ---
+    pedido_stats = db.session.query(
+        Pedido.cliente_id.label('cliente_id'),
+        func.count(Pedido.id).label('total_pedidos')
+    ).group_by(Pedido.cliente_id).subquery()
+
+    # --- Construir la consulta principal ---
+    query = db.session.query(
+        Cliente,
+        func.coalesce(venta_stats.c.total_ventas, 0).label('total_ventas'),
+        func.coalesce(venta_stats.c.monto_total_comprado, 0).label('monto_total_comprado'),
+        func.coalesce(pedido_stats.c.total_pedidos, 0).label('total_pedidos')
+    ).outerjoin(
+        venta_stats, Cliente.id == venta_stats.c.cliente_id
+    ).outerjoin(
+        pedido_stats, Cliente.id == pedido_stats.c.cliente_id
+    )
+    
+    # Aplicar filtros
+    if args.get('ciudad'):
+        query = query.filter(Cliente.ciudad.ilike(f"%{args['ciudad']}%"))
+    if args.get('saldo_minimo'):
+        query = query.filter(Cliente.saldo_pendiente >= args['saldo_minimo'])
+    if args.get('frecuencia_minima'):
+        query = query.filter(Cliente.frecuencia_compra_dias >= args['frecuencia_minima'])
+    
+    # Solo clientes con frecuencia de compra calculada
+    query = query.filter(Cliente.frecuencia_compra_dias.isnot(None))
+    query = query.options(orm.selectinload(Cliente.ventas).selectinload(Venta.pagos))
+
+    return ExportSpec(
+        'clientes_proyecciones', 'Clientes Proyecciones', query, CLIENTE_PROYECCION_EXPORT_COLUMNS,
+        [(Cliente.ultima_fecha_compra, True)], Cliente.id
+    )
+
 class ClienteProyeccionExportResource(Resource):
     @jwt_required()
     @handle_db_errors
     def get(self):
         """
-        Exporta clientes con proyecciones a un archivo Excel de forma optimizada.
+        Exporta clientes con proyecciones a Excel (o CSV con ?formato=csv) por bloques.
         """
         parser = reqparse.RequestParser()
         parser.add_argument('ciudad', type=str, location='args')
         parser.add_argument('saldo_minimo', type=float, location='args')
         parser.add_argument('frecuencia_minima', type=int, location='args')
         args = parser.parse_args()
+        if request.args.get('async', 'false').lower() == 'true':
+            return submit_export_request('clientes_proyecciones', args)
 
         try:
-            # --- Subconsulta para agregar estadísticas de ventas ---
-            venta_stats = db.session.query(
-                Venta.cliente_id.label('cliente_id'),
-                func.count(Venta.id).label('total_ventas'),
-                func.sum(Venta.total).label('monto_total_comprado')
-            ).group_by(Venta.cliente_id).subquery()
-            
-            # --- Subconsulta para agregar estadísticas de pedidos ---
-            pedido_stats = db.session.query(
-                Pedido.cliente_id.label('cliente_id'),
-                func.count(Pedido.id).label('total_pedidos')
-            ).group_by(Pedido.cliente_id).subquery()
-
-            # --- Construir la consulta principal ---
-            query = db.session.query(
-                Cliente,
-                func.coalesce(venta_stats.c.total_ventas, 0).label('total_ventas'),
-                func.coalesce(venta_stats.c.monto_total_comprado, 0).label('monto_total_comprado'),
-                func.coalesce(pedido_stats.c.total_pedidos, 0).label('total_pedidos')
-            ).outerjoin(
-                venta_stats, Cliente.id == venta_stats.c.cliente_id
-            ).outerjoin(
-                pedido_stats, Cliente.id == pedido_stats.c.cliente_id
-            )
-            
-            # Aplicar filtros
-            if args['ciudad']:
-                query = query.filter(Cliente.ciudad.ilike(f"%{args['ciudad']}%"))
-            if args['saldo_minimo']:
-                query = query.filter(Cliente.saldo_pendiente >= args['saldo_minimo'])
-            if args['frecuencia_minima']:
-                query = query.filter(Cliente.frecuencia_compra_dias >= args['frecuencia_minima'])
-            
-            # Solo clientes con frecuencia de compra calculada
-            query = query.filter(Cliente.frecuencia_compra_dias.isnot(None))
-            
-            resultados = query.order_by(desc(Cliente.ultima_fecha_compra)).all()
-            
-            if not resultados:
-                return {"message": "No hay clientes con proyecciones para exportar con los filtros seleccionados"}, 404
-
-            # --- Construir los datos para el Excel ---
-            data_para_excel = []
-            for result in resultados:
-                cliente = result.Cliente
-                monto_total = float(result.monto_total_comprado)
-                total_ventas = result.total_ventas
-                
-                # Calcular proyección de próxima compra
-                proxima_compra = None
-                if cliente.ultima_fecha_compra and cliente.frecuencia_compra_dias and cliente.frecuencia_compra_dias > 0:
-                    proxima_compra = (cliente.ultima_fecha_compra + timedelta(days=cliente.frecuencia_compra_dias)).strftime('%Y-%m-%d')
-                
-                data_para_excel.append({
-                    'ID': cliente.id,
-                    'Nombre': cliente.nombre,
-                    'Teléfono': cliente.telefono or 'N/A',
-                    'Dirección': cliente.direccion or 'N/A',
-                    'Ciudad': cliente.ciudad or 'N/A',
-                    'Saldo Pendiente': float(cliente.saldo_pendiente),
-                    'Última Compra': cliente.ultima_fecha_compra.strftime('%Y-%m-%d') if cliente.ultima_fecha_compra else 'N/A',
-                    'Frecuencia Compra (días)': cliente.frecuencia_compra_dias or 0,
-                    'Próxima Compra Estimada': proxima_compra or 'N/A',
-                    'Total Ventas': total_ventas,
-                    'Monto Total Comprado': monto_total,
-                    'Promedio por Compra': monto_total / total_ventas if total_ventas > 0 else 0,
-                    'Total Pedidos': result.total_pedidos
-                })
-
-            df = pd.DataFrame(data_para_excel)
-
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Clientes Proyecciones')
-            
-            output.seek(0)
-
-            return send_file(
-                output,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name=f'clientes_proyecciones_{datetime.now().strftime("%Y%m%d")}.xlsx'
+            return export_response(
+                build_clientes_proyeccion_export(args),
+                "No hay clientes con proyecciones para exportar con los filtros seleccionados"
             )
-
         except Exception as e:
             logger.error(f"Error al exportar clientes con proyecciones: {str(e)}")
             return {"error": "Error interno al generar el archivo Excel"}, 500
\ No newline at end of file
@@ -1,7 +1,7 @@
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt
 from flask import request
-from models import Venta, Pedido, Inventario, Cliente, PresentacionProducto, Almacen, Lote, Pago
+from models import Venta, Pedido, StockResumen, Cliente, PresentacionProducto, Almacen, Lote, Pago
 from extensions import db
 from common import handle_db_errors, rol_requerido
 from datetime import datetime, timezone, timedelta
@@ -27,17 +27,17 @@ class DashboardResource(Resource):
         user_almacen_id = claims.get('almacen_id')
         is_admin_or_gerente = user_rol in ['admin', 'gerente']
 
-        # Inventario con stock bajo (SIN filtro de fecha)
+        # Inventario con stock bajo (SIN filtro de fecha), por presentación y almacén desde stock_resumen
         inventario_query = db.session.query(
-            Inventario.presentacion_id,
+            StockResumen.presentacion_id,
             PresentacionProducto.nombre.label('presentacion_nombre'),
-            Inventario.cantidad,
-            Inventario.stock_minimo,
-            Inventario.almacen_id,
+            StockResumen.unidades.label('cantidad'),
+            StockResumen.stock_minimo,
+            StockResumen.almacen_id,
             Almacen.nombre.label('almacen_nombre')
-        ).join(PresentacionProducto, Inventario.presentacion_id == PresentacionProducto.id)\
-         .join(Almacen, Inventario.almacen_id == Almacen.id)\
-         .filter(Inventario.cantidad <= Inventario.stock_minimo) # Alerta de stock bajo
+        ).join(PresentacionProducto, StockResumen.presentacion_id == PresentacionProducto.id)\
+         .join(Almacen, StockResumen.almacen_id == Almacen.id)\
+         .filter(StockResumen.unidades <= StockResumen.stock_minimo) # Alerta de stock bajo
 
         # Lotes con cantidad baja (SIN filtro de fecha)
         # Ajusta el umbral (e.g., 500) según sea necesario
@@ -68,7 +68,7 @@ class DashboardResource(Resource):
             if not user_almacen_id:
                 return {"error": "Usuario sin almacén asignado"}, 403
             # Aplicar filtro a las queries que tienen relación directa con almacén
-            inventario_query = inventario_query.filter(Inventario.almacen_id == user_almacen_id)
+            inventario_query = inventario_query.filter(StockResumen.almacen_id == user_almacen_id)
             ventas_pendientes_query = ventas_pendientes_query.filter(Venta.almacen_id == user_almacen_id)
         
         # La query de lotes (lotes_query) no se filtra por almacén aquí.
@@ -0,0 +1,86 @@
+# ARCHIVO: resources/exportacion_resource.py
+import logging
+import os
+
+from flask import send_file
+from flask_jwt_extended import jwt_required, get_jwt
+from flask_restful import Resource
+
+from common import handle_db_errors
+from extensions import db
+from models import ExportJob
+from services.export_jobs import (
+    ESTADO_COMPLETADO, cancel_export_job, export_job_payload
+)
+from utils.export_engine import FORMATOS
+
+logger = logging.getLogger(__name__)
+
+
+def _get_job_del_usuario(job_uuid):
+    """
+    Devuelve (job, None) o (None, respuesta de error). Solo el dueño o un admin lo ven.
+    El parámetro de ruta no termina en `_id`: handle_db_errors lo convertiría a int
+    y los ids de exportación son UUID.
+    """
+    job = db.session.get(ExportJob, job_uuid)
+    if job is None:
+        return None, ({"error": "Exportación no encontrada"}, 404)
+    claims = get_jwt()
+    if claims.get('rol') != 'admin' and str(job.usuario_id) != str(claims.get('sub')):
+        return None, ({"error": "No tienes permiso para ver esta exportación"}, 403)
+    return job, None
+
+
+class ExportacionListResource(Resource):
+    @jwt_required()
+    @handle_db_errors
+    def get(self):
+        """Últimas exportaciones en segundo plano del usuario actual."""
+        jobs = ExportJob.query.filter_by(usuario_id=int(get_jwt().get('sub'))) \
+            .order_by(ExportJob.created_at.desc()).limit(20).all()
+        return {"data": [export_job_payload(job) for job in jobs]}, 200
+
+
+class ExportacionResource(Resource):
+    @jwt_required()
+    @handle_db_errors
+    def get(self, job_uuid):
+        """
+        Estado de una exportación en segundo plano.
+        - Estados: pendiente, procesando, completado, error, cancelado, expirado
+        - Con estado completado incluye `descarga_url`
+        """
+        job, error = _get_job_del_usuario(job_uuid)
+        if error:
+            return error
+        return export_job_payload(job), 200
+
+    @jwt_required()
+    @handle_db_errors
+    def delete(self, job_uuid):
+        """Cancela una exportación pendiente o en curso."""
+        job, error = _get_job_del_usuario(job_uuid)
+        if error:
+            return error
+        if not cancel_export_job(job):
+            return {"error": f"La exportación ya terminó (estado: {job.estado})"}, 409
+        return export_job_payload(job), 200
+
+
+class ExportacionDescargaResource(Resource):
+    @jwt_required()
+    @handle_db_errors
+    def get(self, job_uuid):
+        """Descarga de exportaciones guardadas en disco (cuando S3 no está configurado)."""
+        job, error = _get_job_del_usuario(job_uuid)
+        if error:
+            return error
+        if job.estado != ESTADO_COMPLETADO or not job.ruta_local or not os.path.exists(job.ruta_local):
+            return {"error": "El archivo de esta exportación no está disponible"}, 404
+        return send_file(
+            job.ruta_local,
+            mimetype=FORMATOS[job.formato],
+            as_attachment=True,
+            download_name=f'{job.tipo}_{job.created_at.strftime("%Y%m%d")}.{job.formato}'
+        )
@@ -1,13 +1,13 @@
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import jwt_required, get_jwt
-from flask import request, send_file
+from flask import request
 from models import Gasto, Almacen, Users, Lote
 from schemas import gasto_schema, gastos_schema
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, parse_iso_datetime
-from sqlalchemy import asc, desc
-import pandas as pd
-import io
+from utils.export_engine import ExportSpec, export_response
+from services.export_jobs import submit_export_request
+from common import handle_db_errors, MAX_ITEMS_PER_PAGE, parse_iso_datetime, paginate_query, create_pagination_response
+from sqlalchemy import asc, desc, orm
 import logging
 from datetime import datetime
 
@@ -76,17 +76,9 @@ class GastoResource(Resource):
         # Paginación
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 10, type=int), MAX_ITEMS_PER_PAGE)
-        gastos = query.paginate(page=page, per_page=per_page, error_out=False)
+        gastos = paginate_query(query, [(column_to_sort, sort_order == 'desc')], Gasto.id, page, per_page)
         
-        return {
-            "data": gastos_schema.dump(gastos.items),
-            "pagination": {
-                "total": gastos.total,
-                "page": gastos.page,
-                "per_page": gastos.per_page,
-                "pages": gastos.pages
-            }
-        }, 200
+        return create_pagination_response(gastos_schema.dump(gastos.items), gastos), 200
 
     @jwt_required()
     @handle_db_errors
@@ -129,69 +121,53 @@ class GastoResource(Resource):
         db.session.commit()
         return {"message": "Gasto eliminado exitosamente"}, 200
 
+GASTO_EXPORT_COLUMNS = [
+    ('ID', lambda g: g.id),
+    ('Fecha', lambda g: g.fecha.strftime('%Y-%m-%d') if g.fecha else ''),
+    ('Monto', lambda g: float(g.monto)),
+    ('Categoría', lambda g: g.categoria),
+    ('Descripción', lambda g: g.descripcion),
+    ('Almacén', lambda g: g.almacen.nombre if g.almacen else 'N/A'),
+    ('Usuario', lambda g: g.usuario.username if g.usuario else 'N/A'),
+    ('Lote', lambda g: g.lote.descripcion if g.lote else 'N/A'),
+]
+
+def build_gastos_export(args, claims):
+    """Consulta filtrada de gastos para exportar."""
+    query = Gasto.query.options(
+        orm.joinedload(Gasto.almacen), orm.joinedload(Gasto.usuario), orm.joinedload(Gasto.lote)
+    )
+    # --- FILTRO POR ROL ---
+    if claims.get('rol') != 'admin':
+        query = query.filter_by(usuario_id=claims.get('sub'))
+    # ----------------------
+
+    # Filtros adicionales
+    if categoria := args.get('categoria'):
+        query = query.filter_by(categoria=categoria)
+    if fecha_inicio := args.get('fecha_inicio'):
+        query = query.filter(Gasto.fecha >= fecha_inicio)
+    if fecha_fin := args.get('fecha_fin'):
+        query = query.filter(Gasto.fecha <= fecha_fin)
+    if usuario_id := args.get('usuario_id'):
+        query = query.filter_by(usuario_id=usuario_id)
+    if lote_id := args.get('lote_id'):
+        query = query.filter_by(lote_id=lote_id)
+    if almacen_id := args.get('almacen_id'):
+        query = query.filter_by(almacen_id=almacen_id)
+
+    return ExportSpec('gastos', 'Gastos', query, GASTO_EXPORT_COLUMNS, [(Gasto.fecha, True)], Gasto.id)
+
 class GastoExportResource(Resource):
     @jwt_required()
     @handle_db_errors
     def get(self):
-        """Exporta gastos a Excel"""
+        """Exporta gastos a Excel (o CSV con ?formato=csv) por bloques; con ?async=true, en segundo plano"""
+        if request.args.get('async', 'false').lower() == 'true':
+            return submit_export_request('gastos', request.args.to_dict())
         try:
-            # --- FILTRO POR ROL ---
-            claims = get_jwt()
-            current_user_id = claims.get('sub')
-            rol = claims.get('rol')
-            
-            query = Gasto.query
-            if rol != 'admin':
-                query = query.filter_by(usuario_id=current_user_id)
-            # ----------------------
-
-            # Filtros adicionales
-            if categoria := request.args.get('categoria'):
-                query = query.filter_by(categoria=categoria)
-            if fecha_inicio := request.args.get('fecha_inicio'):
-                query = query.filter(Gasto.fecha >= fecha_inicio)
-            if fecha_fin := request.args.get('fecha_fin'):
-                query = query.filter(Gasto.fecha <= fecha_fin)
-            if usuario_id := request.args.get('usuario_id'):
-                query = query.filter_by(usuario_id=usuario_id)
-            if lote_id := request.args.get('lote_id'):
-                query = query.filter_by(lote_id=lote_id)
-            if almacen_id := request.args.get('almacen_id'):
-                query = query.filter_by(almacen_id=almacen_id)
-
-            gastos = query.order_by(desc(Gasto.fecha)).all()
-
-            if not gastos:
-                return {"message": "No hay gastos para exportar"}, 404
-
-            data_para_excel = []
-            for gasto in gastos:
-                data_para_excel.append({
-                    'ID': gasto.id,
-                    'Fecha': gasto.fecha.strftime('%Y-%m-%d') if gasto.fecha else '',
-                    'Monto': float(gasto.monto),
-                    'Categoría': gasto.categoria,
-                    'Descripción': gasto.descripcion,
-                    'Almacén': gasto.almacen.nombre if gasto.almacen else 'N/A',
-                    'Usuario': gasto.usuario.username if gasto.usuario else 'N/A',
-                    'Lote': gasto.lote.descripcion if gasto.lote else 'N/A'
-                })
-
-            df = pd.DataFrame(data_para_excel)
-
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Gastos')
-            
-            output.seek(0)
-
-            return send_file(
-                output,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name=f'gastos_{datetime.now().strftime("%Y%m%d")}.xlsx'
-            )
-
+            spec = build_gastos_export(request.args.to_dict(), get_jwt())
+            return export_response(spec, "No hay gastos para exportar")
         except Exception as e:
             logger.error(f"Error al exportar gastos: {str(e)}")
-            return {"error": "Error interno al generar el archivo Excel"}, 500
\ No newline at end of file
+            return {"error": "Error interno al generar el archivo Excel"}, 500
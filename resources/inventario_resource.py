@@ -4,12 +4,16 @@ from flask import request, jsonify
 from models import Inventario, PresentacionProducto, Almacen, Lote, Movimiento
 from schemas import inventario_schema, inventarios_schema, lote_schema
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin, validate_pagination_params, create_pagination_response
+from common import handle_db_errors, retry_on_deadlock, is_retryable_db_error, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin, validate_pagination_params, create_pagination_response, paginate_query
 from decimal import Decimal, InvalidOperation
 import logging
 from datetime import datetime, timezone
+from itertools import groupby
+from collections import defaultdict
+from sqlalchemy import insert, tuple_
+from sqlalchemy.orm import joinedload
+from services.stock_resumen import STOCK_MINIMO_POR_DEFECTO, registrar_deltas
 import werkzeug.exceptions
-import sqlalchemy.orm.exc
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -21,41 +25,35 @@ class InventarioGlobalResource(Resource):
         """
         Genera un reporte de inventario global, agrupado por presentación,
         mostrando el stock total, la proyección de ventas y el detalle por almacén y lote.
+        Filtros opcionales: tipo (por defecto 'procesado') y almacen_id.
+        Una sola consulta ordenada por presentación, agrupada en una pasada.
         """
         try:
-            # Subconsulta para obtener el stock por almacen y lote para cada presentación (solo tipo 'procesado')
-            stock_por_almacen_lote = db.session.query(
-                Inventario.presentacion_id,
+            tipo = request.args.get('tipo', 'procesado')
+            almacen_id = request.args.get('almacen_id', type=int)
+
+            filas = db.session.query(
+                PresentacionProducto.id.label('presentacion_id'),
+                PresentacionProducto.nombre.label('nombre_presentacion'),
+                PresentacionProducto.precio_venta,
                 Almacen.nombre.label('almacen_nombre'),
                 Lote.descripcion.label('lote_descripcion'),
                 Lote.id.label('lote_id'),
                 Lote.cantidad_disponible_kg.label('lote_kg_disponible'),
                 Inventario.cantidad
-            ).join(Almacen, Inventario.almacen_id == Almacen.id
-            ).join(PresentacionProducto, Inventario.presentacion_id == PresentacionProducto.id
-            ).filter(PresentacionProducto.tipo == 'procesado'
-            ).outerjoin(Lote, Inventario.lote_id == Lote.id).subquery()
-
-            # Consulta principal para agregar por presentación (solo tipo 'procesado')
-            reporte = db.session.query(
-                PresentacionProducto.id.label('presentacion_id'),
-                PresentacionProducto.nombre.label('nombre_presentacion'),
-                PresentacionProducto.precio_venta,
-                db.func.sum(Inventario.cantidad).label('stock_total_unidades')
             ).join(Inventario, PresentacionProducto.id == Inventario.presentacion_id
-            ).filter(PresentacionProducto.tipo == 'procesado'
-            ).group_by(
-                PresentacionProducto.id, 
-                PresentacionProducto.nombre,
-                PresentacionProducto.precio_venta
-            ).order_by(PresentacionProducto.nombre).all()
+            ).join(Almacen, Inventario.almacen_id == Almacen.id
+            ).outerjoin(Lote, Inventario.lote_id == Lote.id
+            ).filter(PresentacionProducto.tipo == tipo)
+            if almacen_id:
+                filas = filas.filter(Inventario.almacen_id == almacen_id)
+            filas = filas.order_by(
+                PresentacionProducto.nombre, PresentacionProducto.id, Almacen.nombre, Inventario.id
+            ).all()
 
             resultado_final = []
-            for item in reporte:
-                detalles = db.session.query(stock_por_almacen_lote)\
-                    .filter(stock_por_almacen_lote.c.presentacion_id == item.presentacion_id)\
-                    .all()
-                
+            for presentacion_id, grupo in groupby(filas, key=lambda fila: fila.presentacion_id):
+                detalles = list(grupo)
                 detalles_serializados = [
                     {
                         'almacen': d.almacen_nombre,
@@ -66,13 +64,13 @@ class InventarioGlobalResource(Resource):
                     } for d in detalles
                 ]
 
-                total_unidades = int(item.stock_total_unidades)
-                precio_venta = item.precio_venta
+                total_unidades = int(sum(d.cantidad or 0 for d in detalles))
+                precio_venta = detalles[0].precio_venta
                 proyeccion_venta = total_unidades * precio_venta if precio_venta else 0
 
                 resultado_final.append({
-                    'presentacion_id': item.presentacion_id,
-                    'nombre_presentacion': item.nombre_presentacion,
+                    'presentacion_id': presentacion_id,
+                    'nombre_presentacion': detalles[0].nombre_presentacion,
                     'stock_total_unidades': total_unidades,
                     'proyeccion_venta': float(proyeccion_venta),
                     'detalle_por_almacen': detalles_serializados
@@ -147,11 +145,16 @@ class InventarioResource(Resource):
             
             # Paginación con validación
             page, per_page = validate_pagination_params()
-            inventarios = query.paginate(page=page, per_page=per_page)
+            inventarios = paginate_query(
+                query, [(Inventario.almacen_id, False), (Inventario.presentacion_id, False)],
+                Inventario.id, page, per_page, error_out=True
+            )
             
             # Respuesta estandarizada
             return create_pagination_response(inventarios_schema.dump(inventarios.items), inventarios), 200
             
+        except werkzeug.exceptions.BadRequest as e:
+            return {"error": e.description}, 400
         except Exception as e:
             logger.error(f"Error al obtener inventario: {str(e)}")
             return {"error": "Error al procesar la solicitud"}, 500
@@ -159,6 +162,7 @@ class InventarioResource(Resource):
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         """Crea uno o múltiples registros de inventario con validación completa"""
         try:
@@ -173,139 +177,147 @@ class InventarioResource(Resource):
             if not isinstance(raw_data, list):
                 raw_data = [raw_data] # Convertir a lista para procesamiento uniforme
 
-            created_inventories = []
-            claims = get_jwt()
-            
-            for item_data in raw_data:
-                inventario, error_response = self._create_single_inventario(item_data, claims)
-                if error_response:
-                    # Si hay un error en cualquier elemento, revertir toda la transacción
-                    db.session.rollback()
-                    return error_response[0], error_response[1]
-                created_inventories.append(inventario)
+            created_inventories, error_response = self._create_inventarios(raw_data, get_jwt())
+            if error_response:
+                # Si hay un error en cualquier elemento, revertir toda la transacción
+                db.session.rollback()
+                return error_response[0], error_response[1]
 
+            # Serializar antes del commit: después las filas quedarían expiradas y se recargarían una a una
+            resultado = inventarios_schema.dump(created_inventories)
             db.session.commit()
             logger.info(f"Inventarios creados exitosamente. Cantidad: {len(created_inventories)}")
-            return inventarios_schema.dump(created_inventories), 201
+            return resultado, 201
             
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             logger.error(f"Error en POST inventario: {str(e)}")
             return {"error": "Error al crear inventario", "details": str(e)}, 500
 
-    def _create_single_inventario(self, item_data, claims):
-        """Lógica para crear un único registro de inventario, usada internamente."""
-        try:
+    def _create_inventarios(self, items, claims):
+        """
+        Crea los registros de inventario de `items` con un número fijo de consultas:
+        precarga presentaciones, almacenes, lotes (bloqueados) y claves existentes,
+        valida en memoria en el orden de la lista (el primer item inválido da el error),
+        y escribe inventarios, movimientos, lotes y stock_resumen en bloque.
+        Retorna (inventarios creados, error_response).
+        """
+        if not all(isinstance(item, dict) for item in items):
+            return None, ({"error": "Cada item debe ser un objeto JSON"}, 400)
+
+        def _id(valor):
+            try:
+                return int(valor)
+            except (ValueError, TypeError):
+                return None
+
+        presentacion_ids = {_id(item.get('presentacion_id')) for item in items} - {None}
+        almacen_ids = {_id(item.get('almacen_id')) for item in items} - {None}
+        lote_ids = {_id(item.get('lote_id')) for item in items if item.get('lote_id')} - {None}
+
+        presentaciones = {p.id: p for p in PresentacionProducto.query.filter(
+            PresentacionProducto.id.in_(presentacion_ids))} if presentacion_ids else {}
+        almacenes = {a.id: a for a in Almacen.query.filter(Almacen.id.in_(almacen_ids))} if almacen_ids else {}
+        lotes = {l.id: l for l in Lote.query.filter(Lote.id.in_(lote_ids))
+                 .order_by(Lote.id).with_for_update()} if lote_ids else {}
+        existentes = set()
+        if presentacion_ids and almacen_ids:
+            existentes = set(db.session.query(
+                Inventario.presentacion_id, Inventario.almacen_id, Inventario.lote_id
+            ).filter(
+                Inventario.presentacion_id.in_(presentacion_ids), Inventario.almacen_id.in_(almacen_ids)
+            ).all())
+
+        filas, movimientos = [], []
+        disponible_kg = {lote_id: lote.cantidad_disponible_kg for lote_id, lote in lotes.items()}
+        ahora = datetime.now(timezone.utc)
+
+        for item_data in items:
             # Verificar campos requeridos
-            required_fields = ["presentacion_id", "almacen_id", "cantidad"]
-            for field in required_fields:
+            for field in ("presentacion_id", "almacen_id", "cantidad"):
                 if field not in item_data:
                     return None, ({"error": f"Campo requerido '{field}' faltante en un item", "item": item_data}, 400)
-            
+
             # Validar valores numéricos
             try:
                 presentacion_id = int(item_data.get('presentacion_id'))
                 almacen_id = int(item_data.get('almacen_id'))
-                cantidad = Decimal(item_data.get('cantidad'))
-                
-                if cantidad < 0:
-                    return None, ({"error": "La cantidad no puede ser negativa en un item", "item": item_data}, 400)
-                    
-                if 'stock_minimo' in item_data:
-                    stock_minimo = int(item_data.get('stock_minimo'))
-                    if stock_minimo < 0:
-                        return None, ({"error": "El stock mínimo no puede ser negativo en un item", "item": item_data}, 400)
-                        
-            except (ValueError, TypeError):
+                cantidad = Decimal(str(item_data.get('cantidad')))
+                lote_id = int(item_data['lote_id']) if item_data.get('lote_id') else None
+                stock_minimo = int(item_data['stock_minimo']) if 'stock_minimo' in item_data else None
+            except (ValueError, TypeError, InvalidOperation):
                 return None, ({"error": "Valores numéricos inválidos en un item", "item": item_data}, 400)
-            
+            if cantidad < 0:
+                return None, ({"error": "La cantidad no puede ser negativa en un item", "item": item_data}, 400)
+            if stock_minimo is not None and stock_minimo < 0:
+                return None, ({"error": "El stock mínimo no puede ser negativo en un item", "item": item_data}, 400)
+
             # Validar permisos por almacén
             if claims.get('rol') != 'admin' and almacen_id != claims.get('almacen_id'):
                 return None, ({"error": "No tiene permisos para este almacén en un item", "item": item_data}, 403)
-            
+
             # Validar relaciones
-            try:
-                presentacion = PresentacionProducto.query.get_or_404(presentacion_id)
-                almacen = Almacen.query.get_or_404(almacen_id)
-                # Si se provee lote_id, validarlo
-                if item_data.get('lote_id'):
-                    lote = Lote.query.get_or_404(item_data['lote_id'])
-            except (werkzeug.exceptions.NotFound, sqlalchemy.orm.exc.NoResultFound) as e:
-                # Captura específica para 404 de get_or_404
-                return None, ({"error": f"Relación inválida (ID no encontrado): {str(e.description)}", "item": item_data}, 400)
-            except Exception as e:
-                # Captura para otras excepciones inesperadas durante la validación de relaciones
-                return None, ({"error": f"Error inesperado al validar relaciones: {str(e)}", "item": item_data}, 500)
-            
-            # Verificar unicidad
-            lote_id = item_data.get('lote_id')
-            query = Inventario.query.filter_by(
-                presentacion_id=presentacion_id,
-                almacen_id=almacen_id
-            )
-            if lote_id:
-                query = query.filter_by(lote_id=lote_id)
-            else:
-                query = query.filter(Inventario.lote_id.is_(None))
+            for nombre, clave, encontrados in (("presentación", presentacion_id, presentaciones),
+                                               ("almacén", almacen_id, almacenes),
+                                               ("lote", lote_id, lotes)):
+                if clave is not None and clave not in encontrados:
+                    return None, ({"error": f"Relación inválida (ID no encontrado): {nombre} {clave}", "item": item_data}, 400)
 
-            if query.first():
-                error_msg = f"Ya existe un registro de inventario para esta presentación en este almacén"
-                if lote_id:
-                    error_msg += f" con el lote ID {lote_id}"
-                else:
-                    error_msg += " sin lote asignado"
+            # Verificar unicidad (contra la base y contra los items anteriores del mismo envío)
+            clave_inventario = (presentacion_id, almacen_id, lote_id)
+            if clave_inventario in existentes:
+                error_msg = "Ya existe un registro de inventario para esta presentación en este almacén"
+                error_msg += f" con el lote ID {lote_id}" if lote_id else " sin lote asignado"
                 return None, ({"error": error_msg, "item": item_data}, 409)
-            
-            # Cargar con el esquema después de validaciones básicas
-            data = inventario_schema.load(item_data)
-            
-            # Procesar movimiento si hay cantidad inicial
-            if data.cantidad > 0:
-                movimiento = Movimiento(
-                    tipo='entrada',
-                    presentacion_id=data.presentacion_id,
-                    lote_id=data.lote_id,
-                    cantidad=data.cantidad,
-                    usuario_id=claims.get('sub'),
-                    motivo="Inicialización de inventario",
-                    fecha=datetime.now(timezone.utc)
-                )
-                db.session.add(movimiento)
-                
-                # Validar y actualizar lote si corresponde
-                if data.lote_id:
-                    lote = Lote.query.get_or_404(data.lote_id)
-                    
-                    # Asegurar que capacidad_kg sea un Decimal para el cálculo
-                    try:
-                        capacidad_kg = Decimal(str(presentacion.capacidad_kg))
-                        cantidad_decimal = Decimal(str(data.cantidad))
-                        
-                        # Calcular kg a restar del lote
-                        kg_a_restar = cantidad_decimal * capacidad_kg
-                        
-                        # Verificar stock disponible en lote
-                        if not lote.cantidad_disponible_kg or lote.cantidad_disponible_kg < kg_a_restar:
-                            return None, ({"error": "Stock insuficiente en el lote", "disponible_kg": str(lote.cantidad_disponible_kg), "requerido_kg": str(kg_a_restar), "item": item_data}, 400)
-                        
-                        # Actualizar lote
-                        lote.cantidad_disponible_kg -= kg_a_restar
-                    except (InvalidOperation, TypeError) as e:
-                        return None, ({"error": f"Error en cálculo de cantidades: {str(e)}", "item": item_data}, 400)
-            
-            # Guardar en la base de datos
-            db.session.add(data)
-            
-            return data, None # Retorna el objeto inventario creado y sin errores
-            
-        except Exception as e:
-            logger.error(f"Error al procesar item de inventario: {str(e)}")
-            # No se hace rollback aquí, se delega al método post principal
-            return None, ({"error": "Error interno al procesar item de inventario", "details": str(e), "item": item_data}, 500)
+            existentes.add(clave_inventario)
+
+            filas.append({
+                'presentacion_id': presentacion_id,
+                'almacen_id': almacen_id,
+                'lote_id': lote_id,
+                'cantidad': cantidad,
+                'stock_minimo': STOCK_MINIMO_POR_DEFECTO if stock_minimo is None else stock_minimo,
+            })
+
+            # Movimiento y descuento del lote si hay cantidad inicial
+            if cantidad > 0:
+                movimientos.append({
+                    'tipo': 'entrada',
+                    'presentacion_id': presentacion_id,
+                    'lote_id': lote_id,
+                    'cantidad': cantidad,
+                    'usuario_id': claims.get('sub'),
+                    'motivo': "Inicialización de inventario",
+                    'fecha': ahora,
+                })
+                if lote_id:
+                    kg_a_restar = cantidad * Decimal(str(presentaciones[presentacion_id].capacidad_kg))
+                    if not disponible_kg[lote_id] or disponible_kg[lote_id] < kg_a_restar:
+                        return None, ({"error": "Stock insuficiente en el lote", "disponible_kg": str(disponible_kg[lote_id]), "requerido_kg": str(kg_a_restar), "item": item_data}, 400)
+                    disponible_kg[lote_id] -= kg_a_restar
+
+        # Escrituras en bloque: INSERT multi-fila de inventarios y movimientos, un UPDATE por lote
+        for lote_id, lote in lotes.items():
+            if disponible_kg[lote_id] != lote.cantidad_disponible_kg:
+                lote.cantidad_disponible_kg = disponible_kg[lote_id]
+        creados = db.session.scalars(insert(Inventario).returning(Inventario), filas).all()
+        if movimientos:
+            db.session.execute(insert(Movimiento), movimientos)
+
+        # El INSERT en bloque no pasa por los eventos de flush: stock_resumen se actualiza aquí
+        deltas = defaultdict(Decimal)
+        for fila in filas:
+            deltas[(fila['almacen_id'], fila['presentacion_id'])] += fila['cantidad']
+        registrar_deltas(deltas)
+
+        return creados, None
 
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def put(self, inventario_id=None):
         """
         Actualiza registro(s) de inventario existente(s)
@@ -328,6 +340,8 @@ class InventarioResource(Resource):
             return self._update_multiple_inventarios(raw_data)
             
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             logger.error(f"Error en PUT inventario: {str(e)}")
             return {"error": "Error al actualizar inventario"}, 500
@@ -335,8 +349,10 @@ class InventarioResource(Resource):
     def _update_single_inventario(self, inventario_id, raw_data):
         """Actualiza un solo registro de inventario"""
         try:
-            # Buscar el registro existente
-            inventario = Inventario.query.get_or_404(inventario_id)
+            # Buscar el registro existente (bloqueado: la diferencia del ajuste se calcula sobre él)
+            inventario = db.session.get(Inventario, inventario_id, with_for_update=True)
+            if inventario is None:
+                return {"error": f"Inventario con ID {inventario_id} no encontrado"}, 404
             
             # Verificar permisos
             claims = get_jwt()
@@ -354,67 +370,198 @@ class InventarioResource(Resource):
             return inventario_schema.dump(inventario), 200
             
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             logger.error(f"Error en actualización individual: {str(e)}")
             return {"error": "Error al actualizar inventario individual"}, 500
 
     def _update_multiple_inventarios(self, raw_data):
-        """Actualiza múltiples registros de inventario"""
-        try:
-            # Validar que sea una lista
-            if not isinstance(raw_data, list):
-                return {"error": "Para actualización múltiple se esperaba una lista de objetos"}, 400
-            
-            if not raw_data:
-                return {"error": "Lista vacía para actualización múltiple"}, 400
-            
-            updated_inventarios = []
-            claims = get_jwt()
-            
-            for item_data in raw_data:
-                # Validar que cada item tenga ID
-                if 'id' not in item_data:
-                    db.session.rollback()
-                    return {"error": "Cada item debe tener un 'id' para actualización múltiple", "item": item_data}, 400
-                
-                try:
-                    inventario_id = int(item_data['id'])
-                    inventario = Inventario.query.get(inventario_id)
-                    
-                    if not inventario:
-                        db.session.rollback()
-                        return {"error": f"Inventario con ID {inventario_id} no encontrado", "item": item_data}, 404
-                    
-                    # Verificar permisos
-                    if claims.get('rol') != 'admin' and inventario.almacen_id != claims.get('almacen_id'):
-                        db.session.rollback()
-                        return {"error": f"No tiene permisos para modificar inventario ID {inventario_id}"}, 403
-                    
-                    # Validar y actualizar
-                    updated_inventario, error_response = self._validate_and_update_inventario(inventario, item_data, claims)
-                    if error_response:
-                        db.session.rollback()
-                        return error_response[0], error_response[1]
-                    
-                    updated_inventarios.append(updated_inventario)
-                    
-                except (ValueError, TypeError):
-                    db.session.rollback()
-                    return {"error": "ID de inventario inválido", "item": item_data}, 400
-                except Exception as e:
-                    db.session.rollback()
-                    logger.error(f"Error procesando item {item_data}: {str(e)}")
-                    return {"error": f"Error procesando item: {str(e)}", "item": item_data}, 500
-            
-            db.session.commit()
-            
-            logger.info(f"Inventarios actualizados en batch: {len(updated_inventarios)} registros")
-            return inventarios_schema.dump(updated_inventarios), 200
-            
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"Error en actualización múltiple: {str(e)}")
-            return {"error": "Error al actualizar inventarios múltiples"}, 500
+        """
+        Actualiza múltiples registros de inventario y reporta el resultado de cada item.
+        Cada item se acepta o rechaza por separado, en el orden del envío:
+        - Las filas se leen con su presentación, almacén y lote en una sola consulta
+          bloqueada (mismo orden que el servicio de stock); los lotes a validar o
+          descontar, en otra.
+        - Los cambios se validan y aplican en memoria; un flush escribe las filas
+          (y stock_resumen) y los movimientos van en un único INSERT multi-fila.
+        """
+        # Validar que sea una lista
+        if not isinstance(raw_data, list):
+            return {"error": "Para actualización múltiple se esperaba una lista de objetos"}, 400
+
+        if not raw_data:
+            return {"error": "Lista vacía para actualización múltiple"}, 400
+
+        claims = get_jwt()
+        resultados = [{"index": i, "id": None, "estado": None} for i in range(len(raw_data))]
+
+        def rechazar(i, error, **extra):
+            resultados[i].update(estado='error', error=error, **extra)
+
+        # --- 1. Forma de cada item (sin consultas) ---
+        pendientes = []  # (index, inventario_id, cambios, item)
+        for i, item_data in enumerate(raw_data):
+            if not isinstance(item_data, dict) or 'id' not in item_data:
+                rechazar(i, "Cada item debe tener un 'id' para actualización múltiple")
+                continue
+            try:
+                inventario_id = int(item_data['id'])
+            except (ValueError, TypeError):
+                rechazar(i, "ID de inventario inválido")
+                continue
+            resultados[i]['id'] = inventario_id
+
+            cambios = {}
+            try:
+                if 'cantidad' in item_data:
+                    cambios['cantidad'] = Decimal(str(item_data['cantidad']))
+                    if cambios['cantidad'] < 0:
+                        rechazar(i, "La cantidad no puede ser negativa")
+                        continue
+            except (InvalidOperation, TypeError, ValueError):
+                rechazar(i, "Valor de cantidad inválido")
+                continue
+            try:
+                if 'stock_minimo' in item_data:
+                    cambios['stock_minimo'] = int(item_data['stock_minimo'])
+                    if cambios['stock_minimo'] < 0:
+                        rechazar(i, "El stock mínimo no puede ser negativo")
+                        continue
+            except (ValueError, TypeError):
+                rechazar(i, "Valor de stock mínimo inválido")
+                continue
+            try:
+                if 'lote_id' in item_data:
+                    cambios['lote_id'] = int(item_data['lote_id']) if item_data['lote_id'] else None
+            except (ValueError, TypeError):
+                rechazar(i, "ID de lote inválido")
+                continue
+            pendientes.append((i, inventario_id, cambios, item_data))
+
+        # --- 2. Filas (bloqueadas, en orden) con presentación, almacén y lote en una consulta ---
+        inventarios = {inv.id: inv for inv in Inventario.query.options(
+            joinedload(Inventario.presentacion, innerjoin=True),
+            joinedload(Inventario.almacen, innerjoin=True),
+            joinedload(Inventario.lote)
+        ).filter(
+            Inventario.id.in_({p[1] for p in pendientes})
+        ).order_by(
+            Inventario.almacen_id, Inventario.presentacion_id, Inventario.lote_id.nullsfirst(), Inventario.id
+        ).with_for_update(of=Inventario).populate_existing()} if pendientes else {}
+
+        # Lotes nuevos y lotes de filas que reciben entradas: se validan y pueden descontarse
+        lote_ids = set()
+        for _, inventario_id, cambios, _ in pendientes:
+            inventario = inventarios.get(inventario_id)
+            if inventario is not None:
+                lote_ids.add(cambios.get('lote_id', inventario.lote_id))
+                if 'cantidad' in cambios:
+                    lote_ids.add(inventario.lote_id)
+        lote_ids.discard(None)
+        lotes = {l.id: l for l in Lote.query.filter(Lote.id.in_(lote_ids))
+                 .order_by(Lote.id).with_for_update().populate_existing()} if lote_ids else {}
+
+        # Claves (presentacion, almacen, lote) ya ocupadas, para los cambios de lote
+        cambios_lote = [
+            (inventarios[p[1]].presentacion_id, inventarios[p[1]].almacen_id) for p in pendientes
+            if p[1] in inventarios and p[2].get('lote_id', inventarios[p[1]].lote_id) != inventarios[p[1]].lote_id
+        ]
+        ocupadas = {}
+        if cambios_lote:
+            ocupadas = {
+                (inv.presentacion_id, inv.almacen_id, inv.lote_id): inv.id
+                for inv in db.session.query(
+                    Inventario.id, Inventario.presentacion_id, Inventario.almacen_id, Inventario.lote_id
+                ).filter(tuple_(Inventario.presentacion_id, Inventario.almacen_id).in_(set(cambios_lote)))
+            }
+
+        # --- 3. Validar y aplicar en memoria, en orden de envío ---
+        movimientos, actualizados = [], []
+        ahora = datetime.now(timezone.utc)
+        for i, inventario_id, cambios, item_data in pendientes:
+            inventario = inventarios.get(inventario_id)
+            if inventario is None:
+                rechazar(i, f"Inventario con ID {inventario_id} no encontrado")
+                continue
+
+            # Verificar permisos y campos inmutables
+            if claims.get('rol') != 'admin' and inventario.almacen_id != claims.get('almacen_id'):
+                rechazar(i, f"No tiene permisos para modificar inventario ID {inventario_id}")
+                continue
+            error = None
+            for field in ("presentacion_id", "almacen_id"):
+                if field in item_data:
+                    try:
+                        if int(item_data[field]) != getattr(inventario, field):
+                            error = f"Campo inmutable '{field}' no puede modificarse"
+                    except (ValueError, TypeError):
+                        error = f"Valor inválido para '{field}'"
+            if error:
+                rechazar(i, error)
+                continue
+
+            lote_actual_id = inventario.lote_id
+            lote_nuevo_id = cambios.get('lote_id', lote_actual_id)
+            if lote_nuevo_id is not None and lote_nuevo_id not in lotes:
+                rechazar(i, "ID de lote inválido")
+                continue
+            clave_nueva = (inventario.presentacion_id, inventario.almacen_id, lote_nuevo_id)
+            if lote_nuevo_id != lote_actual_id and ocupadas.get(clave_nueva, inventario.id) != inventario.id:
+                rechazar(i, f"Ya existe un registro de inventario para esta presentación en este almacén con el lote ID {lote_nuevo_id}")
+                continue
+
+            # Si hay cambio en la cantidad, preparar movimiento y descuento del lote
+            diferencia = cambios['cantidad'] - inventario.cantidad if 'cantidad' in cambios else Decimal('0')
+            movimiento = None
+            if diferencia != 0:
+                tipo_movimiento = 'entrada' if diferencia > 0 else 'salida'
+                lote_id_para_movimiento = lote_nuevo_id if (tipo_movimiento == 'entrada' and lote_nuevo_id != lote_actual_id) else lote_actual_id
+                movimiento = {
+                    'tipo': tipo_movimiento,
+                    'presentacion_id': inventario.presentacion_id,
+                    'lote_id': lote_id_para_movimiento,
+                    'cantidad': abs(diferencia),
+                    'usuario_id': claims.get('sub'),
+                    'motivo': item_data.get('motivo', "Ajuste manual de inventario"),
+                    'fecha': ahora,
+                }
+
+                # ENTRADA: el embolsado se descuenta del lote
+                lote = lotes.get(lote_id_para_movimiento) if tipo_movimiento == 'entrada' else None
+                if lote is not None and lote.cantidad_disponible_kg is not None and inventario.presentacion.capacidad_kg:
+                    kg_a_restar = Decimal(str(inventario.presentacion.capacidad_kg)) * abs(diferencia)
+                    if lote.cantidad_disponible_kg < kg_a_restar:
+                        rechazar(i, "Stock insuficiente en el lote",
+                                 disponible_kg=str(lote.cantidad_disponible_kg), requerido_kg=str(kg_a_restar))
+                        continue
+                    lote.cantidad_disponible_kg -= kg_a_restar
+
+            # Aplicar cambios sobre la instancia bloqueada
+            if movimiento:
+                movimientos.append(movimiento)
+                inventario.cantidad = cambios['cantidad']
+                inventario.ultima_actualizacion = ahora
+            if 'stock_minimo' in cambios:
+                inventario.stock_minimo = cambios['stock_minimo']
+            if lote_nuevo_id != lote_actual_id:
+                ocupadas.pop((inventario.presentacion_id, inventario.almacen_id, lote_actual_id), None)
+                ocupadas[clave_nueva] = inventario.id
+                inventario.lote = lotes[lote_nuevo_id] if lote_nuevo_id is not None else None
+            actualizados.append((i, inventario))
+
+        # --- 4. Un flush de las filas y un INSERT de movimientos ---
+        if movimientos:
+            db.session.execute(insert(Movimiento), movimientos)
+        db.session.flush()
+        for i, inventario in actualizados:
+            resultados[i].update(estado='actualizado', inventario=inventario_schema.dump(inventario))
+        db.session.commit()
+
+        resumen = {estado: sum(1 for r in resultados if r['estado'] == estado)
+                   for estado in ('actualizado', 'error')}
+        logger.info(f"Inventarios actualizados en batch: {resumen}")
+        return {"resultados": resultados, **resumen}, 200
 
     def _validate_and_update_inventario(self, inventario, raw_data, claims):
         """Valida y actualiza un inventario. Retorna (inventario, error_response)"""
@@ -516,6 +663,8 @@ class InventarioResource(Resource):
             return updated_inventario, None
             
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             logger.error(f"Error en validación y actualización: {str(e)}")
             return None, ({"error": "Error interno en validación", "inventario_id": inventario.id}, 500)
 
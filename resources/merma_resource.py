@@ -4,7 +4,7 @@ from flask import request
 from models import Merma, Lote, Inventario, PresentacionProducto
 from schemas import merma_schema, mermas_schema, lote_schema
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, rol_requerido
+from common import handle_db_errors, retry_on_deadlock, is_retryable_db_error, MAX_ITEMS_PER_PAGE, rol_requerido
 from decimal import Decimal
 
 class MermaResource(Resource):
@@ -43,9 +43,11 @@ class MermaResource(Resource):
     @jwt_required()
     @rol_requerido('admin', 'gerente')
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         data = merma_schema.load(request.get_json())
-        lote = Lote.query.get_or_404(data.lote_id)
+        # FOR UPDATE: dos mermas simultáneas sobre el mismo lote no pueden validar el mismo stock
+        lote = Lote.query.filter_by(id=data.lote_id).with_for_update().first_or_404()
         
         # Validar cantidad
         if Decimal(data.cantidad_kg) > lote.cantidad_disponible_kg:
@@ -71,6 +73,8 @@ class MermaResource(Resource):
             return merma_schema.dump(nueva_merma), 201
         
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             return {"error": str(e)}, 500
        
@@ -78,10 +82,11 @@ class MermaResource(Resource):
     @jwt_required()
     @rol_requerido('admin', 'gerente')
     @handle_db_errors
+    @retry_on_deadlock
     def put(self, merma_id):
         merma = Merma.query.get_or_404(merma_id)
         data = merma_schema.load(request.get_json(), partial=True)
-        lote = merma.lote
+        lote = db.session.get(Lote, merma.lote_id, with_for_update=True)
         
         if data.cantidad_kg:
             nueva_cantidad = Decimal(data.cantidad_kg)
@@ -107,9 +112,10 @@ class MermaResource(Resource):
     @jwt_required()
     @rol_requerido('admin', 'gerente')
     @handle_db_errors
+    @retry_on_deadlock
     def delete(self, merma_id):
         merma = Merma.query.get_or_404(merma_id)
-        lote = merma.lote
+        lote = db.session.get(Lote, merma.lote_id, with_for_update=True)
         try:
             # Revertir cantidad en lote
             lote.cantidad_disponible_kg += merma.cantidad_kg
@@ -118,5 +124,7 @@ class MermaResource(Resource):
             db.session.commit()
             return "Eliminado correctamente", 200        
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             return {"error": str(e)}, 500
\ No newline at end of file
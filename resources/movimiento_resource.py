@@ -5,8 +5,10 @@ from flask import request
 from models import Movimiento, Inventario, PresentacionProducto, Lote, Almacen
 from schemas import movimiento_schema, movimientos_schema
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE
-from datetime import datetime
+from common import handle_db_errors, retry_on_deadlock, MAX_ITEMS_PER_PAGE, paginate_query, create_pagination_response
+from services.stock_service import CambioStock, StockInsuficienteError, aplicar_cambios_stock
+from services.historico import con_historico, historico_alcanzado
+from datetime import datetime, timedelta
 import logging # Importar el módulo estándar
 
 # Configurar logging para este módulo
@@ -24,56 +26,56 @@ class MovimientoResource(Resource):
         if movimiento_id:
             return movimiento_schema.dump(Movimiento.query.get_or_404(movimiento_id)), 200
         
-        # Construir query con filtros
-        query = Movimiento.query
-        if tipo := request.args.get('tipo'):
-            query = query.filter_by(tipo=tipo)
-        if lote_id := request.args.get('lote_id'):
-            try:
-                query = query.filter_by(lote_id=int(lote_id))
-            except ValueError:
-                return {"error": "ID de lote inválido"}, 400
-        if presentacion_id := request.args.get('presentacion_id'):
-            try:
-                query = query.filter_by(presentacion_id=int(presentacion_id))
-            except ValueError:
-                return {"error": "ID de presentación inválido"}, 400
         # Filtro por rango de fechas
         fecha_inicio = request.args.get('fecha_inicio')
         fecha_fin = request.args.get('fecha_fin')
+        fecha_inicio_dt = fecha_fin_dt = None
         if fecha_inicio:
             try:
                 fecha_inicio_dt = datetime.strptime(fecha_inicio, "%Y-%m-%d")
-                query = query.filter(Movimiento.fecha >= fecha_inicio_dt)
             except ValueError:
                 return {"error": "Formato de fecha_inicio inválido. Use YYYY-MM-DD."}, 400
         if fecha_fin:
             try:
-                fecha_fin_dt = datetime.strptime(fecha_fin, "%Y-%m-%d")
                 # Para incluir todo el día, sumamos un día y filtramos menor a esa fecha
-                from datetime import timedelta
-                fecha_fin_dt = fecha_fin_dt + timedelta(days=1)
-                query = query.filter(Movimiento.fecha < fecha_fin_dt)
+                fecha_fin_dt = datetime.strptime(fecha_fin, "%Y-%m-%d") + timedelta(days=1)
             except ValueError:
                 return {"error": "Formato de fecha_fin inválido. Use YYYY-MM-DD."}, 400
 
-        # Paginación
+        # Con un rango que llega a ventas archivadas se incluyen sus movimientos del histórico
+        historico = bool(fecha_inicio or fecha_fin) and historico_alcanzado(Movimiento.fecha, fecha_inicio_dt)
+        M = con_historico(Movimiento, historico)
+
+        # Construir query con filtros
+        query = db.session.query(M)
+        if tipo := request.args.get('tipo'):
+            query = query.filter_by(tipo=tipo)
+        if lote_id := request.args.get('lote_id'):
+            try:
+                query = query.filter_by(lote_id=int(lote_id))
+            except ValueError:
+                return {"error": "ID de lote inválido"}, 400
+        if presentacion_id := request.args.get('presentacion_id'):
+            try:
+                query = query.filter_by(presentacion_id=int(presentacion_id))
+            except ValueError:
+                return {"error": "ID de presentación inválido"}, 400
+        if fecha_inicio_dt:
+            query = query.filter(M.fecha >= fecha_inicio_dt)
+        if fecha_fin_dt:
+            query = query.filter(M.fecha < fecha_fin_dt)
+
+        # Orden estable para OFFSET (idx_movimiento_fecha); con ?cursor= se usa keyset por fecha descendente + id
+        query = query.order_by(M.fecha.desc(), M.id.desc())
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 10, type=int), MAX_ITEMS_PER_PAGE)
-        movimientos = query.paginate(page=page, per_page=per_page, error_out=False)
+        movimientos = paginate_query(query, [(M.fecha, True)], M.id, page, per_page)
         
-        return {
-            "data": movimientos_schema.dump(movimientos.items),
-            "pagination": {
-                "total": movimientos.total,
-                "page": movimientos.page,
-                "per_page": movimientos.per_page,
-                "pages": movimientos.pages
-            }
-        }, 200
+        return create_pagination_response(movimientos_schema.dump(movimientos.items), movimientos), 200
 
     @jwt_required()
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         """Registra movimiento y actualiza inventario correspondiente"""
         data = movimiento_schema.load(request.get_json())
@@ -99,35 +101,39 @@ class MovimientoResource(Resource):
             # , almacen_id=obtenido_almacen_id 
         ).first()
         
-        # Validar stock para movimientos de salida
-        if data.tipo == 'salida' and (not inventario or inventario.cantidad < data.cantidad):
-            stock_disp = inventario.cantidad if inventario else 0
-            return {"error": "Stock insuficiente para este movimiento", "disponible": stock_disp}, 400
+        # Validar que exista inventario para movimientos de salida (la cantidad la valida el UPDATE condicional)
+        if data.tipo == 'salida' and not inventario:
+            return {"error": "Stock insuficiente para este movimiento", "disponible": 0}, 400
         
         # Asignar usuario actual
         data.usuario_id = get_jwt().get('sub')
         nuevo_movimiento = Movimiento(**data.to_dict()) # Asumiendo que data es un objeto con .to_dict() o similar tras load
         db.session.add(nuevo_movimiento)
         
-        # Actualizar inventario
+        # Actualizar inventario (el movimiento ya se registró arriba)
         if inventario: # Solo actualizar si el inventario existe
-            if data.tipo == 'entrada':
-                inventario.cantidad += data.cantidad
-            else: # tipo == 'salida'
-                inventario.cantidad -= data.cantidad
+            delta = data.cantidad if data.tipo == 'entrada' else -data.cantidad
+            try:
+                aplicar_cambios_stock(
+                    [CambioStock(inventario.almacen_id, inventario.presentacion_id, inventario.lote_id, delta)],
+                    registrar_movimientos=False
+                )
+            except StockInsuficienteError as e:
+                db.session.rollback()
+                return {"error": "Stock insuficiente para este movimiento", "disponible": e.faltantes[0]['disponible']}, 400
         else:
             # Si es una entrada y no hay inventario, ¿debería crearse? 
             # La lógica actual requiere que el inventario exista para salidas
             # y no hace nada con él para entradas si no existe.
-            if data.tipo == 'entrada':
-                 logger.warning(f"Movimiento de entrada para inventario inexistente: Presentación {data.presentacion_id}")
-                 # Considerar crear inventario aquí si es la lógica deseada
+            logger.warning(f"Movimiento de entrada para inventario inexistente: Presentación {data.presentacion_id}")
+            # Considerar crear inventario aquí si es la lógica deseada
         
         db.session.commit()
         return movimiento_schema.dump(nuevo_movimiento), 201
 
     @jwt_required()
     @handle_db_errors
+    @retry_on_deadlock
     def delete(self, movimiento_id):
         """Elimina movimiento y revierte el inventario"""
         movimiento = Movimiento.query.get_or_404(movimiento_id)
@@ -147,15 +153,16 @@ class MovimientoResource(Resource):
         
         # Revertir movimiento
         if inventario: # Solo revertir si el inventario existe
-            if movimiento.tipo == 'entrada':
+            delta = movimiento.cantidad if movimiento.tipo == 'salida' else -movimiento.cantidad
+            try:
+                aplicar_cambios_stock(
+                    [CambioStock(inventario.almacen_id, inventario.presentacion_id, inventario.lote_id, delta)],
+                    registrar_movimientos=False
+                )
+            except StockInsuficienteError:
                 # Asegurarse de no dejar stock negativo al revertir entrada
-                if inventario.cantidad >= movimiento.cantidad:
-                    inventario.cantidad -= movimiento.cantidad
-                else:
-                    logger.warning(f"Reversión de entrada resultaría en stock negativo. Estableciendo a 0. Movimiento ID: {movimiento_id}")
-                    inventario.cantidad = 0 
-            else: # tipo == 'salida'
-                inventario.cantidad += movimiento.cantidad
+                logger.warning(f"Reversión de entrada resultaría en stock negativo. Estableciendo a 0. Movimiento ID: {movimiento_id}")
+                inventario.cantidad = 0
         else:
             logger.warning(f"Inventario no encontrado al intentar revertir movimiento {movimiento_id}")
         
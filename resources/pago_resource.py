@@ -13,11 +13,19 @@ from sqlalchemy import asc, desc, func, case
 from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 
-from common import MAX_ITEMS_PER_PAGE, handle_db_errors, parse_iso_datetime
+from common import MAX_ITEMS_PER_PAGE, handle_db_errors, parse_iso_datetime, paginate_query, create_pagination_response
 from extensions import db
 from models import Almacen, Cliente, Pago, Users, Venta, Gasto
-from schemas import pago_schema, pagos_schema, gastos_schema
-from utils.file_handlers import delete_file, get_presigned_url, save_file
+from schemas import pago_schema, pagos_schema, gastos_schema, loader_options, PAGO_LOADERS
+from utils.file_handlers import presign_payload
+from services.s3_delete_queue import queue_delete
+from utils.upload_worker import upload_status_payload, UploadQueueFullError
+from utils.streaming_upload import parse_upload_request, StreamedUpload
+from utils.export_engine import ExportSpec, export_response
+from services.export_jobs import submit_export_request
+from services.archivo_service import ArchivoService
+from services.idempotency import idempotente
+from services.historico import con_historico, historico_alcanzado
 
 # Configuración de Logging
 logger = logging.getLogger(__name__)
@@ -60,11 +68,17 @@ from sqlalchemy import asc, desc, func, case
 from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 
-from common import MAX_ITEMS_PER_PAGE, handle_db_errors, parse_iso_datetime
+from common import MAX_ITEMS_PER_PAGE, handle_db_errors, parse_iso_datetime, paginate_query, create_pagination_response
 from extensions import db
 from models import Almacen, Cliente, Pago, Users, Venta, Gasto
-from schemas import pago_schema, pagos_schema, gastos_schema
-from utils.file_handlers import delete_file, get_presigned_url, save_file
+from schemas import pago_schema, pagos_schema, gastos_schema, loader_options, PAGO_LOADERS
+from utils.file_handlers import presign_payload
+from services.s3_delete_queue import queue_delete
+from utils.upload_worker import upload_status_payload, UploadQueueFullError
+from utils.streaming_upload import parse_upload_request, StreamedUpload
+from utils.export_engine import ExportSpec, export_response
+from services.export_jobs import submit_export_request
+from services.archivo_service import ArchivoService
 
 # Configuración de Logging
 logger = logging.getLogger(__name__)
@@ -84,11 +98,17 @@ from sqlalchemy import asc, desc, func, case
 from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 
-from common import MAX_ITEMS_PER_PAGE, handle_db_errors, parse_iso_datetime
+from common import MAX_ITEMS_PER_PAGE, handle_db_errors, parse_iso_datetime, paginate_query, create_pagination_response
 from extensions import db
 from models import Almacen, Cliente, Pago, Users, Venta, Gasto
-from schemas import pago_schema, pagos_schema, gastos_schema
-from utils.file_handlers import delete_file, get_presigned_url, save_file
+from schemas import pago_schema, pagos_schema, gastos_schema, loader_options, PAGO_LOADERS
+from utils.file_handlers import presign_payload
+from services.s3_delete_queue import queue_delete
+from utils.upload_worker import upload_status_payload, UploadQueueFullError
+from utils.streaming_upload import parse_upload_request, StreamedUpload
+from utils.export_engine import ExportSpec, export_response
+from services.export_jobs import submit_export_request
+from services.archivo_service import ArchivoService
 
 # Configuración de Logging
 logger = logging.getLogger(__name__)
@@ -123,35 +143,42 @@ class PagoService:
             )
 
     @staticmethod
-    def get_pagos_query(filters, current_user_id=None, rol=None):
-        """Construye una consulta de pagos optimizada con filtros y carga ansiosa (eager loading)."""
-        query = Pago.query.options(
-            joinedload(Pago.venta).joinedload(Venta.cliente),
-            joinedload(Pago.venta).joinedload(Venta.almacen),
-            joinedload(Pago.usuario)
-        )
+    def get_pagos_query(filters, current_user_id=None, rol=None, profile='lista'):
+        """
+        Construye una consulta de pagos con filtros y carga ansiosa (eager loading)
+        según el perfil de PAGO_LOADERS ('lista' o 'exportar').
+        Devuelve (query, entidad): la entidad es Pago o, si el filtro de fechas
+        llega a pagos archivados, un alias que incluye el histórico.
+        """
+        fecha_inicio = filters.get('fecha_inicio')
+        fecha_fin = filters.get('fecha_fin')
+        historico = bool(fecha_inicio or fecha_fin) and historico_alcanzado(Pago.fecha, fecha_inicio)
+        P = con_historico(Pago, historico)
+        V = con_historico(Venta, historico)
+
+        query = db.session.query(P).options(*loader_options(PAGO_LOADERS, profile, P, V))
         if venta_id := filters.get('venta_id'):
-            query = query.filter(Pago.venta_id == venta_id)
+            query = query.filter(P.venta_id == venta_id)
         if metodo := filters.get('metodo_pago'):
-            query = query.filter(Pago.metodo_pago == metodo)
+            query = query.filter(P.metodo_pago == metodo)
         if usuario_id := filters.get('usuario_id'):
-            query = query.filter(Pago.usuario_id == usuario_id)
+            query = query.filter(P.usuario_id == usuario_id)
         if almacen_id := filters.get('almacen_id'):
-            query = query.join(Venta).filter(Venta.almacen_id == almacen_id)
+            query = query.join(V, P.venta_id == V.id).filter(V.almacen_id == almacen_id)
         if (depositado_str := filters.get('depositado')) is not None:
             is_depositado = depositado_str.lower() == 'true'
-            query = query.filter(Pago.depositado == is_depositado)
-        if fecha_inicio := filters.get('fecha_inicio'):
-             query = query.filter(Pago.fecha >= fecha_inicio)
-        if fecha_fin := filters.get('fecha_fin'):
-             query = query.filter(Pago.fecha <= fecha_fin)
+            query = query.filter(P.depositado == is_depositado)
+        if fecha_inicio:
+             query = query.filter(P.fecha >= fecha_inicio)
+        if fecha_fin:
+             query = query.filter(P.fecha <= fecha_fin)
         
         # --- FILTRO POR ROL ---
         if rol and rol != 'admin' and current_user_id:
-            query = query.filter(Pago.usuario_id == current_user_id)
+            query = query.filter(P.usuario_id == current_user_id)
         # ----------------------
         
-        return query
+        return query, P
 
     @staticmethod
     def create_pago(data, file, usuario_id):
@@ -167,7 +194,8 @@ class PagoService:
         
         s3_key = None
         if file and file.filename:
-            s3_key = save_file(file, "comprobantes")
+            # Un comprobante idéntico ya subido reutiliza su clave S3
+            s3_key, _ = ArchivoService.store(file, "comprobantes")
             if not s3_key:
                 raise Exception("Ocurrió un error interno al guardar el comprobante.")
         
@@ -192,14 +220,14 @@ class PagoService:
             setattr(pago, key, value)
             
         if eliminar_comprobante and pago.url_comprobante:
-            delete_file(pago.url_comprobante)
+            ArchivoService.release(pago.url_comprobante, exclude_pago_id=pago.id)
             pago.url_comprobante = None
         elif file and file.filename:
-            if pago.url_comprobante:
-                delete_file(pago.url_comprobante)
-            s3_key = save_file(file, "comprobantes")
+            s3_key, _ = ArchivoService.store(file, "comprobantes")
             if not s3_key:
                 raise Exception("Error al subir el nuevo comprobante.")
+            if pago.url_comprobante:
+                ArchivoService.release(pago.url_comprobante, exclude_pago_id=pago.id)
             pago.url_comprobante = s3_key
             
         venta.actualizar_estado()
@@ -212,16 +240,9 @@ class PagoService:
         venta = pago.venta
         
         if pago.url_comprobante:
-            # --- LÓGICA DE SEGURIDAD AÑADIDA ---
-            # Contar cuántos otros pagos usan el mismo comprobante.
-            otros_pagos_con_mismo_comprobante = db.session.query(Pago.id).filter(
-                Pago.url_comprobante == pago.url_comprobante,
-                Pago.id != pago.id
-            ).count()
-
-            # Solo borrar el archivo si ningún otro pago lo está usando.
-            if otros_pagos_con_mismo_comprobante == 0:
-                delete_file(pago.url_comprobante)
+            # Solo se borra el archivo cuando ningún otro pago lo referencia
+            # (contador en archivos_contenido, búsqueda por índice único)
+            ArchivoService.release(pago.url_comprobante, exclude_pago_id=pago.id)
         
         db.session.delete(pago)
         venta.actualizar_estado()
@@ -230,9 +251,11 @@ class PagoService:
     def create_batch_pagos(pagos_json_str, file, fecha_str, metodo_pago, referencia, claims):
         """Crea múltiples pagos en lote. Operación transaccional."""
         s3_key_comprobante = None
+        comprobante_creado = False
         try:
             if file and file.filename:
-                s3_key_comprobante = save_file(file, 'comprobantes')
+                # Se registra sin referencias; se suman al crear los pagos
+                s3_key_comprobante, comprobante_creado = ArchivoService.store(file, 'comprobantes', refs=0)
                 if not s3_key_comprobante:
                     raise Exception("Error al subir el comprobante a S3.")
 
@@ -294,6 +317,7 @@ class PagoService:
                 db.session.add(nuevo_pago)
                 pagos_creados.append(nuevo_pago)
             
+            ArchivoService.retain(s3_key_comprobante, refs=len(pagos_creados))
             db.session.flush()
             # Actualizar el estado de todas las ventas afectadas al final
             for venta in ventas_map.values():
@@ -301,26 +325,32 @@ class PagoService:
 
             return pagos_creados
         except Exception:
-            if s3_key_comprobante:
-                delete_file(s3_key_comprobante)
+            # Solo borrar si el objeto se subió en esta petición (no si se reutilizó uno existente)
+            if s3_key_comprobante and comprobante_creado:
+                queue_delete(s3_key_comprobante, independent=True)
             raise
 
 # --- FUNCIONES AUXILIARES ---
 def _parse_request_data():
     """Unifica la obtención de datos de JSON y multipart/form-data."""
     if 'multipart/form-data' in request.content_type:
-        data = request.form.to_dict()
-        file = request.files.get('comprobante')
+        # Los PDFs grandes se suben a S3 en streaming mientras se parsea el cuerpo
+        data, file = parse_upload_request('comprobante', 'comprobantes')
         eliminar_comprobante = data.get('eliminar_comprobante', 'false').lower() == 'true'
         return data, file, eliminar_comprobante
     elif 'application/json' in request.content_type:
         return request.get_json(), None, False
     raise BadRequest("Tipo de contenido no soportado.")
 
+def _discard_streamed_upload(file):
+    """Elimina de S3 un comprobante ya subido en streaming si la operación falla."""
+    if isinstance(file, StreamedUpload):
+        queue_delete(file.s3_key, independent=True)
+
 def _get_presigned_url_for_item(item_dump, s3_key):
     """Genera y asigna una URL pre-firmada a un objeto serializado."""
     if s3_key:
-        item_dump['url_comprobante'] = get_presigned_url(s3_key)
+        presign_payload(item_dump, fields=('url_comprobante',))
     return item_dump
 
 # --- RESOURCES DE LA API ---
@@ -335,37 +365,32 @@ class PagoResource(Resource):
             return _get_presigned_url_for_item(pago_dump, pago.url_comprobante), 200
         
         claims = get_jwt()
-        query = PagoService.get_pagos_query(request.args, claims.get('sub'), claims.get('rol'))
+        query, P = PagoService.get_pagos_query(request.args, claims.get('sub'), claims.get('rol'))
         
         sort_by = request.args.get('sort_by', 'fecha')
         sort_order = request.args.get('sort_order', 'desc').lower()
-        sort_column = getattr(Pago, sort_by, Pago.fecha)
+        sort_column = getattr(P, sort_by, P.fecha)
         order_func = desc if sort_order == 'desc' else asc
         query = query.order_by(order_func(sort_column))
         
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 10, type=int), MAX_ITEMS_PER_PAGE)
-        pagos_paginados = query.paginate(page=page, per_page=per_page, error_out=False)
+        pagos_paginados = paginate_query(
+            query, [(sort_column, sort_order == 'desc')], P.id, page, per_page
+        )
         pagos_dump = pagos_schema.dump(pagos_paginados.items)
         
-        # MEJORA: Usar zip para una iteración más segura y pitónica.
-        for pago_obj, dump_item in zip(pagos_paginados.items, pagos_dump):
-             _get_presigned_url_for_item(dump_item, pago_obj.url_comprobante)
+        # Firmar todos los comprobantes de la página en lote (varios pagos suelen compartir comprobante)
+        presign_payload(pagos_dump, fields=('url_comprobante',))
 
-        return {
-            "data": pagos_dump, 
-            "pagination": {
-                "total": pagos_paginados.total, 
-                "page": pagos_paginados.page, 
-                "per_page": pagos_paginados.per_page, 
-                "pages": pagos_paginados.pages,
-            }
-        }, 200
+        return create_pagination_response(pagos_dump, pagos_paginados), 200
 
     @jwt_required()
+    @idempotente
     @handle_db_errors
     def post(self):
         """Registra un nuevo pago."""
+        file = None
         try:
             raw_data, file, _ = _parse_request_data()
             if raw_data.get('metodo_pago'):
@@ -378,12 +403,18 @@ class PagoResource(Resource):
             db.session.commit()
             
             pago_dump = pago_schema.dump(nuevo_pago)
+            pago_dump['procesamiento_comprobante'] = upload_status_payload(nuevo_pago.url_comprobante)
             return _get_presigned_url_for_item(pago_dump, nuevo_pago.url_comprobante), 201
         except PagoValidationError as e:
             db.session.rollback()
+            _discard_streamed_upload(file)
             return {"error": str(e)}, 400
+        except UploadQueueFullError as e:
+            db.session.rollback()
+            return {"error": str(e)}, 503
         except Exception as e:
             db.session.rollback()
+            _discard_streamed_upload(file)
             logger.error(f"Error al crear pago: {e}")
             return {"error": "Error interno al procesar el pago."}, 500
 
@@ -391,6 +422,7 @@ class PagoResource(Resource):
     @handle_db_errors
     def put(self, pago_id):
         """Actualiza un pago existente."""
+        file = None
         try:
             raw_data, file, eliminar_comprobante = _parse_request_data()
             data = pago_schema.load(raw_data, partial=True)
@@ -399,12 +431,19 @@ class PagoResource(Resource):
             db.session.commit()
             
             pago_dump = pago_schema.dump(pago_actualizado)
+            if file and file.filename:
+                pago_dump['procesamiento_comprobante'] = upload_status_payload(pago_actualizado.url_comprobante)
             return _get_presigned_url_for_item(pago_dump, pago_actualizado.url_comprobante), 200
         except PagoValidationError as e:
             db.session.rollback()
+            _discard_streamed_upload(file)
             return {"error": str(e)}, 400
+        except UploadQueueFullError as e:
+            db.session.rollback()
+            return {"error": str(e)}, 503
         except Exception as e:
             db.session.rollback()
+            _discard_streamed_upload(file)
             logger.error(f"Error al actualizar pago {pago_id}: {e}")
             return {"error": "Error interno al actualizar el pago."}, 500
 
@@ -425,27 +464,28 @@ class PagosPorVentaResource(Resource):
         Venta.query.get_or_404(venta_id)
         pagos = Pago.query.filter_by(venta_id=venta_id).order_by(Pago.fecha.asc()).all()
         pagos_dump = pagos_schema.dump(pagos)
-        for i, pago in enumerate(pagos):
-            _get_presigned_url_for_item(pagos_dump[i], pago.url_comprobante)
+        presign_payload(pagos_dump, fields=('url_comprobante',))
         return pagos_dump, 200
 
 class PagoBatchResource(Resource):
     @jwt_required()
+    @idempotente
     @handle_db_errors
     def post(self):
         """Registra múltiples pagos para un solo comprobante (pago en lote)."""
         if 'multipart/form-data' not in request.content_type:
             return {"error": "Se requiere contenido multipart/form-data"}, 415
         try:
-            pagos_json_str = request.form.get('pagos_json_data')
-            fecha_str = request.form.get('fecha')
-            metodo_pago = request.form.get('metodo_pago')
+            form, file = parse_upload_request('comprobante', 'comprobantes')
+            pagos_json_str = form.get('pagos_json_data')
+            fecha_str = form.get('fecha')
+            metodo_pago = form.get('metodo_pago')
             if metodo_pago:
                 metodo_pago = metodo_pago.lower()
-            referencia = request.form.get('referencia')
-            file = request.files.get('comprobante')
+            referencia = form.get('referencia')
 
             if not all([pagos_json_str, fecha_str, metodo_pago]):
+                _discard_streamed_upload(file)
                 return {"error": "Faltan campos (pagos_json_data, fecha, metodo_pago)"}, 400
             
             claims = get_jwt()
@@ -454,9 +494,14 @@ class PagoBatchResource(Resource):
             )
             db.session.commit()  # Cambio de flush() a commit() para guardar en BD
             created_pagos_dump = pagos_schema.dump(pagos_creados)
-            for i, pago in enumerate(pagos_creados):
-                _get_presigned_url_for_item(created_pagos_dump[i], pago.url_comprobante)
-            return {"message": "Pagos en lote registrados exitosamente.", "pagos_creados": created_pagos_dump}, 201
+            presign_payload(created_pagos_dump, fields=('url_comprobante',))
+            return {
+                "message": "Pagos en lote registrados exitosamente.",
+                "pagos_creados": created_pagos_dump,
+                "procesamiento_comprobante": upload_status_payload(pagos_creados[0].url_comprobante) if pagos_creados else None
+            }, 201
+        except UploadQueueFullError as e:
+            return {"error": str(e)}, 503
         except (PagoValidationError, NotFound, BadRequest) as e:
             return {"error": str(e)}, 400
         except Forbidden as e:
@@ -472,15 +517,17 @@ class DepositoBancarioResource(Resource):
         """Registra un depósito bancario para uno o múltiples pagos y asocia un comprobante común."""
         comprobante_file = None
         if 'multipart/form-data' in request.content_type:
-            depositos_json_str = request.form.get('depositos')
-            fecha_deposito_str = request.form.get('fecha_deposito')
-            comprobante_file = request.files.get('comprobante_deposito') # Nombre más específico
+            form, comprobante_file = parse_upload_request('comprobante_deposito', 'comprobantes_depositos') # Nombre más específico
+            depositos_json_str = form.get('depositos')
+            fecha_deposito_str = form.get('fecha_deposito')
             
             if not depositos_json_str:
+                _discard_streamed_upload(comprobante_file)
                 return {"error": "Campo 'depositos' (JSON string) es requerido"}, 400
             try:
                 depositos = json.loads(depositos_json_str)
             except json.JSONDecodeError:
+                _discard_streamed_upload(comprobante_file)
                 return {"error": "Formato JSON inválido en 'depositos'"}, 400
         else:
             data = request.get_json()
@@ -489,29 +536,45 @@ class DepositoBancarioResource(Resource):
             fecha_deposito_str = data.get('fecha_deposito')
 
         if not depositos or not fecha_deposito_str:
+            _discard_streamed_upload(comprobante_file)
             return {"error": "Campos requeridos: 'depositos' (lista) y 'fecha_deposito'"}, 400
         
         try:
             fecha_deposito = parse_iso_datetime(fecha_deposito_str, add_timezone=True)
         except ValueError:
+            _discard_streamed_upload(comprobante_file)
             return {"error": "Formato de fecha inválido"}, 400
 
         s3_key_comprobante = None
+        comprobante_creado = False
         if comprobante_file and comprobante_file.filename:
-            s3_key_comprobante = save_file(comprobante_file, 'comprobantes_depositos')
+            try:
+                # Un comprobante idéntico ya subido reutiliza su clave; las referencias se suman abajo
+                s3_key_comprobante, comprobante_creado = ArchivoService.store(
+                    comprobante_file, 'comprobantes_depositos', refs=0
+                )
+            except UploadQueueFullError as e:
+                return {"error": str(e)}, 503
             if not s3_key_comprobante:
                 return {"error": "Error interno al guardar el comprobante"}, 500
 
+        def _descartar_comprobante():
+            db.session.rollback()
+            if s3_key_comprobante and comprobante_creado:
+                queue_delete(s3_key_comprobante, independent=True)
+
         pago_ids = [d.get('pago_id') for d in depositos]
         pagos = Pago.query.filter(Pago.id.in_(pago_ids)).all()
         pagos_map = {p.id: p for p in pagos}
 
         if len(pagos) != len(set(pago_ids)):
-            if s3_key_comprobante: delete_file(s3_key_comprobante)
+            _descartar_comprobante()
             return {"error": "Algunos pagos no fueron encontrados"}, 404
 
         pagos_actualizados = []
         monto_total_depositado = Decimal('0')
+        # Comprobantes reemplazados: se liberan cuando el depósito ya está confirmado
+        comprobantes_reemplazados = []
 
         for deposito_data in depositos:
             pago_id = deposito_data['pago_id']
@@ -520,7 +583,7 @@ class DepositoBancarioResource(Resource):
             
             monto_disponible = pago.monto - (pago.monto_depositado or Decimal('0'))
             if monto_a_depositar > monto_disponible + Decimal('0.001'):
-                if s3_key_comprobante: delete_file(s3_key_comprobante)
+                _descartar_comprobante()
                 return {"error": f"Monto para pago {pago.id} excede el disponible {monto_disponible}"}, 400
 
             if monto_a_depositar > 0:
@@ -529,51 +592,64 @@ class DepositoBancarioResource(Resource):
                 pago.fecha_deposito = fecha_deposito
                 
                 # Asigna la URL del comprobante a cada pago
-                if s3_key_comprobante:
+                if s3_key_comprobante and pago.url_comprobante != s3_key_comprobante:
+                    if pago.url_comprobante:
+                        comprobantes_reemplazados.append((pago.url_comprobante, pago.id))
+                    ArchivoService.retain(s3_key_comprobante)
                     pago.url_comprobante = s3_key_comprobante
                 
                 pagos_actualizados.append(pago)
                 monto_total_depositado += monto_a_depositar
-        
+
+        if s3_key_comprobante and comprobante_creado:
+            # Ningún pago tomó el comprobante (todos los montos en 0): no dejar la fila ni el objeto
+            ArchivoService.discard_if_unused(s3_key_comprobante)
+
         db.session.commit()
 
+        if comprobantes_reemplazados:
+            for s3_key, pago_id in comprobantes_reemplazados:
+                ArchivoService.release(s3_key, exclude_pago_id=pago_id)
+            db.session.commit()
+
         return {
             "message": "Depósito registrado exitosamente.",
             "pagos_actualizados": len(pagos_actualizados),
-            "pagos": [pago_schema.dump(p) for p in pagos_actualizados]
+            "pagos": [pago_schema.dump(p) for p in pagos_actualizados],
+            "procesamiento_comprobante": upload_status_payload(s3_key_comprobante)
         }, 200
 
 
+PAGO_EXPORT_COLUMNS = [
+    ('ID', lambda p: p.id),
+    ('Fecha', lambda p: p.fecha.strftime('%Y-%m-%d') if p.fecha else ''),
+    ('Monto', lambda p: float(p.monto)),
+    ('Método de Pago', lambda p: p.metodo_pago),
+    ('Referencia', lambda p: p.referencia),
+    ('ID Venta', lambda p: p.venta.id if p.venta else 'N/A'),
+    ('Cliente', lambda p: p.venta.cliente.nombre if p.venta and p.venta.cliente else 'N/A'),
+    ('Almacén', lambda p: p.venta.almacen.nombre if p.venta and p.venta.almacen else 'N/A'),
+    ('Usuario', lambda p: p.usuario.username if p.usuario else 'N/A'),
+    ('Depositado', lambda p: 'Sí' if p.depositado else 'No'),
+    ('Monto Depositado', lambda p: float(p.monto_depositado or 0)),
+    ('Fecha Depósito', lambda p: p.fecha_deposito.strftime('%Y-%m-%d') if p.fecha_deposito else ''),
+]
+
+def build_pagos_export(args, claims):
+    """Consulta filtrada de pagos para exportar (mismos filtros que GET /pagos)."""
+    query, P = PagoService.get_pagos_query(args, claims.get('sub'), claims.get('rol'), profile='exportar')
+    return ExportSpec('pagos', 'Pagos', query, PAGO_EXPORT_COLUMNS, [(P.fecha, True)], P.id)
+
 class PagoExportResource(Resource):
     @jwt_required()
     @handle_db_errors
     def get(self):
-        """Exporta pagos a Excel de forma optimizada."""
+        """Exporta pagos a Excel (o CSV con ?formato=csv) por bloques; con ?async=true, en segundo plano."""
+        if request.args.get('async', 'false').lower() == 'true':
+            return submit_export_request('pagos', request.args.to_dict())
         try:
-            claims = get_jwt()
-            query = PagoService.get_pagos_query(request.args.to_dict(), claims.get('sub'), claims.get('rol'))
-            pagos = query.order_by(desc(Pago.fecha)).all()
-            if not pagos:
-                return {"message": "No hay pagos para exportar con los filtros seleccionados"}, 404
-
-            data_para_excel = [{
-                'ID': p.id, 'Fecha': p.fecha.strftime('%Y-%m-%d') if p.fecha else '',
-                'Monto': float(p.monto), 'Método de Pago': p.metodo_pago, 'Referencia': p.referencia,
-                'ID Venta': p.venta.id if p.venta else 'N/A',
-                'Cliente': p.venta.cliente.nombre if p.venta and p.venta.cliente else 'N/A',
-                'Almacén': p.venta.almacen.nombre if p.venta and p.venta.almacen else 'N/A',
-                'Usuario': p.usuario.username if p.usuario else 'N/A',
-                'Depositado': 'Sí' if p.depositado else 'No',
-                'Monto Depositado': float(p.monto_depositado or 0),
-                'Fecha Depósito': p.fecha_deposito.strftime('%Y-%m-%d') if p.fecha_deposito else ''
-            } for p in pagos]
-
-            df = pd.DataFrame(data_para_excel)
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Pagos')
-            output.seek(0)
-            return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', as_attachment=True, download_name=f'pagos_{datetime.now().strftime("%Y%m%d")}.xlsx')
+            spec = build_pagos_export(request.args.to_dict(), get_jwt())
+            return export_response(spec, "No hay pagos para exportar con los filtros seleccionados")
         except Exception as e:
             logger.error(f"Error al exportar pagos: {str(e)}")
             return {"error": "Error interno al generar el archivo Excel."}, 500
@@ -1,13 +1,14 @@
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt
 from flask import request
-from models import Pedido, PedidoDetalle, Cliente, PresentacionProducto, Almacen, Inventario, Movimiento, VentaDetalle, Venta, Users
-from schemas import pedido_schema, pedidos_schema, venta_schema, clientes_schema, almacenes_schema, presentacion_schema
+from models import Pedido, PedidoDetalle, Cliente, PresentacionProducto, Almacen, Inventario, VentaDetalle, Venta, Users
+from schemas import pedido_schema, pedidos_schema, venta_schema, clientes_schema, almacenes_schema, presentacion_schema, loader_options, PEDIDO_LOADERS
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin, parse_iso_datetime
+from common import handle_db_errors, retry_on_deadlock, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin, parse_iso_datetime, get_foto_variant, paginate_query, create_pagination_response
 from datetime import datetime, timezone
 from decimal import Decimal, InvalidOperation
-from utils.file_handlers import get_presigned_url
+from utils.file_handlers import presign_payload
+from services.stock_service import CambioStock, StockInsuficienteError, aplicar_cambios_stock
 import logging
 from sqlalchemy import asc, desc
 
@@ -28,19 +29,8 @@ class PedidoResource(Resource):
             # Serializar el pedido
             result = pedido_schema.dump(pedido)
             
-            # --- GENERAR URLs PRE-FIRMADAS PARA DETALLES ---
-            if 'detalles' in result and result['detalles']:
-                for detalle in result['detalles']:
-                    # Verificar estructura anidada
-                    if 'presentacion' in detalle and detalle['presentacion'] and 'url_foto' in detalle['presentacion']:
-                        s3_key = detalle['presentacion']['url_foto']
-                        if s3_key:
-                            # Reemplazar clave S3 con URL pre-firmada
-                            detalle['presentacion']['url_foto'] = get_presigned_url(s3_key)
-                        # else: url_foto ya es None o vacío, no hacer nada
-            # ---------------------------------------------
-            
-            return result, 200
+            # URLs pre-firmadas para las fotos de los detalles (firmadas en lote)
+            return presign_payload(result), 200
         
         # --- Lógica de Ordenación Dinámica ---
         sort_by = request.args.get('sort_by', 'fecha_creacion') # Default
@@ -59,7 +49,7 @@ class PedidoResource(Resource):
         order_func = desc if sort_order == 'desc' else asc
         # --- Fin Lógica de Ordenación ---
 
-        query = Pedido.query
+        query = Pedido.query.options(*loader_options(PEDIDO_LOADERS))
 
         # --- Aplicar Joins si es necesario para ordenar ---
         if sort_by == 'cliente_nombre':
@@ -103,17 +93,9 @@ class PedidoResource(Resource):
         # Paginación
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 10, type=int), MAX_ITEMS_PER_PAGE)
-        pedidos = query.paginate(page=page, per_page=per_page, error_out=False)
+        pedidos = paginate_query(query, [(column_to_sort, sort_order == 'desc')], Pedido.id, page, per_page)
         
-        return {
-            "data": pedidos_schema.dump(pedidos.items),
-            "pagination": {
-                "total": pedidos.total,
-                "page": pedidos.page,
-                "per_page": pedidos.per_page,
-                "pages": pedidos.pages
-            }
-        }, 200
+        return create_pagination_response(pedidos_schema.dump(pedidos.items), pedidos), 200
 
     @jwt_required()
     @mismo_almacen_o_admin
@@ -190,6 +172,7 @@ class PedidoConversionResource(Resource):
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def post(self, pedido_id):
         """
         Convierte un pedido en una venta real
@@ -277,27 +260,25 @@ class PedidoConversionResource(Resource):
         db.session.add(venta)
         db.session.flush()  # Esto asigna un ID sin hacer commit
         
-        # Actualizar inventario y crear movimientos de salida
-        for detalle in venta.detalles:
-            inventario = inventarios_dict.get(detalle.presentacion_id)
-            if not inventario:
-                return {"error": f"No se encontró inventario para presentación {detalle.presentacion_id}"}, 400
-            
-            inventario.cantidad -= detalle.cantidad
-            
-            # Registrar movimiento
-            # Usar el nombre del cliente de forma segura
-            cliente_nombre = pedido.cliente.nombre if pedido.cliente else f"Cliente {pedido.cliente_id}"
-            movimiento = Movimiento(
-                tipo='salida',
-                presentacion_id=detalle.presentacion_id,
-                lote_id=inventario.lote_id,
-                cantidad=detalle.cantidad,
+        # Descontar inventario y crear movimientos de salida en un solo UPDATE/INSERT;
+        # la comprobación previa es orientativa, la definitiva es la del UPDATE condicional
+        cliente_nombre = pedido.cliente.nombre if pedido.cliente else f"Cliente {pedido.cliente_id}"
+        try:
+            aplicar_cambios_stock(
+                [
+                    CambioStock(pedido.almacen_id, detalle.presentacion_id,
+                                inventarios_dict[detalle.presentacion_id].lote_id, -detalle.cantidad)
+                    for detalle in venta.detalles
+                ],
                 usuario_id=claims.get('sub'),
-                fecha=datetime.now(timezone.utc),
-                motivo=f"Venta ID: {venta.id} - Cliente: {cliente_nombre} (desde pedido {pedido.id})"
+                motivo=f"Venta ID: {venta.id} - Cliente: {cliente_nombre} (desde pedido {pedido.id})",
+                tipo_operacion='venta',
+                venta_id=venta.id,
+                pedido_id=pedido.id
             )
-            db.session.add(movimiento)
+        except StockInsuficienteError as e:
+            db.session.rollback()
+            return e.to_dict(), 400
         
         # Actualizar cliente si es necesario (verificar que el campo existe)
         if hasattr(venta, 'consumo_diario_kg') and venta.consumo_diario_kg:
@@ -347,12 +328,11 @@ class PedidoFormDataResource(Resource):
             presentaciones_data = []
             for p in presentaciones_activas:
                 dumped_p = presentacion_schema.dump(p)
-                # URL pre-firmada
-                if p.url_foto:
-                    dumped_p['url_foto'] = get_presigned_url(p.url_foto)
-                else:
+                if not p.url_foto:
                     dumped_p['url_foto'] = None
                 presentaciones_data.append(dumped_p)
+            # URLs pre-firmadas en lote (miniatura salvo ?foto=full)
+            presign_payload(presentaciones_data, foto_variant=get_foto_variant())
             
             # Devolver siempre las tres listas
             return {
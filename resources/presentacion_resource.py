@@ -6,8 +6,10 @@ from models import PresentacionProducto, Inventario, VentaDetalle
 from models import Almacen
 from schemas import presentacion_schema, presentaciones_schema # Asegúrate que existan y sean correctos
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, rol_requerido
-from utils.file_handlers import save_file, delete_file, get_presigned_url
+from common import handle_db_errors, MAX_ITEMS_PER_PAGE, rol_requerido, get_foto_variant
+from utils.file_handlers import presign_payload, is_image, IMAGE_VARIANTS
+from services.s3_delete_queue import queue_delete
+from utils.upload_worker import save_file_async, upload_status_payload, UploadQueueFullError
 # import os # No usado directamente aquí
 # from werkzeug.datastructures import FileStorage # No usado directamente aquí
 # from flask import current_app # No usado directamente aquí
@@ -28,8 +30,7 @@ class PresentacionResource(Resource):
             # Generar URL pre-firmada si hay clave S3
             # Asume que el campo se llama 'url_foto' y guarda la clave S3
             if presentacion.url_foto:
-                presigned_url = get_presigned_url(presentacion.url_foto)
-                result['url_foto'] = presigned_url
+                presign_payload(result, foto_variant=get_foto_variant(default='full'))
             else:
                 result['url_foto'] = None # Asegurar que el campo exista
             # --- CORRECCIÓN: Devolver diccionario directamente ---
@@ -65,12 +66,13 @@ class PresentacionResource(Resource):
              # Si 'presentaciones_schema' es Many=True, usarlo así está bien.
              # Si es igual a 'presentacion_schema', usar presentacion_schema.dump(item)
             dumped_item = presentacion_schema.dump(item) # Asumiendo detalle individual
-            if item.url_foto:
-                dumped_item['url_foto'] = get_presigned_url(item.url_foto)
-            else:
+            if not item.url_foto:
                 dumped_item['url_foto'] = None # Asegurar que el campo exista
             items_data.append(dumped_item)
 
+        # Firmar todas las fotos de la página en lote (miniatura salvo ?foto=full)
+        presign_payload(items_data, foto_variant=get_foto_variant())
+
         # --- CORRECCIÓN: Devolver diccionario directamente ---
         return {
             "data": items_data,
@@ -179,12 +181,18 @@ class PresentacionResource(Resource):
 
             # Procesar imagen si existe
             s3_key_foto = None
+            foto_variantes = False
             if 'foto' in request.files:
                 file = request.files['foto']
                 if file.filename != '':
-                     s3_key_foto = save_file(file, 'presentaciones') # save_file devuelve la clave
+                     try:
+                         # La clave S3 se decide ya; la transcodificación y subida siguen en segundo plano
+                         s3_key_foto = save_file_async(file, 'presentaciones', variants=IMAGE_VARIANTS)
+                     except UploadQueueFullError as e:
+                         return {"error": str(e)}, 503
                      if not s3_key_foto:
                          return {"error": "Error al subir la foto"}, 500
+                     foto_variantes = is_image(file.content_type)
 
             # Crear presentación
             nueva_presentacion = PresentacionProducto(
@@ -194,7 +202,8 @@ class PresentacionResource(Resource):
                 tipo=tipo,
                 precio_venta=precio_venta, # Asegurar conversión a Decimal si es necesario
                 activo=activo,
-                url_foto=s3_key_foto # Guardar la clave S3
+                url_foto=s3_key_foto, # Guardar la clave S3
+                foto_variantes=foto_variantes
             )
 
             db.session.add(nueva_presentacion)
@@ -231,7 +240,9 @@ class PresentacionResource(Resource):
             
             db.session.commit()
 
-            return presentacion_schema.dump(nueva_presentacion), 201
+            result = presentacion_schema.dump(nueva_presentacion)
+            result['procesamiento_foto'] = upload_status_payload(s3_key_foto)
+            return result, 201
 
         return {"error": "Tipo de contenido no soportado"}, 415
 
@@ -292,23 +303,31 @@ class PresentacionResource(Resource):
             if 'foto' in request.files:
                 file = request.files['foto']
                 if file.filename != '':
+                    # Encolar la nueva foto primero: si la cola está llena se conserva la anterior
+                    try:
+                        s3_key_nueva = save_file_async(file, 'presentaciones', variants=IMAGE_VARIANTS)
+                    except UploadQueueFullError as e:
+                        return {"error": str(e)}, 503
                     # Eliminar foto anterior si existe (usando la clave S3)
-                    if presentacion.url_foto:
-                        delete_file(presentacion.url_foto)
-                    # Guardar nueva foto y obtener su clave S3
-                    s3_key_nueva = save_file(file, 'presentaciones')
+                    if s3_key_nueva and presentacion.url_foto:
+                        queue_delete(presentacion.url_foto, with_variants=True)
                     if s3_key_nueva:
                         presentacion.url_foto = s3_key_nueva # Actualizar la clave S3 en el modelo
+                        presentacion.foto_variantes = is_image(file.content_type)
                     else:
                         return {"error": "Error al subir la nueva foto"}, 500
 
             # Si se especifica eliminar la foto (y no se subió una nueva)
             elif request.form.get('eliminar_foto') == 'true' and presentacion.url_foto:
-                delete_file(presentacion.url_foto) # Eliminar usando la clave S3
+                queue_delete(presentacion.url_foto, with_variants=True) # Eliminar usando la clave S3
                 presentacion.url_foto = None
+                presentacion.foto_variantes = False
 
             db.session.commit()
-            return presentacion_schema.dump(presentacion), 200
+            result = presentacion_schema.dump(presentacion)
+            if 'foto' in request.files and presentacion.url_foto:
+                result['procesamiento_foto'] = upload_status_payload(presentacion.url_foto)
+            return result, 200
 
         return {"error": "Tipo de contenido no soportado"}, 415
 
@@ -327,7 +346,7 @@ class PresentacionResource(Resource):
 
         # Eliminar foto de S3 si existe (usando la clave)
         if presentacion.url_foto:
-            delete_file(presentacion.url_foto)
+            queue_delete(presentacion.url_foto, with_variants=True)
 
         db.session.delete(presentacion)
         db.session.commit()
@@ -4,7 +4,8 @@ from flask import request, current_app
 import json
 from models import Movimiento, Inventario, PresentacionProducto, Lote, Almacen, Receta, ComponenteReceta
 from extensions import db
-from common import handle_db_errors
+from common import handle_db_errors, retry_on_deadlock, is_retryable_db_error
+from services.stock_service import CambioStock, StockInsuficienteError, aplicar_cambios_stock
 from datetime import datetime, timezone
 from decimal import Decimal, InvalidOperation
 from sqlalchemy.orm import joinedload, selectinload
@@ -95,6 +96,7 @@ class ProduccionResource(Resource):
 class ProduccionEnsamblajeResource(Resource):
     @jwt_required()
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         data = request.get_json()
         almacen_id = data["almacen_id"]
@@ -104,106 +106,105 @@ class ProduccionEnsamblajeResource(Resource):
         usuario_id = claims.get('sub')
 
         try:
-            # --- Fase de Verificación de Stock y Lote de Destino ---
-            for item in [s for s in salidas if s['tipo_consumo'] == 'insumo']:
-                cantidad_req = Decimal(item["cantidad_unidades"])
-                inv = Inventario.query.filter_by(almacen_id=almacen_id, presentacion_id=int(item["presentacion_id"]), lote_id=None).first()
-                if not inv or inv.cantidad < cantidad_req:
-                    return {"error": f"Stock de insumo insuficiente para presentación ID {item['presentacion_id']}. Requerido: {cantidad_req}, Disponible: {inv.cantidad if inv else 0}"}, 400
-
+            # --- Fase de Verificación de Lotes (el stock de insumos lo valida el UPDATE condicional) ---
+            # Todos los lotes involucrados se bloquean (FOR UPDATE, en orden de id) antes de validar:
+            # otro ensamblaje o una merma simultánea no pueden validar ni descontar los mismos kg
+            consumos_kg = {}
             for item in [s for s in salidas if s['tipo_consumo'] == 'materia_prima']:
                 lote_id = int(item["lote_id"])
-                cantidad_req_kg = Decimal(item["cantidad_kg"])
-                lote = Lote.query.get(lote_id)
-                
+                consumos_kg[lote_id] = consumos_kg.get(lote_id, Decimal('0')) + Decimal(item["cantidad_kg"])
+            lotes_destino_ids = {int(item['lote_destino_id']) for item in entradas if item.get('lote_destino_id')}
+            lote_ids = set(consumos_kg) | lotes_destino_ids
+            lotes = {
+                lote.id: lote for lote in Lote.query.filter(Lote.id.in_(lote_ids))
+                .order_by(Lote.id).with_for_update().populate_existing()
+            } if lote_ids else {}
+
+            for lote_id, cantidad_req_kg in consumos_kg.items():
+                lote = lotes.get(lote_id)
                 if not lote:
                     return {"error": f"No se encontró el lote ID {lote_id}."}, 400
                 
                 if lote.cantidad_disponible_kg < cantidad_req_kg:
                     return {"error": f"Stock en KG insuficiente en Lote ID {lote_id}. Requerido: {cantidad_req_kg}, Disponible: {lote.cantidad_disponible_kg}"}, 400
 
-            for item in entradas:
-                if lote_destino_id := item.get('lote_destino_id'):
-                    lote_destino = Lote.query.get(lote_destino_id)
-                    if not lote_destino:
-                        return {"error": f"El lote de destino con ID {lote_destino_id} no existe."}, 400
+            for lote_destino_id in sorted(lotes_destino_ids):
+                if lote_destino_id not in lotes:
+                    return {"error": f"El lote de destino con ID {lote_destino_id} no existe."}, 400
 
             # --- Fase de Ejecución (Transacción Atómica) ---
             id_ensamblaje = str(uuid.uuid4())
             fecha_operacion = datetime.now(timezone.utc)
             motivo_base = f"Ensamblaje {id_ensamblaje}: {data['descripcion']}"
 
+            cambios = []
             for item in salidas:
                 if item["tipo_consumo"] == "materia_prima":
                     lote_id, cantidad_kg = int(item["lote_id"]), Decimal(item["cantidad_kg"])
-                    lote = Lote.query.get(lote_id)
-                    # Para materia prima, solo reducimos del lote directamente
-                    lote.cantidad_disponible_kg -= cantidad_kg
+                    # Para materia prima, solo reducimos del lote directamente (ya bloqueado)
+                    lotes[lote_id].cantidad_disponible_kg -= cantidad_kg
                     # Registramos el movimiento sin presentacion_id específica ya que es materia prima
-                    db.session.add(Movimiento(tipo='salida', presentacion_id=None, lote_id=lote_id, cantidad=cantidad_kg, fecha=fecha_operacion, motivo=motivo_base, usuario_id=usuario_id, tipo_operacion='ensamblaje'))
+                    db.session.add(Movimiento(tipo='salida', presentacion_id=None, lote_id=lote_id, cantidad=cantidad_kg, fecha=fecha_operacion, motivo=motivo_base, usuario_id=usuario_id, tipo_operacion='ensamblaje', ensamblaje_id=id_ensamblaje))
                 elif item["tipo_consumo"] == "insumo":
                     presentacion_id, cantidad_unidades = int(item["presentacion_id"]), Decimal(item["cantidad_unidades"])
-                    inv = Inventario.query.filter_by(almacen_id=almacen_id, presentacion_id=presentacion_id, lote_id=None).first()
-                    inv.cantidad -= cantidad_unidades
-                    db.session.add(Movimiento(tipo='salida', presentacion_id=presentacion_id, lote_id=None, cantidad=cantidad_unidades, fecha=fecha_operacion, motivo=motivo_base, usuario_id=usuario_id, tipo_operacion='ensamblaje'))
+                    cambios.append(CambioStock(almacen_id, presentacion_id, None, -cantidad_unidades))
+
+            # Inventario de destino de todas las entradas en una sola consulta
+            presentaciones_entrada = {int(item["presentacion_id"]) for item in entradas}
+            presentaciones_finales = {
+                p.id: p for p in PresentacionProducto.query.filter(PresentacionProducto.id.in_(presentaciones_entrada))
+            }
+            inventarios_destino = {
+                inv.presentacion_id: inv for inv in Inventario.query.filter(
+                    Inventario.almacen_id == almacen_id,
+                    Inventario.presentacion_id.in_(presentaciones_entrada)
+                )
+            }
+            lotes_reasignados = {}
 
             for item in entradas:
                 presentacion_id, cantidad_unidades = int(item["presentacion_id"]), Decimal(item["cantidad_unidades"])
-                presentacion_final = PresentacionProducto.query.get(presentacion_id)
+                presentacion_final = presentaciones_finales[presentacion_id]
                 cantidad_kg_producida = cantidad_unidades * (presentacion_final.capacidad_kg or Decimal('0.0'))
                 lote_destino_id = item.get('lote_destino_id')
 
-                lote_para_movimiento_id = None
-                
                 # Todas las presentaciones van al inventario (productos finales)
                 if lote_destino_id:
-                    lote_destino = Lote.query.get(lote_destino_id)
-                    if not lote_destino:
-                        return {"error": f"El lote de destino con ID {lote_destino_id} no existe."}, 400
+                    lote_destino = lotes[int(lote_destino_id)]
                     lote_destino.cantidad_disponible_kg += cantidad_kg_producida
-                    lote_para_movimiento_id = lote_destino.id
-                else:
-                    # Para productos sin lote específico, usar None en el lote
-                    lote_para_movimiento_id = None
-                
-                # Buscar inventario existente por presentacion_id y almacen_id
-                inv_destino = Inventario.query.filter_by(
-                    presentacion_id=presentacion_id, 
-                    almacen_id=almacen_id
-                ).first()
-                
-                if inv_destino:
-                    # Actualizar inventario existente
-                    inv_destino.cantidad += cantidad_unidades
-                    inv_destino.ultima_actualizacion = fecha_operacion
-                    # Si hay un lote específico, actualizar el lote_id
-                    if lote_destino_id:
-                        inv_destino.lote_id = lote_destino_id
-                else:
-                    # Crear nuevo registro de inventario
-                    inv_destino = Inventario(
-                        presentacion_id=presentacion_id, 
-                        almacen_id=almacen_id, 
-                        lote_id=lote_destino_id, 
-                        cantidad=cantidad_unidades
-                    )
-                    db.session.add(inv_destino)
-                
-                db.session.add(Movimiento(
-                    tipo='entrada', 
-                    presentacion_id=presentacion_id, 
-                    lote_id=lote_para_movimiento_id, 
-                    cantidad=cantidad_unidades, 
-                    fecha=fecha_operacion, 
-                    motivo=motivo_base, 
-                    usuario_id=usuario_id, 
-                    tipo_operacion='ensamblaje'
+
+                # El inventario existente se busca por presentacion_id y almacen_id; si no hay, se crea
+                inv_destino = inventarios_destino.get(presentacion_id)
+                lote_inventario_id = inv_destino.lote_id if inv_destino else lote_destino_id
+                cambios.append(CambioStock(
+                    almacen_id, presentacion_id, lote_inventario_id, cantidad_unidades,
+                    movimiento={'lote_id': lote_destino_id or None}
                 ))
+                if inv_destino and lote_destino_id:
+                    # Si hay un lote específico, el inventario pasa a ese lote
+                    lotes_reasignados[inv_destino] = lote_destino_id
+
+            aplicar_cambios_stock(
+                cambios,
+                crear_faltantes=True,
+                usuario_id=usuario_id,
+                motivo=motivo_base,
+                tipo_operacion='ensamblaje',
+                ensamblaje_id=id_ensamblaje,
+                fecha=fecha_operacion
+            )
+            for inv_destino, lote_destino_id in lotes_reasignados.items():
+                inv_destino.lote_id = lote_destino_id
 
             db.session.commit()
             return {"mensaje": "Operación de ensamblaje registrada exitosamente", "id_ensamblaje": id_ensamblaje}, 201
 
+        except StockInsuficienteError as e:
+            db.session.rollback()
+            return e.to_dict(), 400
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             logger.error(f"Error en registro de ensamblaje: {str(e)}", exc_info=True)
             return {"error": "Error interno al registrar el ensamblaje", "detalle": str(e)}, 500
\ No newline at end of file
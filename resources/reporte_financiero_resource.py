@@ -8,10 +8,11 @@ import logging
  # Asumiendo que db viene de extensions, ajustar si es models
 from models import (
     db, Venta, VentaDetalle, Gasto, PresentacionProducto, 
-    Lote, Pago, Inventario, Almacen
+    Lote, Pago, Almacen, StockResumen
 )
 from common import handle_db_errors
-from utils.file_handlers import get_presigned_url
+from utils.file_handlers import get_presigned_urls
+from services.historico import con_historico, historico_alcanzado
 
 logger = logging.getLogger(__name__)
 
@@ -38,20 +39,26 @@ def _calcular_resumen_financiero(fecha_inicio, fecha_fin, almacen_id, lote_id):
     """
     Lógica centralizada para calcular totales financieros.
     Evita duplicar código entre el Resumen y el Reporte Unificado.
+    Si el rango llega a ventas archivadas, ventas/detalles/pagos incluyen el histórico.
     """
+    historico = historico_alcanzado(Venta.fecha, fecha_inicio)
+    V = con_historico(Venta, historico)
+    VD = con_historico(VentaDetalle, historico)
+    P = con_historico(Pago, historico)
+
     # 1. Base Query para Ventas (Detalles)
     ventas_q = db.session.query(
-        VentaDetalle.venta_id,
-        (VentaDetalle.cantidad * VentaDetalle.precio_unitario).label('total_linea')
-    ).join(Venta, Venta.id == VentaDetalle.venta_id)
+        VD.venta_id,
+        (VD.cantidad * VD.precio_unitario).label('total_linea')
+    ).join(V, V.id == VD.venta_id)
 
     # Filtros de Venta
     if fecha_inicio and fecha_fin:
-        ventas_q = ventas_q.filter(func.date(Venta.fecha).between(fecha_inicio, fecha_fin))
+        ventas_q = ventas_q.filter(func.date(V.fecha).between(fecha_inicio, fecha_fin))
     if almacen_id:
-        ventas_q = ventas_q.filter(Venta.almacen_id == almacen_id)
+        ventas_q = ventas_q.filter(V.almacen_id == almacen_id)
     if lote_id:
-        ventas_q = ventas_q.filter(VentaDetalle.lote_id == lote_id)
+        ventas_q = ventas_q.filter(VD.lote_id == lote_id)
 
     ventas_sub = ventas_q.subquery()
 
@@ -70,18 +77,18 @@ def _calcular_resumen_financiero(fecha_inicio, fecha_fin, almacen_id, lote_id):
 
     # Subquery de pagos totales por venta
     pagos_por_venta_sq = db.session.query(
-        Pago.venta_id,
-        func.sum(Pago.monto).label('total_pagado')
-    ).group_by(Pago.venta_id).subquery()
+        P.venta_id,
+        func.sum(P.monto).label('total_pagado')
+    ).group_by(P.venta_id).subquery()
 
     if lote_id:
         # Si filtramos por lote, la deuda se calcula sobre la FACTURA completa que contiene el lote.
         # Deuda = Suma(Total Venta - Total Pagado) para las ventas filtradas
         deuda_total_query = db.session.query(
-            func.coalesce(func.sum(Venta.total - func.coalesce(pagos_por_venta_sq.c.total_pagado, 0)), 0)
-        ).select_from(Venta).outerjoin(
-            pagos_por_venta_sq, Venta.id == pagos_por_venta_sq.c.venta_id
-        ).filter(Venta.id.in_(venta_ids_filtradas))
+            func.coalesce(func.sum(V.total - func.coalesce(pagos_por_venta_sq.c.total_pagado, 0)), 0)
+        ).select_from(V).outerjoin(
+            pagos_por_venta_sq, V.id == pagos_por_venta_sq.c.venta_id
+        ).filter(V.id.in_(venta_ids_filtradas))
         
         total_deuda = deuda_total_query.scalar() or Decimal('0.00')
         # En contexto de lote, el 'total_pagado' es derivado: (Venta Filtrada - Deuda)
@@ -89,8 +96,8 @@ def _calcular_resumen_financiero(fecha_inicio, fecha_fin, almacen_id, lote_id):
         total_pagado = total_ventas - total_deuda if total_ventas > total_deuda else Decimal('0.00') 
     else:
         # Sin filtro de lote, sumamos pagos directos de las ventas filtradas
-        total_pagado = db.session.query(func.coalesce(func.sum(Pago.monto), 0))\
-            .filter(Pago.venta_id.in_(venta_ids_filtradas))\
+        total_pagado = db.session.query(func.coalesce(func.sum(P.monto), 0))\
+            .filter(P.venta_id.in_(venta_ids_filtradas))\
             .scalar() or Decimal('0.00')
         total_deuda = total_ventas - total_pagado
 
@@ -111,9 +118,10 @@ def _calcular_resumen_financiero(fecha_inicio, fecha_fin, almacen_id, lote_id):
     num_gastos = resumen_gastos[1]
 
     # 5. Depósitos (Solo confirmados)
-    depositos_q = db.session.query(func.coalesce(func.sum(Pago.monto_depositado), 0)).filter(Pago.depositado == True)
+    PD = con_historico(Pago, historico_alcanzado(Pago.fecha_deposito, fecha_inicio))
+    depositos_q = db.session.query(func.coalesce(func.sum(PD.monto_depositado), 0)).filter(PD.depositado == True)
     if fecha_inicio and fecha_fin:
-        depositos_q = depositos_q.filter(func.date(Pago.fecha_deposito).between(fecha_inicio, fecha_fin))
+        depositos_q = depositos_q.filter(func.date(PD.fecha_deposito).between(fecha_inicio, fecha_fin))
     
     depositado_total = depositos_q.scalar() or Decimal('0.00')
 
@@ -151,20 +159,24 @@ class ReporteVentasPresentacionResource(Resource):
         almacen_id = request.args.get('almacen_id', type=int)
         lote_id = request.args.get('lote_id', type=int)
 
+        historico = historico_alcanzado(Venta.fecha, fecha_inicio)
+        V = con_historico(Venta, historico)
+        VD = con_historico(VentaDetalle, historico)
+
         query = db.session.query(
             PresentacionProducto.id.label('presentacion_id'),
             PresentacionProducto.nombre.label('presentacion_nombre'),
-            func.coalesce(func.sum(VentaDetalle.cantidad), 0).label('unidades_vendidas'),
-            func.coalesce(func.sum(VentaDetalle.cantidad * VentaDetalle.precio_unitario), 0).label('total_vendido')
-        ).join(VentaDetalle, VentaDetalle.presentacion_id == PresentacionProducto.id)\
-         .join(Venta, Venta.id == VentaDetalle.venta_id)
+            func.coalesce(func.sum(VD.cantidad), 0).label('unidades_vendidas'),
+            func.coalesce(func.sum(VD.cantidad * VD.precio_unitario), 0).label('total_vendido')
+        ).join(VD, VD.presentacion_id == PresentacionProducto.id)\
+         .join(V, V.id == VD.venta_id)
 
         if fecha_inicio and fecha_fin:
-            query = query.filter(func.date(Venta.fecha).between(fecha_inicio, fecha_fin))
+            query = query.filter(func.date(V.fecha).between(fecha_inicio, fecha_fin))
         if almacen_id:
-            query = query.filter(Venta.almacen_id == almacen_id)
+            query = query.filter(V.almacen_id == almacen_id)
         if lote_id:
-            query = query.filter(VentaDetalle.lote_id == lote_id)
+            query = query.filter(VD.lote_id == lote_id)
 
         reporte = query.group_by(PresentacionProducto.id, PresentacionProducto.nombre).all()
 
@@ -205,24 +217,27 @@ class ReporteUnificadoResource(Resource):
         
         # 3. KPIs y Ventas por Presentación
         # Query optimizada para KPIs
+        historico = historico_alcanzado(Venta.fecha, fecha_inicio)
+        V = con_historico(Venta, historico)
+        VD = con_historico(VentaDetalle, historico)
         ventas_base_q = db.session.query(
-            VentaDetalle.presentacion_id,
+            VD.presentacion_id,
             PresentacionProducto.nombre.label('presentacion_nombre'),
-            func.coalesce(func.sum(VentaDetalle.cantidad), 0).label('unidades'),
-            func.coalesce(func.sum(VentaDetalle.cantidad * VentaDetalle.precio_unitario), 0).label('total_linea'),
-            func.coalesce(func.sum(VentaDetalle.cantidad * PresentacionProducto.capacidad_kg), 0).label('kg_linea')
-        ).join(Venta, Venta.id == VentaDetalle.venta_id)\
-         .join(PresentacionProducto, PresentacionProducto.id == VentaDetalle.presentacion_id)
+            func.coalesce(func.sum(VD.cantidad), 0).label('unidades'),
+            func.coalesce(func.sum(VD.cantidad * VD.precio_unitario), 0).label('total_linea'),
+            func.coalesce(func.sum(VD.cantidad * PresentacionProducto.capacidad_kg), 0).label('kg_linea')
+        ).select_from(VD).join(V, V.id == VD.venta_id)\
+         .join(PresentacionProducto, PresentacionProducto.id == VD.presentacion_id)
 
         if fecha_inicio and fecha_fin:
-            ventas_base_q = ventas_base_q.filter(func.date(Venta.fecha).between(fecha_inicio, fecha_fin))
+            ventas_base_q = ventas_base_q.filter(func.date(V.fecha).between(fecha_inicio, fecha_fin))
         if almacen_id:
-            ventas_base_q = ventas_base_q.filter(Venta.almacen_id == almacen_id)
+            ventas_base_q = ventas_base_q.filter(V.almacen_id == almacen_id)
         if lote_id:
-            ventas_base_q = ventas_base_q.filter(VentaDetalle.lote_id == lote_id)
+            ventas_base_q = ventas_base_q.filter(VD.lote_id == lote_id)
 
         # Agrupamos por producto para el listado, pero calculamos KPIs sumando en Python para evitar otra query
-        ventas_agrupadas = ventas_base_q.group_by(VentaDetalle.presentacion_id, PresentacionProducto.nombre).all()
+        ventas_agrupadas = ventas_base_q.group_by(VD.presentacion_id, PresentacionProducto.nombre).all()
 
         ventas_por_presentacion = []
         total_kg_vendidos = Decimal(0)
@@ -239,24 +254,22 @@ class ReporteUnificadoResource(Resource):
             total_kg_vendidos += r.kg_linea
             total_unidades_vendidas += r.unidades
 
-        # 4. Inventario Actual (Optimizado: Una sola query agrupada por Presentacion y Almacen)
+        # 4. Inventario Actual (desde stock_resumen: ya agregado por Presentacion y Almacen)
         inv_q = db.session.query(
-            Inventario.presentacion_id,
+            StockResumen.presentacion_id,
             PresentacionProducto.nombre.label('p_nombre'),
-            PresentacionProducto.capacidad_kg.label('p_capacidad'),
-            PresentacionProducto.precio_venta.label('p_precio'),
             Almacen.nombre.label('a_nombre'),
-            func.coalesce(func.sum(Inventario.cantidad), 0).label('cantidad')
-        ).join(PresentacionProducto, PresentacionProducto.id == Inventario.presentacion_id)\
-         .join(Almacen, Almacen.id == Inventario.almacen_id)\
+            StockResumen.unidades.label('cantidad'),
+            StockResumen.kg,
+            StockResumen.valor_venta
+        ).join(PresentacionProducto, PresentacionProducto.id == StockResumen.presentacion_id)\
+         .join(Almacen, Almacen.id == StockResumen.almacen_id)\
          .filter(PresentacionProducto.tipo.in_(['procesado', 'briqueta']))
 
         if almacen_id:
-            inv_q = inv_q.filter(Inventario.almacen_id == almacen_id)
+            inv_q = inv_q.filter(StockResumen.almacen_id == almacen_id)
         
-        inv_rows = inv_q.group_by(Inventario.presentacion_id, PresentacionProducto.nombre, 
-                                 PresentacionProducto.capacidad_kg, PresentacionProducto.precio_venta,
-                                 Almacen.nombre).all()
+        inv_rows = inv_q.all()
 
         # Procesamiento en memoria para estructurar JSON
         inv_map = {}
@@ -281,14 +294,12 @@ class ReporteUnificadoResource(Resource):
             })
             
             # Sumamos a los totales de la presentación
-            cantidad_dec = row.cantidad
-            inv_map[pid]['stock_unidades'] += int(cantidad_dec)
-            inv_map[pid]['stock_kg'] += cantidad_dec * row.p_capacidad
-            val_linea = cantidad_dec * row.p_precio
-            inv_map[pid]['valor_estimado'] += val_linea
+            inv_map[pid]['stock_unidades'] += int(row.cantidad)
+            inv_map[pid]['stock_kg'] += row.kg
+            inv_map[pid]['valor_estimado'] += row.valor_venta
             
             # KPI Global
-            valor_inventario_actual += val_linea
+            valor_inventario_actual += row.valor_venta
 
         # Convertir mapa a lista y formatear decimales
         inventario_actual_list = []
@@ -339,37 +350,43 @@ class DepositosHistorialResource(Resource):
         fecha_inicio_str = request.args.get('fecha_inicio')
         fecha_fin_str = request.args.get('fecha_fin')
 
-        query = db.session.query(
-            Pago.referencia,
-            Pago.url_comprobante.label('comprobante_url'),
-            Pago.fecha_deposito,
-            func.sum(Pago.monto_depositado).label('monto_total_agrupado'),
-            func.count(Pago.id).label('cantidad_pagos')
-        ).filter(
-            Pago.depositado == True,
-            Pago.monto_depositado.isnot(None)
-        )
-
-        # 3. Aplicar Filtro de Fechas (Si el front las envía)
+        fecha_inicio = fecha_fin = None
         if fecha_inicio_str and fecha_fin_str:
             try:
                 fecha_inicio = datetime.strptime(fecha_inicio_str, '%Y-%m-%d').date()
                 fecha_fin = datetime.strptime(fecha_fin_str, '%Y-%m-%d').date()
-                
-                # Filtrar por rango de fecha de depósito
-                query = query.filter(func.date(Pago.fecha_deposito).between(fecha_inicio, fecha_fin))
             except ValueError:
                 return {'error': 'Formato de fecha inválido, usar YYYY-MM-DD'}, 400
 
+        # Pagos de ventas archivadas, si el rango llega al histórico
+        P = con_historico(Pago, historico_alcanzado(Pago.fecha_deposito, fecha_inicio))
+        query = db.session.query(
+            P.referencia,
+            P.url_comprobante.label('comprobante_url'),
+            P.fecha_deposito,
+            func.sum(P.monto_depositado).label('monto_total_agrupado'),
+            func.count(P.id).label('cantidad_pagos')
+        ).filter(
+            P.depositado == True,
+            P.monto_depositado.isnot(None)
+        )
+
+        # 3. Aplicar Filtro de Fechas (Si el front las envía)
+        if fecha_inicio and fecha_fin:
+            # Filtrar por rango de fecha de depósito
+            query = query.filter(func.date(P.fecha_deposito).between(fecha_inicio, fecha_fin))
+
         query = query.group_by(
-            Pago.referencia,
-            Pago.url_comprobante,
-            Pago.fecha_deposito
+            P.referencia,
+            P.url_comprobante,
+            P.fecha_deposito
         )
-        resultados = query.order_by(Pago.fecha_deposito.desc()).all()
+        resultados = query.order_by(P.fecha_deposito.desc()).all()
+        # Firmar cada comprobante distinto una sola vez
+        presigned_urls = get_presigned_urls(r.comprobante_url for r in resultados)
         response = []
         for r in resultados:
-            presigned = get_presigned_url(r.comprobante_url) if r.comprobante_url else None
+            presigned = presigned_urls.get(r.comprobante_url) if r.comprobante_url else None
             response.append({
                 'fecha_deposito': r.fecha_deposito.strftime('%Y-%m-%d %H:%M') if r.fecha_deposito else None,
                 'referencia': r.referencia or "Sin Referencia",
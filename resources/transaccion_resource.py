@@ -1,9 +1,11 @@
 from flask import request
 from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt, get_jwt_identity
-from models import Venta, VentaDetalle, Pago, Gasto, Movimiento, Inventario, Cliente
+from models import Venta, VentaDetalle, Pago, Gasto, Cliente
 from extensions import db
-from common import handle_db_errors, parse_iso_datetime
+from common import handle_db_errors, retry_on_deadlock, is_retryable_db_error, parse_iso_datetime
+from services.stock_service import CambioStock, aplicar_cambios_stock
+from services.idempotency import idempotente
 from decimal import Decimal
 from datetime import datetime
 import logging
@@ -12,7 +14,9 @@ logger = logging.getLogger(__name__)
 
 class TransaccionCompletaResource(Resource):
     @jwt_required()
+    @idempotente
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         """
         Recibe un JSON confirmado con datos de Venta, Pagos y Gasto.
@@ -51,14 +55,6 @@ class TransaccionCompletaResource(Resource):
                 if not prod_id or not lote_id:
                      return {"error": f"Faltan datos (ID o Lote) para el producto: {item.get('producto_nombre_buscado')}"}, 400
 
-                # Verificar stock nuevamente (seguridad)
-                inventario = Inventario.query.filter_by(almacen_id=almacen_id, presentacion_id=prod_id, lote_id=lote_id).with_for_update().first()
-                if not inventario or inventario.cantidad < cantidad:
-                     raise ValueError(f"Stock insuficiente para producto ID {prod_id} durante la transacción.")
-
-                # Deducir Stock
-                inventario.cantidad -= cantidad
-                
                 detalle = VentaDetalle(
                     presentacion_id=prod_id,
                     cantidad=cantidad,
@@ -80,17 +76,15 @@ class TransaccionCompletaResource(Resource):
             db.session.add(nueva_venta)
             db.session.flush() # Para obtener ID de venta
 
-            # --- 3. Registrar Movimientos de Salida ---
-            for detalle in nueva_venta.detalles:
-                movimiento = Movimiento(
-                    tipo='salida',
-                    presentacion_id=detalle.presentacion_id,
-                    lote_id=detalle.lote_id,
-                    cantidad=detalle.cantidad,
-                    usuario_id=usuario_id,
-                    motivo=f"Venta ID: {nueva_venta.id} (Voz)"
-                )
-                db.session.add(movimiento)
+            # --- 3. Descontar stock y registrar Movimientos de Salida ---
+            # Un único UPDATE condicional: si falta stock en cualquier línea no se toca ninguna
+            aplicar_cambios_stock(
+                [CambioStock(almacen_id, d.presentacion_id, d.lote_id, -d.cantidad) for d in nueva_venta.detalles],
+                usuario_id=usuario_id,
+                motivo=f"Venta ID: {nueva_venta.id} (Voz)",
+                tipo_operacion='venta',
+                venta_id=nueva_venta.id
+            )
 
             # --- 4. Registrar Pagos ---
             total_pagado = Decimal(0)
@@ -148,6 +142,8 @@ class TransaccionCompletaResource(Resource):
             db.session.rollback()
             return {"error": str(ve)}, 400
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             logger.error(f"Error en TransaccionCompleta: {e}", exc_info=True)
             return {"error": "Error interno al procesar la transacción."}, 500
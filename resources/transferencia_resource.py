@@ -9,12 +9,13 @@ from flask_jwt_extended import get_jwt, jwt_required
 from flask_restful import Resource
 from sqlalchemy.orm import joinedload
 
-from common import handle_db_errors
+from common import handle_db_errors, retry_on_deadlock, is_retryable_db_error, get_foto_variant
 from extensions import db
-from models import Almacen, Inventario, Movimiento, PresentacionProducto
+from models import Almacen, Inventario, PresentacionProducto
+from services.stock_service import CambioStock, aplicar_cambios_stock
 # Imports agregados para el método GET
 from schemas import almacenes_schema
-from utils.file_handlers import get_presigned_url
+from utils.file_handlers import presign_payload
 
 logger = logging.getLogger(__name__)
 
@@ -121,59 +122,44 @@ class TransferenciaService:
 
     def _actualizar_inventarios_y_crear_movimientos(self, inventarios_origen, inventarios_destino):
         """
-        Modifica los registros de inventario en la sesión de la base de datos
-        y crea los movimientos correspondientes.
+        Aplica salidas y entradas de todas las transferencias en un único UPDATE
+        condicional (creando las filas de destino que falten) e inserta los
+        movimientos en un solo INSERT.
         """
-        movimientos_a_crear = []
+        motivo_salida = f"Transferencia a {self.almacen_destino.nombre} (Op: {self.id_operacion})"
+        motivo_entrada = f"Transferencia desde {self.almacen_origen.nombre} (Op: {self.id_operacion})"
+        cambios = []
         transferencias_realizadas_info = []
 
         for transfer in self.transferencias_validadas:
             inv_origen = inventarios_origen[transfer['presentacion_id']]
             inv_destino = inventarios_destino.get(transfer['presentacion_id'])
-
             cantidad = transfer['cantidad']
 
-            # Actualizar inventarios
-            inv_origen.cantidad -= cantidad
-            if inv_destino:
-                inv_destino.cantidad += cantidad
-                inv_destino.ultima_actualizacion = self.fecha_operacion
-            else:
-                inv_destino_nuevo = Inventario(
-                    presentacion_id=transfer['presentacion_id'],
-                    almacen_id=self.almacen_destino_id,
-                    lote_id=None,  # Las transferencias no manejan lotes específicos
-                    cantidad=cantidad,
-                    stock_minimo=inv_origen.stock_minimo
-                )
-                db.session.add(inv_destino_nuevo)
-
-            # Preparar movimientos
-            motivo_salida = f"Transferencia a {self.almacen_destino.nombre} (Op: {self.id_operacion})"
-            motivo_entrada = f"Transferencia desde {self.almacen_origen.nombre} (Op: {self.id_operacion})"
-
-            movimientos_a_crear.append(Movimiento(
-                tipo='salida', motivo=motivo_salida, 
-                presentacion_id=transfer['presentacion_id'],
-                lote_id=None,  # Las transferencias no manejan lotes específicos
-                cantidad=cantidad,
-                usuario_id=self.usuario_id, tipo_operacion='transferencia', fecha=self.fecha_operacion
+            # Las transferencias no manejan lotes específicos: los movimientos van sin lote
+            cambios.append(CambioStock(
+                self.almacen_origen_id, transfer['presentacion_id'], inv_origen.lote_id, -cantidad,
+                movimiento={'motivo': motivo_salida, 'lote_id': None}
             ))
-            movimientos_a_crear.append(Movimiento(
-                tipo='entrada', motivo=motivo_entrada, 
-                presentacion_id=transfer['presentacion_id'],
-                lote_id=None,  # Las transferencias no manejan lotes específicos
-                cantidad=cantidad,
-                usuario_id=self.usuario_id, tipo_operacion='transferencia', fecha=self.fecha_operacion
+            cambios.append(CambioStock(
+                self.almacen_destino_id, transfer['presentacion_id'], inv_destino.lote_id if inv_destino else None,
+                cantidad, movimiento={'motivo': motivo_entrada, 'lote_id': None},
+                stock_minimo=inv_origen.stock_minimo
             ))
-            
+
             transferencias_realizadas_info.append({
                 "presentacion_nombre": inv_origen.presentacion.nombre,
                 "cantidad": str(cantidad),
                 "lote_id": None  # Las transferencias no manejan lotes específicos
             })
 
-        db.session.add_all(movimientos_a_crear)
+        aplicar_cambios_stock(
+            cambios,
+            crear_faltantes=True,
+            usuario_id=self.usuario_id,
+            tipo_operacion='transferencia',
+            fecha=self.fecha_operacion
+        )
         return transferencias_realizadas_info
 
 
@@ -222,7 +208,8 @@ class TransferenciaInventarioResource(Resource):
                     presentaciones_agrupadas[pres_id] = {
                         "id": pres_id,
                         "nombre": inv.presentacion.nombre,
-                        "url_foto": get_presigned_url(inv.presentacion.url_foto) if inv.presentacion.url_foto else None,
+                        "url_foto": inv.presentacion.url_foto or None,
+                        "foto_variantes": inv.presentacion.foto_variantes,
                         "inventarios": []
                     }
 
@@ -245,7 +232,9 @@ class TransferenciaInventarioResource(Resource):
             
             return {
                 "almacenes": almacenes_schema.dump(almacenes),
-                "presentaciones_disponibles": list(presentaciones_agrupadas.values())
+                "presentaciones_disponibles": presign_payload(
+                    list(presentaciones_agrupadas.values()), foto_variant=get_foto_variant()
+                )
             }, 200
 
         except Exception as e:
@@ -254,6 +243,7 @@ class TransferenciaInventarioResource(Resource):
 
     @jwt_required()
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         """
         Transfiere inventario entre almacenes de forma múltiple y optimizada.
@@ -276,6 +266,8 @@ class TransferenciaInventarioResource(Resource):
             db.session.rollback()
             return {"error": str(e)}, 400
         except Exception as e:
+            if is_retryable_db_error(e):
+                raise  # Lo reintenta retry_on_deadlock
             db.session.rollback()
             logger.error(f"Error crítico en transferencia: {str(e)}", exc_info=True)
             return {"error": "Ocurrió un error interno al procesar la transferencia."}, 500
@@ -3,6 +3,7 @@ from flask_restful import Resource
 from flask_jwt_extended import jwt_required, get_jwt
 from flask import request, current_app
 from models import Users, Almacen
+from sqlalchemy import func
 from schemas import user_schema, users_schema
 from extensions import db
 from common import handle_db_errors, MAX_ITEMS_PER_PAGE, rol_requerido, validate_pagination_params, create_pagination_response
@@ -91,7 +92,7 @@ class UserResource(Resource):
             
             # Verificar que el username no exista (case insensitive)
             username = data.get('username').strip().lower()  # Convertir a minúsculas
-            if Users.query.filter(Users.username.ilike(username)).first():
+            if Users.query.filter(func.lower(Users.username) == username).first():
                 return {"error": "El nombre de usuario ya existe"}, 400
             
             # Validar rol
@@ -156,7 +157,7 @@ class UserResource(Resource):
                 if len(username) < 3:
                     return {"error": "El nombre de usuario debe tener al menos 3 caracteres"}, 400
                     
-                if Users.query.filter(Users.username.ilike(username)).first():
+                if Users.query.filter(func.lower(Users.username) == username).first():
                     return {"error": "El nombre de usuario ya existe"}, 400
             
             # Si se cambia la contraseña, verificar complejidad
@@ -1,17 +1,23 @@
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import jwt_required, get_jwt
-from flask import request, send_file
+from flask import request, current_app
 from models import Venta, VentaDetalle, Inventario, Cliente, PresentacionProducto, Almacen, Movimiento, Lote, Users
-from schemas import venta_schema, ventas_schema, clientes_schema, almacenes_schema, presentacion_schema
+from schemas import venta_schema, ventas_schema, clientes_schema, almacenes_schema, presentacion_schema, loader_options, VENTA_LOADERS
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin, parse_iso_datetime
-from utils.file_handlers import get_presigned_url
+from common import handle_db_errors, retry_on_deadlock, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin, parse_iso_datetime, get_foto_variant, paginate_query, create_pagination_response
+from utils.file_handlers import presign_payload
+from utils.export_engine import ExportSpec, export_response
+from services.export_jobs import submit_export_request
+from services.stock_service import CambioStock, StockInsuficienteError, aplicar_cambios_stock, bloquear_inventarios
+from services.idempotency import idempotente
+from services.historico import cargar_hijos_historicos, con_historico, historico_alcanzado
 from datetime import datetime, timezone
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 import logging
+import uuid
+from marshmallow import ValidationError
 from sqlalchemy import asc, desc, orm
-import pandas as pd
-import io
+from sqlalchemy.exc import IntegrityError
 
 logger = logging.getLogger(__name__)
 
@@ -29,15 +35,7 @@ class VentaResource(Resource):
                 return {"error": "No tienes permiso para ver esta venta"}, 403
             
             result = venta_schema.dump(venta)
-            
-            if 'detalles' in result and result['detalles']:
-                for detalle in result['detalles']:
-                    if 'presentacion' in detalle and detalle['presentacion'] and 'url_foto' in detalle['presentacion']:
-                        s3_key = detalle['presentacion']['url_foto']
-                        if s3_key:
-                            detalle['presentacion']['url_foto'] = get_presigned_url(s3_key)
-            
-            return result, 200
+            return presign_payload(result), 200
         
         filters = {
             "cliente_id": request.args.get('cliente_id'),
@@ -49,63 +47,76 @@ class VentaResource(Resource):
         }
 
         get_all = request.args.get('all', 'false').lower() == 'true'
-        query = Venta.query
+
+        fecha_inicio = fecha_fin = None
+        if filters["fecha_inicio"] and filters["fecha_fin"]:
+            try:
+                fecha_inicio = parse_iso_datetime(filters["fecha_inicio"], add_timezone=True)
+                fecha_fin = parse_iso_datetime(filters["fecha_fin"], add_timezone=True)
+            except ValueError:
+                return {"error": "Formato de fecha inválido. Usa ISO 8601"}, 400
+
+        # Si el rango de fechas llega a ventas archivadas, se consultan también las del histórico
+        historico = fecha_inicio is not None and historico_alcanzado(Venta.fecha, fecha_inicio)
+        V = con_historico(Venta, historico)
+        query = db.session.query(V).options(*loader_options(VENTA_LOADERS, 'lista', V))
 
         if not is_admin:
-            query = query.filter_by(vendedor_id=current_user_id)
+            query = query.filter(V.vendedor_id == current_user_id)
         elif filters["vendedor_id"]:
-            query = query.filter_by(vendedor_id=filters["vendedor_id"])
+            query = query.filter(V.vendedor_id == filters["vendedor_id"])
         
         if filters["cliente_id"]:
-            query = query.filter_by(cliente_id=filters["cliente_id"])
+            query = query.filter(V.cliente_id == filters["cliente_id"])
         if filters["almacen_id"]:
-            query = query.filter_by(almacen_id=filters["almacen_id"])
+            query = query.filter(V.almacen_id == filters["almacen_id"])
         
         if filters["estado_pago"]:
             statuses = [status.strip() for status in filters["estado_pago"].split(',') if status.strip()]
             if statuses:
-                query = query.filter(Venta.estado_pago.in_(statuses))
+                query = query.filter(V.estado_pago.in_(statuses))
 
-        if filters["fecha_inicio"] and filters["fecha_fin"]:
-            try:
-                fecha_inicio = parse_iso_datetime(filters["fecha_inicio"], add_timezone=True)
-                fecha_fin = parse_iso_datetime(filters["fecha_fin"], add_timezone=True)
-                query = query.filter(Venta.fecha.between(fecha_inicio, fecha_fin))
-            except ValueError:
-                return {"error": "Formato de fecha inválido. Usa ISO 8601"}, 400
+        if fecha_inicio is not None:
+            query = query.filter(V.fecha.between(fecha_inicio, fecha_fin))
         
         sort_by = request.args.get('sort_by', 'fecha')
         sort_order = request.args.get('sort_order', 'desc').lower()
 
         sortable_columns = {
-            'fecha': Venta.fecha, 'total': Venta.total, 'cliente_nombre': Cliente.nombre
+            'fecha': V.fecha, 'total': V.total, 'cliente_nombre': Cliente.nombre
         }
-        column_to_sort = sortable_columns.get(sort_by, Venta.fecha)
+        column_to_sort = sortable_columns.get(sort_by, V.fecha)
         order_func = desc if sort_order == 'desc' else asc
 
         if sort_by == 'cliente_nombre':
-            query = query.join(Cliente, Venta.cliente_id == Cliente.id)
+            query = query.join(Cliente, V.cliente_id == Cliente.id)
         
         query = query.order_by(order_func(column_to_sort))
 
         if get_all:
             ventas_items = query.all()
-            return {"data": ventas_schema.dump(ventas_items)}, 200
+            if historico:
+                _cargar_hijos_historicos(ventas_items)
+            return {"data": presign_payload(ventas_schema.dump(ventas_items), foto_variant=get_foto_variant())}, 200
 
         page = request.args.get('page', 1, type=int)
         per_page = min(request.args.get('per_page', 10, type=int), MAX_ITEMS_PER_PAGE)
-        ventas = query.paginate(page=page, per_page=per_page)
+        # Con ?cursor= se pagina por keyset (columna de orden + id) en lugar de OFFSET
+        ventas = paginate_query(
+            query, [(column_to_sort, sort_order == 'desc')], V.id, page, per_page, error_out=True
+        )
+        if historico:
+            _cargar_hijos_historicos(ventas.items)
         
-        return {
-            "data": ventas_schema.dump(ventas.items),
-            "pagination": {
-                "total": ventas.total, "page": ventas.page, "per_page": ventas.per_page, "pages": ventas.pages
-            }
-        }, 200
+        return create_pagination_response(
+            presign_payload(ventas_schema.dump(ventas.items), foto_variant=get_foto_variant()), ventas
+        ), 200
 
     @jwt_required()
     @mismo_almacen_o_admin
+    @idempotente
     @handle_db_errors
+    @retry_on_deadlock
     def post(self):
         """
         Crea una nueva venta. El lote_id se obtiene automáticamente del inventario.
@@ -125,9 +136,9 @@ class VentaResource(Resource):
         total = Decimal('0')
         detalles_para_venta = []
 
-        # Optimización para obtener todos los datos necesarios en menos consultas
+        # Un solo SELECT para lote y precio de todas las líneas; el stock se valida al descontarlo
         presentacion_ids = [d.get('presentacion_id') for d in detalles_data]
-        inventarios = Inventario.query.filter(
+        inventarios = Inventario.query.options(orm.joinedload(Inventario.presentacion)).filter(
             Inventario.presentacion_id.in_(presentacion_ids),
             Inventario.almacen_id == venta_data.almacen_id
         ).all()
@@ -143,9 +154,6 @@ class VentaResource(Resource):
             inventario = inventarios_dict.get(presentacion_id)
             if not inventario:
                 return {"error": f"No se encontró inventario para la presentación {presentacion_id} en este almacén."}, 404
-            
-            if inventario.cantidad < cantidad:
-                return {"error": f"Stock insuficiente para {inventario.presentacion.nombre} (Disponible: {inventario.cantidad})"}, 400
 
             # --- LÓGICA ÓPTIMA: Obtener lote automáticamente ---
             lote_id_obtenido = inventario.lote_id
@@ -162,7 +170,6 @@ class VentaResource(Resource):
             )
             detalles_para_venta.append(nuevo_detalle)
             total += cantidad * Decimal(precio_unitario)
-            inventario.cantidad -= cantidad # Deducir stock
 
         nueva_venta = Venta(
             cliente_id=venta_data.cliente_id,
@@ -178,16 +185,17 @@ class VentaResource(Resource):
         db.session.add(nueva_venta)
         db.session.flush()
 
-        for detalle in nueva_venta.detalles:
-            movimiento = Movimiento(
-                tipo='salida',
-                presentacion_id=detalle.presentacion_id,
-                lote_id=detalle.lote_id,
-                cantidad=detalle.cantidad,
+        try:
+            aplicar_cambios_stock(
+                [CambioStock(nueva_venta.almacen_id, d.presentacion_id, d.lote_id, -d.cantidad) for d in nueva_venta.detalles],
                 usuario_id=claims['sub'],
-                motivo=f"Venta ID: {nueva_venta.id} - Cliente: {cliente.nombre}"
+                motivo=f"Venta ID: {nueva_venta.id} - Cliente: {cliente.nombre}",
+                tipo_operacion='venta',
+                venta_id=nueva_venta.id
             )
-            db.session.add(movimiento)
+        except StockInsuficienteError as e:
+            db.session.rollback()
+            return e.to_dict(), 400
 
         db.session.commit()
         return venta_schema.dump(nueva_venta), 201
@@ -195,80 +203,43 @@ class VentaResource(Resource):
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def put(self, venta_id):
         """
-        Actualiza una venta existente de forma optimizada, precargando el inventario.
+        Actualiza una venta aplicando solo las diferencias en sus detalles
+        (ver _diff_detalles). Sin `detalles` en el payload las líneas no se tocan.
         """
         # Carga la venta y sus detalles de una sola vez
         venta = Venta.query.options(orm.joinedload(Venta.detalles)).get_or_404(venta_id)
-        data = request.get_json()
-        nuevos_detalles_data = data.get('detalles', [])
-        
-        # IDs de presentaciones de los detalles actuales y nuevos para una consulta única
-        presentacion_ids_actuales = {d.presentacion_id for d in venta.detalles}
-        presentacion_ids_nuevos = {d.get('presentacion_id') for d in nuevos_detalles_data}
-        todos_los_ids = list(presentacion_ids_actuales.union(presentacion_ids_nuevos))
-
-        # --- MEJORA CLAVE: Cargar todo el inventario necesario en una sola consulta ---
-        inventarios = Inventario.query.filter(
-            Inventario.almacen_id == venta.almacen_id,
-            Inventario.presentacion_id.in_(todos_los_ids)
-        ).all()
-        # Convertir a un diccionario para acceso instantáneo (O(1))
-        inventario_dict = {i.presentacion_id: i for i in inventarios}
-
-        # --- 1. Revertir el estado anterior (usando el diccionario) ---
-        for detalle_actual in venta.detalles:
-            inventario = inventario_dict.get(detalle_actual.presentacion_id)
-            if inventario:
-                inventario.cantidad += detalle_actual.cantidad
-        
-        Movimiento.query.filter(Movimiento.motivo.like(f"Venta ID: {venta_id}%")).delete(synchronize_session=False)
-
-        # --- 2. Procesar y aplicar el nuevo estado (usando el diccionario) ---
-        nuevo_total = Decimal('0')
-        nuevos_detalles_obj = []
+        data = request.get_json() or {}
 
-        for detalle_data in nuevos_detalles_data:
-            presentacion_id = detalle_data.get('presentacion_id')
-            cantidad = detalle_data.get('cantidad')
-            precio_unitario = Decimal(detalle_data.get('precio_unitario'))
-
-            inventario = inventario_dict.get(presentacion_id)
-            if not inventario or inventario.cantidad < cantidad:
-                db.session.rollback() # Importante: revertir cambios si hay error
-                return {"error": f"Stock insuficiente para actualizar. Presentación ID: {presentacion_id}"}, 400
-            
-            inventario.cantidad -= cantidad
-            
-            detalle_obj = VentaDetalle(
-                presentacion_id=presentacion_id,
-                cantidad=cantidad,
-                precio_unitario=precio_unitario,
-                lote_id=inventario.lote_id
-            )
-            nuevos_detalles_obj.append(detalle_obj)
-            nuevo_total += cantidad * precio_unitario
+        cambios = []
+        if 'detalles' in data:
+            cambios, error = _diff_detalles(venta, data.get('detalles') or [])
+            if error:
+                db.session.rollback()
+                return error
 
-        # --- 3. Actualizar la venta ---
         venta.cliente_id = data.get('cliente_id', venta.cliente_id)
-        # (actualiza los otros campos de la venta como ya lo hacías)
-        venta.total = nuevo_total
-        venta.detalles = nuevos_detalles_obj
-        
-        # (El resto de la lógica para crear movimientos y hacer commit se mantiene igual)
-        cliente_nombre = Cliente.query.get(venta.cliente_id).nombre
-        current_user_id = get_jwt().get('sub')
-        for detalle in venta.detalles:
-            movimiento = Movimiento(
-                tipo='salida',
-                presentacion_id=detalle.presentacion_id,
-                lote_id=detalle.lote_id,
-                cantidad=detalle.cantidad,
-                usuario_id=current_user_id,
-                motivo=f"Venta ID: {venta.id} - Cliente: {cliente_nombre} (Actualizada)"
-            )
-            db.session.add(movimiento)
+        nuevo_total = sum((d.cantidad * Decimal(d.precio_unitario) for d in venta.detalles), Decimal('0'))
+        if nuevo_total != venta.total:
+            venta.total = nuevo_total
+            venta.actualizar_estado()
+
+        # Solo los cambios netos de stock, en un único UPDATE condicional
+        if cambios:
+            cliente_nombre = Cliente.query.get(venta.cliente_id).nombre
+            try:
+                aplicar_cambios_stock(
+                    cambios,
+                    usuario_id=get_jwt().get('sub'),
+                    motivo=f"Venta ID: {venta.id} - Cliente: {cliente_nombre} (Actualizada)",
+                    tipo_operacion='venta',
+                    venta_id=venta.id
+                )
+            except StockInsuficienteError as e:
+                db.session.rollback()
+                return e.to_dict(), 400
 
         db.session.commit()
         return venta_schema.dump(venta), 200
@@ -276,25 +247,339 @@ class VentaResource(Resource):
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def delete(self, venta_id):
         venta = Venta.query.get_or_404(venta_id)
         
-        # Revertir movimientos e inventario
-        movimientos = Movimiento.query.filter(Movimiento.motivo.like(f"Venta ID: {venta_id}%")).all()
+        # Revertir movimientos e inventario: las salidas vuelven al stock y las
+        # entradas (detalles quitados) se descuentan, en un solo UPDATE
+        movimientos = Movimiento.query.filter(Movimiento.venta_id == venta_id).all()
+        inventarios = Inventario.query.filter(
+            Inventario.almacen_id == venta.almacen_id,
+            Inventario.presentacion_id.in_({m.presentacion_id for m in movimientos})
+        ).all() if movimientos else []
+        inventario_dict = {i.presentacion_id: i for i in inventarios}
+        cambios = []
         for movimiento in movimientos:
-            inventario = Inventario.query.filter_by(
-                presentacion_id=movimiento.presentacion_id,
-                almacen_id=venta.almacen_id
-            ).first()
+            inventario = inventario_dict.get(movimiento.presentacion_id)
             if inventario:
-                inventario.cantidad += movimiento.cantidad
+                delta = movimiento.cantidad if movimiento.tipo == 'salida' else -movimiento.cantidad
+                cambios.append(CambioStock(venta.almacen_id, inventario.presentacion_id, inventario.lote_id, delta))
             db.session.delete(movimiento)
+        try:
+            aplicar_cambios_stock(cambios, registrar_movimientos=False)
+        except StockInsuficienteError as e:
+            db.session.rollback()
+            return e.to_dict(), 400
         
         db.session.delete(venta)
         db.session.commit()
         
         return {"message": "Venta eliminada con éxito"}, 200
 
+def _cargar_hijos_historicos(ventas):
+    """Pagos y detalles de las ventas archivadas: VENTA_LOADERS solo los busca en las tablas actuales."""
+    cargar_hijos_historicos(ventas, Venta.pagos)
+    cargar_hijos_historicos(ventas, Venta.detalles, cargar=('presentacion',))
+
+
+def _diff_detalles(venta, detalles_data):
+    """
+    Aplica a la sesión la diferencia entre los detalles de `venta` y `detalles_data`:
+    - Línea nueva: VentaDetalle nuevo y salida de stock
+    - Línea quitada: se elimina el VentaDetalle y vuelve el stock
+    - Cantidad distinta: un cambio de stock por la diferencia neta
+    - Solo precio distinto: se actualiza el precio, sin tocar stock
+    Las líneas iguales no se modifican. Cada línea se empareja con un detalle
+    existente por `id` o, si no lo trae, por presentacion_id.
+    Devuelve (cambios de stock, None) o (None, (respuesta, código)).
+    """
+    lineas = []
+    for detalle_data in detalles_data:
+        try:
+            presentacion_id = int(detalle_data.get('presentacion_id'))
+            cantidad = int(detalle_data.get('cantidad'))
+            precio = detalle_data.get('precio_unitario')
+            precio_unitario = Decimal(str(precio)) if precio is not None else None
+            detalle_id = int(detalle_data['id']) if detalle_data.get('id') is not None else None
+        except (TypeError, ValueError, InvalidOperation):
+            return None, ({"error": "Cada detalle debe incluir presentacion_id y cantidad válidos"}, 400)
+        if cantidad <= 0:
+            return None, ({"error": f"La cantidad debe ser positiva. Presentación ID: {presentacion_id}"}, 400)
+        lineas.append((detalle_id, presentacion_id, cantidad, precio_unitario))
+
+    # --- 1. Emparejar líneas del payload con los detalles actuales ---
+    actuales = {d.id: d for d in venta.detalles}
+    usados = set()
+    emparejados = []
+    for detalle_id, presentacion_id, cantidad, precio_unitario in lineas:
+        if detalle_id is not None:
+            detalle = actuales.get(detalle_id)
+            if detalle is None or detalle_id in usados:
+                return None, ({"error": f"El detalle {detalle_id} no pertenece a esta venta"}, 400)
+            if detalle.presentacion_id != presentacion_id:
+                detalle = None  # Cambió de producto: se trata como quitar + agregar
+        else:
+            detalle = next((d for d in venta.detalles
+                            if d.presentacion_id == presentacion_id and d.id not in usados), None)
+        if detalle is not None:
+            usados.add(detalle.id)
+        emparejados.append((detalle, presentacion_id, cantidad, precio_unitario))
+    quitados = [d for d in venta.detalles if d.id not in usados]
+
+    # --- 2. Inventario de todas las presentaciones involucradas en una consulta ---
+    presentacion_ids = {d.presentacion_id for d in venta.detalles} | {linea[1] for linea in lineas}
+    inventarios = Inventario.query.options(orm.joinedload(Inventario.presentacion)).filter(
+        Inventario.almacen_id == venta.almacen_id,
+        Inventario.presentacion_id.in_(presentacion_ids)
+    ).all() if presentacion_ids else []
+    por_lote = {(i.presentacion_id, i.lote_id): i for i in inventarios}
+    por_presentacion = {i.presentacion_id: i for i in inventarios}
+
+    def fila_de(detalle):
+        # El stock vuelve/sale del lote del detalle si aún tiene fila de inventario
+        return por_lote.get((detalle.presentacion_id, detalle.lote_id)) or por_presentacion.get(detalle.presentacion_id)
+
+    # --- 3. Calcular cambios netos ---
+    cambios = []
+    for detalle in quitados:
+        inventario = fila_de(detalle)
+        if inventario:
+            cambios.append(CambioStock(venta.almacen_id, detalle.presentacion_id, inventario.lote_id,
+                                       detalle.cantidad, movimiento={'lote_id': detalle.lote_id}))
+        venta.detalles.remove(detalle)
+
+    for detalle, presentacion_id, cantidad, precio_unitario in emparejados:
+        if detalle is None:
+            inventario = por_presentacion.get(presentacion_id)
+            if not inventario:
+                return None, ({"error": f"No se encontró inventario para la presentación {presentacion_id} en este almacén."}, 404)
+            venta.detalles.append(VentaDetalle(
+                presentacion_id=presentacion_id,
+                cantidad=cantidad,
+                precio_unitario=precio_unitario if precio_unitario is not None else inventario.presentacion.precio_venta,
+                lote_id=inventario.lote_id
+            ))
+            cambios.append(CambioStock(venta.almacen_id, presentacion_id, inventario.lote_id, -cantidad))
+            continue
+
+        diferencia = cantidad - detalle.cantidad
+        if diferencia:
+            inventario = fila_de(detalle)
+            if not inventario:
+                return None, ({"error": f"No se encontró inventario para la presentación {presentacion_id} en este almacén."}, 404)
+            cambios.append(CambioStock(venta.almacen_id, presentacion_id, inventario.lote_id,
+                                       -diferencia, movimiento={'lote_id': detalle.lote_id}))
+            detalle.cantidad = cantidad
+        if precio_unitario is not None and precio_unitario != detalle.precio_unitario:
+            detalle.precio_unitario = precio_unitario
+
+    return cambios, None
+
+
+class VentaBatchResource(Resource):
+    @jwt_required()
+    @handle_db_errors
+    @retry_on_deadlock
+    def post(self):
+        """
+        Sincroniza ventas capturadas offline en el móvil.
+        Payload: {"ventas": [{client_uuid, cliente_id, almacen_id, tipo_pago, fecha, detalles: [...]}, ...]}
+        - Cada venta se acepta o rechaza por separado (éxito parcial); el resultado
+          de cada una vuelve en el mismo orden que se envió.
+        - Un client_uuid ya aplicado se informa como 'duplicada' con su venta_id.
+        - Clientes e inventario se cargan en pocas consultas; el stock de todas las
+          ventas aceptadas se descuenta en un único UPDATE y sus movimientos en un INSERT.
+        """
+        data = request.get_json(silent=True) or {}
+        ventas_data = data.get('ventas')
+        if not isinstance(ventas_data, list) or not ventas_data:
+            return {"error": "Se requiere una lista 'ventas' con al menos una venta"}, 400
+        max_items = current_app.config.get('VENTAS_BATCH_MAX_ITEMS', 500)
+        if len(ventas_data) > max_items:
+            return {"error": f"Máximo {max_items} ventas por lote"}, 400
+
+        for intento in (1, 2):
+            try:
+                return _procesar_lote_ventas(ventas_data, get_jwt())
+            except IntegrityError:
+                # Otro envío del mismo lote insertó alguno de los UUID en paralelo:
+                # al repetir, esas ventas salen como duplicadas
+                db.session.rollback()
+                if intento == 2:
+                    raise
+
+
+def _entero_estricto(valor):
+    """int de un valor JSON sin truncar: rechaza booleanos, decimales (2.7) y textos no enteros."""
+    if isinstance(valor, bool):
+        raise ValueError(valor)
+    if isinstance(valor, str):
+        return int(valor.strip())
+    if not isinstance(valor, (int, float, Decimal)):
+        raise TypeError(valor)
+    entero = int(valor)
+    if entero != valor:
+        raise ValueError(valor)
+    return entero
+
+
+def _procesar_lote_ventas(ventas_data, claims):
+    resultados = [{"index": i, "client_uuid": None, "estado": None} for i in range(len(ventas_data))]
+
+    def rechazar(i, error):
+        resultados[i].update(estado='error', error=error)
+
+    # --- 1. Validación de forma y permisos (sin consultas) ---
+    pendientes = []  # (index, venta_data, detalles_data)
+    vistos = {}
+    for i, item in enumerate(ventas_data):
+        if not isinstance(item, dict):
+            rechazar(i, "Formato de venta inválido")
+            continue
+        client_uuid = str(item.get('client_uuid') or '').strip().lower()
+        resultados[i]['client_uuid'] = client_uuid or None
+        try:
+            uuid.UUID(client_uuid)
+        except ValueError:
+            rechazar(i, "client_uuid inválido o faltante")
+            continue
+        if client_uuid in vistos:
+            resultados[i].update(estado='duplicada', duplicado_de_index=vistos[client_uuid])
+            continue
+        vistos[client_uuid] = i
+
+        detalles_data = item.get('detalles') or []
+        if not detalles_data or not all(
+            isinstance(d, dict) and d.get('presentacion_id') and d.get('cantidad') for d in detalles_data
+        ):
+            rechazar(i, "Cada venta debe tener detalles con presentacion_id y cantidad")
+            continue
+        try:
+            # Enteros desde aquí: el bloqueo de inventario del paso 3 usa estos ids
+            detalles_data = [
+                {**d, 'presentacion_id': _entero_estricto(d['presentacion_id']),
+                 'cantidad': _entero_estricto(d['cantidad'])}
+                for d in detalles_data
+            ]
+        except (TypeError, ValueError, OverflowError):
+            rechazar(i, "presentacion_id y cantidad deben ser enteros")
+            continue
+        try:
+            venta_data = venta_schema.load(
+                # El total lo calcula el servidor a partir de los detalles
+                {k: v for k, v in item.items() if k not in ('detalles', 'client_uuid', 'total')},
+                partial=("detalles", "total")
+            )
+        except ValidationError as e:
+            rechazar(i, e.messages)
+            continue
+        if claims.get('rol') != 'admin' and venta_data.almacen_id != claims.get('almacen_id'):
+            rechazar(i, "No tiene permiso para registrar ventas en este almacén")
+            continue
+        pendientes.append((i, client_uuid, venta_data, detalles_data))
+
+    # --- 2. UUID ya aplicados en envíos anteriores ---
+    if pendientes:
+        existentes = dict(db.session.query(Venta.client_uuid, Venta.id).filter(
+            Venta.client_uuid.in_([p[1] for p in pendientes])
+        ).all())
+        for i, client_uuid, _, _ in pendientes:
+            if client_uuid in existentes:
+                resultados[i].update(estado='duplicada', venta_id=existentes[client_uuid])
+        pendientes = [p for p in pendientes if p[1] not in existentes]
+
+    # --- 3. Clientes e inventario (bloqueado, en orden) en dos consultas ---
+    clientes = {c.id: c for c in Cliente.query.filter(
+        Cliente.id.in_({p[2].cliente_id for p in pendientes})
+    ).all()} if pendientes else {}
+    inventarios = {}
+    for inv in bloquear_inventarios(
+        (p[2].almacen_id, d['presentacion_id']) for p in pendientes for d in p[3]
+    ):
+        # Como en POST /ventas: se vende del inventario con lote de esa presentación
+        if inv.lote_id is not None:
+            inventarios.setdefault((inv.almacen_id, inv.presentacion_id), inv)
+    presentaciones = {p.id: p for p in PresentacionProducto.query.filter(
+        PresentacionProducto.id.in_({inv.presentacion_id for inv in inventarios.values()})
+    ).all()} if inventarios else {}
+
+    # --- 4. Asignar stock en orden de envío; una venta que no cabe se rechaza entera ---
+    disponible = {inv.id: inv.cantidad for inv in inventarios.values()}
+    aceptadas = []  # (index, Venta, Cliente)
+    for i, client_uuid, venta_data, detalles_data in pendientes:
+        cliente = clientes.get(venta_data.cliente_id)
+        if cliente is None:
+            rechazar(i, f"Cliente {venta_data.cliente_id} no encontrado")
+            continue
+        lineas, requerido, error = [], {}, None
+        for d in detalles_data:
+            try:
+                presentacion_id, cantidad = d['presentacion_id'], d['cantidad']
+                precio = Decimal(str(d['precio_unitario'])) if d.get('precio_unitario') is not None else None
+            except (TypeError, ValueError, InvalidOperation):
+                error = "Detalle con valores inválidos"
+                break
+            inventario = inventarios.get((venta_data.almacen_id, presentacion_id))
+            if cantidad <= 0:
+                error = f"La cantidad debe ser positiva. Presentación ID: {presentacion_id}"
+                break
+            if inventario is None:
+                error = f"No se encontró inventario con lote para la presentación {presentacion_id} en este almacén."
+                break
+            requerido[inventario.id] = requerido.get(inventario.id, 0) + cantidad
+            if disponible[inventario.id] < requerido[inventario.id]:
+                nombre = presentaciones[presentacion_id].nombre
+                error = f"Stock insuficiente para {nombre} (Disponible: {disponible[inventario.id]})"
+                break
+            if precio is None:
+                precio = Decimal(presentaciones[presentacion_id].precio_venta)
+            lineas.append((inventario, cantidad, precio))
+        if error:
+            rechazar(i, error)
+            continue
+        for inventario_id, cantidad in requerido.items():
+            disponible[inventario_id] -= cantidad
+
+        venta = Venta(
+            cliente_id=venta_data.cliente_id,
+            almacen_id=venta_data.almacen_id,
+            vendedor_id=claims.get('sub'),
+            total=sum((cantidad * precio for _, cantidad, precio in lineas), Decimal('0')),
+            tipo_pago=venta_data.tipo_pago,
+            fecha=venta_data.fecha,
+            consumo_diario_kg=venta_data.consumo_diario_kg,
+            client_uuid=client_uuid,
+            detalles=[
+                VentaDetalle(presentacion_id=inv.presentacion_id, cantidad=cantidad,
+                             precio_unitario=precio, lote_id=inv.lote_id)
+                for inv, cantidad, precio in lineas
+            ]
+        )
+        db.session.add(venta)
+        aceptadas.append((i, venta, cliente))
+
+    # --- 5. Un flush para todas las ventas, un UPDATE de stock y un INSERT de movimientos ---
+    if aceptadas:
+        db.session.flush()
+        cambios = [
+            CambioStock(venta.almacen_id, detalle.presentacion_id, detalle.lote_id, -detalle.cantidad, movimiento={
+                'venta_id': venta.id,
+                'motivo': f"Venta ID: {venta.id} - Cliente: {cliente.nombre} (Sincronizada)",
+            })
+            for _, venta, cliente in aceptadas for detalle in venta.detalles
+        ]
+        aplicar_cambios_stock(cambios, usuario_id=claims.get('sub'), tipo_operacion='venta')
+        db.session.commit()
+        for i, venta, _ in aceptadas:
+            resultados[i].update(estado='creada', venta_id=venta.id, total=str(venta.total))
+
+    resumen = {estado: sum(1 for r in resultados if r['estado'] == estado)
+               for estado in ('creada', 'duplicada', 'error')}
+    logger.info(f"Lote de ventas sincronizado: {resumen}")
+    return {"resultados": resultados, **resumen}, 200
+
+
 class VentaFormDataResource(Resource):
     @jwt_required()
     @handle_db_errors
@@ -352,12 +637,11 @@ class VentaFormDataResource(Resource):
                 dumped_presentacion['lote_id'] = lote.id if lote else None
                 dumped_presentacion['lote_descripcion'] = lote.descripcion if lote else "Sin lote asignado"
                 
-                # Generar URL pre-firmada para la foto
-                if presentacion.url_foto:
-                    dumped_presentacion['url_foto'] = get_presigned_url(presentacion.url_foto)
-                
                 presentaciones_data.append(dumped_presentacion)
 
+            # Firmar las fotos en lote (una firma por clave distinta); miniatura salvo ?foto=full
+            presign_payload(presentaciones_data, foto_variant=get_foto_variant())
+
             return {
                 "clientes": clientes_schema.dump(clientes),
                 "almacenes": almacenes_schema.dump(todos_almacenes),
@@ -369,12 +653,62 @@ class VentaFormDataResource(Resource):
             return {"error": "Error al obtener datos para el formulario de venta", "details": str(e)}, 500
 
 # VentaExportResource reescrita y optimizada
+VENTA_EXPORT_COLUMNS = [
+    ('ID', lambda v: v.id),
+    ('Fecha', lambda v: v.fecha.strftime('%Y-%m-%d %H:%M:%S') if v.fecha else ''),
+    ('Total', lambda v: float(v.total)),  # Decimal a float para Excel
+    ('Tipo de Pago', lambda v: v.tipo_pago),
+    ('Estado de Pago', lambda v: v.estado_pago),
+    ('Consumo Diario (kg)', lambda v: float(v.consumo_diario_kg) if v.consumo_diario_kg else None),
+    ('Cliente', lambda v: v.cliente.nombre if v.cliente else 'N/A'),
+    ('Teléfono Cliente', lambda v: v.cliente.telefono if v.cliente else 'N/A'),
+    ('Almacén', lambda v: v.almacen.nombre if v.almacen else 'N/A'),
+    ('Vendedor', lambda v: v.vendedor.username if v.vendedor else 'N/A'),
+    ('Cantidad de Items', lambda v: len(v.detalles)),
+    ('Productos', lambda v: ', '.join(f"{d.presentacion.nombre} (x{d.cantidad})" for d in v.detalles)),
+]
+
+def build_ventas_export(args, claims):
+    """
+    Consulta filtrada de ventas para exportar. `args` son los filtros de la
+    petición y `claims` los del JWT. Lanza ValueError si las fechas no son ISO 8601.
+    """
+    fecha_inicio = fecha_fin = None
+    if args.get('fecha_inicio') and args.get('fecha_fin'):
+        fecha_inicio = parse_iso_datetime(args['fecha_inicio'], add_timezone=True)
+        fecha_fin = parse_iso_datetime(args['fecha_fin'], add_timezone=True)
+
+    historico = fecha_inicio is not None and historico_alcanzado(Venta.fecha, fecha_inicio)
+    V = con_historico(Venta, historico)
+    query = db.session.query(V).options(*loader_options(VENTA_LOADERS, 'lista', V))
+
+    if claims.get('rol') != 'admin':
+        query = query.filter(V.vendedor_id == claims.get('sub'))
+    elif args.get('vendedor_id'):
+        query = query.filter(V.vendedor_id == args['vendedor_id'])
+
+    if args.get('cliente_id'):
+        query = query.filter(V.cliente_id == args['cliente_id'])
+    if args.get('almacen_id'):
+        query = query.filter(V.almacen_id == args['almacen_id'])
+    if args.get('estado_pago'):
+        statuses = [status.strip() for status in args['estado_pago'].split(',') if status.strip()]
+        if statuses:
+            query = query.filter(V.estado_pago.in_(statuses))
+
+    if fecha_inicio is not None:
+        query = query.filter(V.fecha.between(fecha_inicio, fecha_fin))
+
+    return ExportSpec('ventas', 'Ventas', query, VENTA_EXPORT_COLUMNS, [(V.fecha, True)], V.id,
+                      preparar=_cargar_hijos_historicos if historico else None)
+
 class VentaExportResource(Resource):
     @jwt_required()
     @handle_db_errors
     def get(self):
         """
-        Exporta ventas a Excel de forma optimizada.
+        Exporta ventas a Excel (o CSV con ?formato=csv) por bloques, con memoria constante.
+        Con ?async=true se genera en segundo plano (ver /exportaciones/<id>).
         """
         parser = reqparse.RequestParser()
         parser.add_argument('cliente_id', type=int, location='args')
@@ -385,89 +719,16 @@ class VentaExportResource(Resource):
         parser.add_argument('fecha_fin', type=str, location='args')
         args = parser.parse_args()
 
-        current_user_id = get_jwt().get('sub')
-        user_rol = get_jwt().get('rol')
-        is_admin = user_rol == 'admin'
-
         try:
-            # --- MEJORA 1: Carga ansiosa (Eager Loading) de relaciones ---
-            # Le decimos a SQLAlchemy que cargue todo en una sola vez.
-            query = Venta.query.options(
-                orm.joinedload(Venta.cliente),
-                orm.joinedload(Venta.almacen),
-                orm.joinedload(Venta.vendedor),
-                orm.selectinload(Venta.detalles).joinedload(VentaDetalle.presentacion)
-            )
+            spec = build_ventas_export(args, get_jwt())
+        except ValueError:
+            return {"error": "Formato de fecha inválido. Usa ISO 8601"}, 400
 
-            # (El resto de tu lógica de filtrado es correcta y se mantiene igual)
-            if not is_admin:
-                query = query.filter(Venta.vendedor_id == current_user_id)
-            elif args['vendedor_id']:
-                query = query.filter(Venta.vendedor_id == args['vendedor_id'])
-
-            if args['cliente_id']:
-                query = query.filter(Venta.cliente_id == args['cliente_id'])
-            if args['almacen_id']:
-                query = query.filter(Venta.almacen_id == args['almacen_id'])
-            if args['estado_pago']:
-                statuses = [status.strip() for status in args['estado_pago'].split(',') if status.strip()]
-                if statuses:
-                    query = query.filter(Venta.estado_pago.in_(statuses))
-
-            if args['fecha_inicio'] and args['fecha_fin']:
-                try:
-                    fecha_inicio = parse_iso_datetime(args['fecha_inicio'], add_timezone=True)
-                    fecha_fin = parse_iso_datetime(args['fecha_fin'], add_timezone=True)
-                    query = query.filter(Venta.fecha.between(fecha_inicio, fecha_fin))
-                except ValueError:
-                    return {"error": "Formato de fecha inválido. Usa ISO 8601"}, 400
-
-            ventas = query.order_by(desc(Venta.fecha)).all()
-
-            if not ventas:
-                return {"message": "No hay ventas para exportar con los filtros seleccionados"}, 404
-
-            # --- MEJORA 2: Construir los datos directamente ---
-            # Evitamos la serialización completa y los .apply() de Pandas.
-            # Esto es mucho más rápido.
-            data_para_excel = []
-            for venta in ventas:
-                # Concatenamos los nombres de los productos directamente
-                productos_str = ', '.join([
-                    f"{detalle.presentacion.nombre} (x{detalle.cantidad})"
-                    for detalle in venta.detalles
-                ])
-
-                data_para_excel.append({
-                    'ID': venta.id,
-                    'Fecha': venta.fecha.strftime('%Y-%m-%d %H:%M:%S'), # Formatear fecha
-                    'Total': float(venta.total), # Convertir Decimal a float para Excel
-                    'Tipo de Pago': venta.tipo_pago,
-                    'Estado de Pago': venta.estado_pago,
-                    'Consumo Diario (kg)': float(venta.consumo_diario_kg) if venta.consumo_diario_kg else None,
-                    'Cliente': venta.cliente.nombre if venta.cliente else 'N/A',
-                    'Teléfono Cliente': venta.cliente.telefono if venta.cliente else 'N/A',
-                    'Almacén': venta.almacen.nombre if venta.almacen else 'N/A',
-                    'Vendedor': venta.vendedor.username if venta.vendedor else 'N/A',
-                    'Cantidad de Items': len(venta.detalles),
-                    'Productos': productos_str
-                })
-
-            df = pd.DataFrame(data_para_excel)
-
-            output = io.BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Ventas')
-            
-            output.seek(0)
-
-            return send_file(
-                output,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name=f'ventas_{datetime.now().strftime("%Y%m%d")}.xlsx'
-            )
+        if request.args.get('async', 'false').lower() == 'true':
+            return submit_export_request('ventas', args)
 
+        try:
+            return export_response(spec, "No hay ventas para exportar con los filtros seleccionados")
         except Exception as e:
             logger.error(f"Error al exportar ventas: {str(e)}")
             return {"error": "Error interno al generar el archivo Excel"}, 500
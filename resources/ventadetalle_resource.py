@@ -4,7 +4,8 @@ from flask import request
 from models import Venta, VentaDetalle, Inventario, PresentacionProducto
 from schemas import venta_schema, ventas_schema, venta_detalle_schema
 from extensions import db
-from common import handle_db_errors, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin
+from common import handle_db_errors, retry_on_deadlock, MAX_ITEMS_PER_PAGE, mismo_almacen_o_admin
+from services.stock_service import CambioStock, StockInsuficienteError, aplicar_cambios_stock
 
 class VentaDetalleResource(Resource):
     @jwt_required()
@@ -16,6 +17,7 @@ class VentaDetalleResource(Resource):
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def post(self, venta_id):
         venta = Venta.query.get_or_404(venta_id)
         data = venta_detalle_schema.load(request.get_json())
@@ -27,10 +29,10 @@ class VentaDetalleResource(Resource):
             almacen_id=venta.almacen_id
         ).first()
         
-        if not inventario or inventario.cantidad < data["cantidad"]:
+        if not inventario:
             return {
                 "error": f"Stock insuficiente para {presentacion.nombre}",
-                "stock_disponible": inventario.cantidad if inventario else 0
+                "stock_disponible": 0
             }, 400
         
         # Crear detalle
@@ -38,14 +40,27 @@ class VentaDetalleResource(Resource):
             venta_id=venta_id,
             presentacion_id=presentacion.id,
             cantidad=data["cantidad"],
-            precio_unitario=presentacion.precio_venta
+            precio_unitario=presentacion.precio_venta,
+            lote_id=inventario.lote_id
         )
         
         # Actualizar venta y stock
         venta.total += nuevo_detalle.precio_unitario * nuevo_detalle.cantidad
-        inventario.cantidad -= nuevo_detalle.cantidad
-        
         db.session.add(nuevo_detalle)
+        try:
+            aplicar_cambios_stock(
+                [CambioStock(venta.almacen_id, presentacion.id, inventario.lote_id, -nuevo_detalle.cantidad)],
+                usuario_id=get_jwt().get('sub'),
+                motivo=f"Venta ID: {venta_id} - Detalle agregado",
+                tipo_operacion='venta',
+                venta_id=venta_id
+            )
+        except StockInsuficienteError as e:
+            db.session.rollback()
+            return {
+                "error": f"Stock insuficiente para {presentacion.nombre}",
+                "stock_disponible": e.faltantes[0]['disponible'] if e.faltantes else 0
+            }, 400
         db.session.commit()
         
         return venta_detalle_schema.dump(nuevo_detalle), 201
@@ -53,6 +68,7 @@ class VentaDetalleResource(Resource):
     @jwt_required()
     @mismo_almacen_o_admin
     @handle_db_errors
+    @retry_on_deadlock
     def delete(self, detalle_id):
         detalle = VentaDetalle.query.get_or_404(detalle_id)
         venta = detalle.venta
@@ -62,7 +78,14 @@ class VentaDetalleResource(Resource):
             presentacion_id=detalle.presentacion_id,
             almacen_id=venta.almacen_id
         ).first()
-        inventario.cantidad += detalle.cantidad
+        aplicar_cambios_stock(
+            [CambioStock(venta.almacen_id, detalle.presentacion_id, inventario.lote_id, detalle.cantidad,
+                         movimiento={'lote_id': detalle.lote_id})],
+            usuario_id=get_jwt().get('sub'),
+            motivo=f"Venta ID: {venta.id} - Detalle eliminado",
+            tipo_operacion='venta',
+            venta_id=venta.id
+        )
         
         # Actualizar total de la venta
         venta.total -= detalle.precio_unitario * detalle.cantidad
@@ -8,8 +8,21 @@ from models import (
 )
 from extensions import db
 from decimal import Decimal, InvalidOperation
+from sqlalchemy.orm import joinedload, selectinload
 import logging
 
+# ------------------------- PERFILES DE CARGA -------------------------
+# Cada esquema con relaciones anidadas declara, junto a su definición, qué
+# relaciones cargar de forma ansiosa según la forma de salida ('lista',
+# 'exportar', ...). Así el número de consultas de un listado no depende del
+# tamaño de página. Los perfiles son funciones porque algunas relaciones son
+# backrefs que solo existen una vez configurados los mappers. Reciben opcionalmente
+# las entidades consultadas, p. ej. un alias con el histórico (services/historico.py).
+
+def loader_options(profiles, profile='lista', *entidades):
+    """Opciones para query.options(*...) del perfil `profile`."""
+    return profiles[profile](*entidades)
+
 # ------------------------- ESQUEMAS BASE -------------------------
 class AlmacenSchema(SQLAlchemyAutoSchema):
     class Meta:
@@ -54,6 +67,7 @@ class PresentacionSchema(SQLAlchemyAutoSchema):
     precio_venta = fields.Decimal(as_string=True)
     capacidad_kg = fields.Decimal(as_string=True)
     foto_url = fields.String(dump_only=True)
+    foto_variantes = fields.Boolean(dump_only=True)  # Lo decide la subida de la foto
     
     class Meta:
         model = PresentacionProducto
@@ -139,7 +153,7 @@ class MovimientoSchema(SQLAlchemyAutoSchema):
         sqla_session = db.session
 
 class VentaDetalleSchema(SQLAlchemyAutoSchema):
-    presentacion = fields.Nested(PresentacionSchema, only=("id", "nombre", "precio_venta", "url_foto"))
+    presentacion = fields.Nested(PresentacionSchema, only=("id", "nombre", "precio_venta", "url_foto", "foto_variantes"))
     precio_unitario = fields.Decimal(as_string=True)
     total_linea = fields.Decimal(as_string=True, dump_only=True)
 
@@ -168,6 +182,17 @@ class VentaSchema(SQLAlchemyAutoSchema):
         include_fk = True 
         unknown = EXCLUDE
 
+# Muchos-a-uno con JOIN; colecciones con SELECT ... IN (no multiplican filas bajo LIMIT)
+VENTA_LOADERS = {
+    'lista': lambda V=Venta: (
+        joinedload(V.cliente),
+        joinedload(V.almacen),
+        joinedload(V.vendedor),
+        selectinload(V.pagos),  # ids en 'pagos' y saldo_pendiente
+        selectinload(V.detalles).joinedload(VentaDetalle.presentacion),
+    ),
+}
+
 class PagoSchema(SQLAlchemyAutoSchema):
     venta = fields.Nested(VentaSchema, only=("id", "total","cliente"), dump_only=True)
     usuario = fields.Nested(UserSchema, only=("id", "username"), dump_only=True)
@@ -183,6 +208,18 @@ class PagoSchema(SQLAlchemyAutoSchema):
         sqla_session = db.session 
         include_fk = True
 
+PAGO_LOADERS = {
+    'lista': lambda P=Pago, V=Venta: (
+        joinedload(P.venta.of_type(V)).joinedload(V.cliente),
+        joinedload(P.usuario),
+    ),
+    'exportar': lambda P=Pago, V=Venta: (
+        joinedload(P.venta.of_type(V)).joinedload(V.cliente),
+        joinedload(P.venta.of_type(V)).joinedload(V.almacen),
+        joinedload(P.usuario),
+    ),
+}
+
 class GastoSchema(SQLAlchemyAutoSchema):
     almacen = fields.Nested(AlmacenSchema, only=("id", "nombre"))
     usuario = fields.Nested(UserSchema, only=("id", "username"))
@@ -198,7 +235,7 @@ class GastoSchema(SQLAlchemyAutoSchema):
         include_fk = True
 
 class PedidoDetalleSchema(SQLAlchemyAutoSchema):
-    presentacion = fields.Nested(PresentacionSchema, only=("id", "nombre", "precio_venta", "url_foto"))
+    presentacion = fields.Nested(PresentacionSchema, only=("id", "nombre", "precio_venta", "url_foto", "foto_variantes"))
     precio_estimado = fields.Decimal(as_string=True)
 
     class Meta:
@@ -224,6 +261,15 @@ class PedidoSchema(SQLAlchemyAutoSchema):
         include_fk = True
         unknown = EXCLUDE
 
+PEDIDO_LOADERS = {
+    'lista': lambda: (
+        joinedload(Pedido.cliente),
+        joinedload(Pedido.almacen),
+        joinedload(Pedido.vendedor),
+        selectinload(Pedido.detalles).joinedload(PedidoDetalle.presentacion),  # también total_estimado
+    ),
+}
+
 class DepositoBancarioSchema(SQLAlchemyAutoSchema):
     almacen = fields.Nested(AlmacenSchema, only=("id", "nombre"))
     usuario = fields.Nested(UserSchema, only=("id", "username"))
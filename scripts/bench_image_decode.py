@@ -0,0 +1,116 @@
+"""
+Benchmark: decode completo vs. decode reducido (draft) de JPEG en el pipeline de imágenes.
+
+Uso:
+    python scripts/bench_image_decode.py [--dir fotos/] [--width 1920] [--quality 80]
+
+- "antes": Image.open + decode completo + LANCZOS a --width + WebP (pipeline anterior).
+- "después": transcode_image_to_webp (draft JPEG + orientación EXIF + sin metadatos).
+
+Cada conversión se ejecuta en un proceso nuevo para medir el pico de RSS
+(ru_maxrss) de forma aislada. Sin --dir se generan fotos sintéticas de
+4000x3000 (12 MP), del tamaño típico de un teléfono.
+"""
+import argparse
+import glob
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.append(os.getcwd())
+
+
+def _peak_rss_mb():
+    # ru_maxrss está en KB en Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_antes(path, width, quality):
+    from PIL import Image
+    img = Image.open(path)
+    img.load()
+    if img.width > width:
+        img = img.resize((width, int(img.height * width / img.width)), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img.convert('RGB').save(buffer, format='WEBP', quality=quality)
+    return buffer.tell()
+
+
+def _run_despues(path, width, quality):
+    from utils.file_handlers import transcode_image_to_webp
+    with open(path, 'rb') as f:
+        return len(transcode_image_to_webp(f, quality, width).getvalue())
+
+
+def _medir(modo, path, width, quality, queue):
+    # Importar antes de medir para que la carga de módulos no cuente
+    import PIL.Image  # noqa: F401
+    import utils.file_handlers  # noqa: F401
+    rss_base = _peak_rss_mb()
+    inicio = time.process_time()
+    size = (_run_antes if modo == 'antes' else _run_despues)(path, width, quality)
+    queue.put((time.process_time() - inicio, _peak_rss_mb() - rss_base, size))
+
+
+def medir(modo, path, width, quality):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_medir, args=(modo, path, width, quality, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _fotos_sinteticas(directorio, cantidad=5):
+    from PIL import Image
+    paths = []
+    for i in range(cantidad):
+        img = Image.effect_mandelbrot((4000, 3000), (-2.0 + i * 0.1, -1.2, 1.0, 1.2), 100).convert('RGB')
+        path = os.path.join(directorio, f"foto_{i}.jpg")
+        img.save(path, format='JPEG', quality=90)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', help='Directorio con fotos JPEG de ejemplo')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--quality', type=int, default=80)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.dir:
+            paths = sorted(glob.glob(os.path.join(args.dir, '*.jp*g')) + glob.glob(os.path.join(args.dir, '*.JP*G')))
+        else:
+            paths = _fotos_sinteticas(tmp)
+        if not paths:
+            print("No se encontraron JPEG")
+            return
+
+        total = {'antes': [0.0, 0.0], 'despues': [0.0, 0.0]}
+        print(f"{'foto':<28} {'CPU antes':>10} {'CPU desp.':>10} {'RSS antes':>10} {'RSS desp.':>10}")
+        for path in paths:
+            cpu_a, rss_a, _ = medir('antes', path, args.width, args.quality)
+            cpu_d, rss_d, _ = medir('despues', path, args.width, args.quality)
+            total['antes'][0] += cpu_a
+            total['antes'][1] += rss_a
+            total['despues'][0] += cpu_d
+            total['despues'][1] += rss_d
+            print(f"{os.path.basename(path)[:28]:<28} {cpu_a * 1000:>8.0f}ms {cpu_d * 1000:>8.0f}ms {rss_a:>8.1f}MB {rss_d:>8.1f}MB")
+
+        n = len(paths)
+        cpu_a, rss_a = total['antes'][0] / n, total['antes'][1] / n
+        cpu_d, rss_d = total['despues'][0] / n, total['despues'][1] / n
+        print(f"\nPromedio por imagen: CPU {cpu_a * 1000:.0f}ms -> {cpu_d * 1000:.0f}ms "
+              f"(ahorro {(cpu_a - cpu_d) * 1000:.0f}ms), pico RSS {rss_a:.1f}MB -> {rss_d:.1f}MB "
+              f"(ahorro {rss_a - rss_d:.1f}MB)")
+
+
+if __name__ == '__main__':
+    main()
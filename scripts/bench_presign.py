@@ -0,0 +1,77 @@
+"""
+Micro-benchmark: firma de URLs pre-firmadas con cliente S3 por llamada vs. cliente compartido.
+
+Uso:
+    python scripts/bench_presign.py [--keys 1000] [--region us-east-1] [--bucket demo-bucket] [--with-network]
+
+- "antes": replica el comportamiento anterior de get_s3_client(), que creaba un
+  cliente nuevo en cada llamada (y con --with-network, además hacía list_buckets()).
+- "después": un único cliente por proceso, como el get_s3_client() actual.
+
+La firma es local (no requiere red), así que sin --with-network el benchmark
+funciona con credenciales ficticias.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+import boto3
+
+from utils.file_handlers import _build_s3_client
+
+
+def _firmar(client, bucket, key):
+    return client.generate_presigned_url(
+        'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=3600
+    )
+
+
+def bench_antes(keys, region, bucket, with_network):
+    inicio = time.perf_counter()
+    for key in keys:
+        client = boto3.client('s3', region_name=region)
+        if with_network:
+            client.list_buckets()
+        _firmar(client, bucket, key)
+    return time.perf_counter() - inicio
+
+
+def bench_despues(keys, region, bucket, max_pool):
+    inicio = time.perf_counter()
+    client = _build_s3_client(region, max_pool)
+    for key in keys:
+        _firmar(client, bucket, key)
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--region', default=os.environ.get('AWS_REGION', 'us-east-1'))
+    parser.add_argument('--bucket', default=os.environ.get('S3_BUCKET', 'bench-bucket'))
+    parser.add_argument('--max-pool', type=int, default=10)
+    parser.add_argument('--with-network', action='store_true', help='Incluir list_buckets() por llamada en "antes"')
+    args = parser.parse_args()
+
+    if not args.with_network:
+        # Credenciales ficticias: generate_presigned_url no las valida contra AWS
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'AKIABENCHMARK000000')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark-secret')
+
+    keys = [f"presentaciones/foto_{i:05d}.webp" for i in range(args.keys)]
+
+    t_antes = bench_antes(keys, args.region, args.bucket, args.with_network)
+    t_despues = bench_despues(keys, args.region, args.bucket, args.max_pool)
+
+    print(f"Claves firmadas: {len(keys)}")
+    print(f"Antes   (cliente por llamada{' + list_buckets' if args.with_network else ''}): {t_antes:.3f} s  ({t_antes / len(keys) * 1000:.3f} ms/clave)")
+    print(f"Después (cliente compartido):  {t_despues:.3f} s  ({t_despues / len(keys) * 1000:.3f} ms/clave)")
+    if t_despues > 0:
+        print(f"Aceleración: x{t_antes / t_despues:.1f}")
+
+
+if __name__ == '__main__':
+    main()
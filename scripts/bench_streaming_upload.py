@@ -0,0 +1,114 @@
+"""
+Comprueba que la subida en streaming de PDFs usa memoria constante.
+
+Uso:
+    python scripts/bench_streaming_upload.py [--sizes 5,20,50] [--chunk-mb 8]
+
+Genera cuerpos multipart sintéticos (sin materializarlos en memoria), los pasa
+por parse_multipart_streaming con un cliente S3 que descarta las partes y mide
+el pico de memoria con tracemalloc. El pico debe quedar acotado por el tamaño
+de parte (S3_MULTIPART_CHUNK_SIZE) y no crecer con el tamaño del archivo;
+el script termina con código 1 si no es así.
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.append(os.getcwd())
+
+from utils.streaming_upload import parse_multipart_streaming, StreamedUpload
+
+BOUNDARY = b'----benchboundary7d2f'
+
+
+class DiscardingS3Client:
+    """Cliente mínimo con la interfaz de multipart upload que descarta los datos."""
+
+    def __init__(self):
+        self.parts = 0
+        self.bytes = 0
+
+    def create_multipart_upload(self, **kwargs):
+        return {'UploadId': 'bench'}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        self.parts += 1
+        self.bytes += len(Body)
+        return {'ETag': f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+
+class SyntheticMultipartStream:
+    """Stream de lectura que produce un multipart con un PDF de `size` bytes al vuelo."""
+
+    def __init__(self, size):
+        head = (
+            b'--' + BOUNDARY + b'\r\n'
+            b'Content-Disposition: form-data; name="venta_id"\r\n\r\n1\r\n'
+            b'--' + BOUNDARY + b'\r\n'
+            b'Content-Disposition: form-data; name="comprobante"; filename="recibo.pdf"\r\n'
+            b'Content-Type: application/pdf\r\n\r\n'
+        )
+        tail = b'\r\n--' + BOUNDARY + b'--\r\n'
+        self._segments = [(head, len(head)), (None, size), (tail, len(tail))]
+        self._index = 0
+        self._offset = 0
+
+    def read(self, n):
+        while self._index < len(self._segments):
+            data, length = self._segments[self._index]
+            remaining = length - self._offset
+            if remaining <= 0:
+                self._index += 1
+                self._offset = 0
+                continue
+            count = min(n, remaining)
+            chunk = data[self._offset:self._offset + count] if data is not None else b'%' * count
+            self._offset += count
+            return chunk
+        return b''
+
+
+def medir(size_bytes, part_size):
+    client = DiscardingS3Client()
+    stream = SyntheticMultipartStream(size_bytes)
+    tracemalloc.start()
+    form, uploaded = parse_multipart_streaming(
+        stream, BOUNDARY, 'comprobante', 'comprobantes', client, 'bench-bucket', part_size
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert isinstance(uploaded, StreamedUpload) and uploaded.size == size_bytes
+    assert client.bytes == size_bytes and form.get('venta_id') == '1'
+    return peak, client.parts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='5,20,50', help='Tamaños de PDF en MB, separados por coma')
+    parser.add_argument('--chunk-mb', type=int, default=8)
+    args = parser.parse_args()
+
+    part_size = args.chunk_mb * 1024 * 1024
+    picos = []
+    for size_mb in [int(s) for s in args.sizes.split(',')]:
+        peak, parts = medir(size_mb * 1024 * 1024, part_size)
+        picos.append(peak)
+        print(f"PDF {size_mb:>4} MB: pico {peak / 1024 / 1024:6.2f} MB, partes S3: {parts}")
+
+    # Margen: una parte en buffer + su copia al enviarla + bloques de lectura del decoder
+    limite = 2 * part_size + 1024 * 1024
+    if max(picos) > limite:
+        print(f"FALLO: el pico supera {limite / 1024 / 1024:.1f} MB")
+        sys.exit(1)
+    print(f"OK: pico máximo {max(picos) / 1024 / 1024:.2f} MB, independiente del tamaño del archivo")
+
+
+if __name__ == '__main__':
+    main()
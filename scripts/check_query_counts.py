@@ -0,0 +1,89 @@
+"""
+Verifica que los listados no hacen consultas N+1 al serializar.
+
+Uso:
+    python scripts/check_query_counts.py [--user-id 1] [--sizes 1,10,50,100]
+
+Llama a /ventas, /pagos y /pedidos con distintos per_page contra la base
+configurada (DATABASE_URL) y cuenta las sentencias SQL de cada petición.
+Con los perfiles de carga de schemas.py (VENTA_LOADERS, PAGO_LOADERS,
+PEDIDO_LOADERS) el número de consultas no debe depender del tamaño de página;
+el script termina con código 1 si varía. Necesita datos suficientes para
+llenar la página más grande.
+
+Los reportes sin paginar de MAX_CONSULTAS (p. ej. /inventario/reporte-global)
+deben resolverse en un número fijo de consultas sea cual sea el catálogo.
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from app import app
+from extensions import db
+
+ENDPOINTS = ('/ventas', '/pagos', '/pedidos')
+MAX_CONSULTAS = {
+    '/inventario/reporte-global': 2,
+    '/inventario/reporte-global?tipo=briqueta': 2,
+}
+
+
+def contar_consultas(engine, client, headers, url):
+    contador = {'n': 0}
+
+    def _contar(conn, cursor, statement, parameters, context, executemany):
+        contador['n'] += 1
+
+    event.listen(engine, 'before_cursor_execute', _contar)
+    try:
+        response = client.get(url, headers=headers)
+    finally:
+        event.remove(engine, 'before_cursor_execute', _contar)
+    if response.status_code != 200:
+        raise SystemExit(f"{url} respondió {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    datos = response.get_json()
+    return contador['n'], len(datos.get('data', []) if isinstance(datos, dict) else datos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user-id', default='1', help='ID de un usuario admin para el token')
+    parser.add_argument('--sizes', default='1,10,50,100')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    with app.app_context():
+        token = create_access_token(identity=str(args.user_id), additional_claims={'rol': 'admin', 'almacen_id': None})
+        # db.engine necesita contexto de aplicación; el listener se registra sobre el engine ya resuelto
+        engine = db.engine
+    headers = {'Authorization': f'Bearer {token}'}
+
+    fallos = 0
+    with app.test_client() as client:
+        for endpoint in ENDPOINTS:
+            conteos = []
+            for size in sizes:
+                consultas, filas = contar_consultas(engine, client, headers, f"{endpoint}?per_page={size}")
+                conteos.append(consultas)
+                print(f"{endpoint:<10} per_page={size:<4} filas={filas:<4} consultas={consultas}")
+            if len(set(conteos)) > 1:
+                fallos += 1
+                print(f"  ERROR: {endpoint} hace más consultas con páginas más grandes: {conteos}")
+
+        for url, maximo in MAX_CONSULTAS.items():
+            consultas, filas = contar_consultas(engine, client, headers, url)
+            print(f"{url:<40} filas={filas:<4} consultas={consultas}")
+            if consultas > maximo:
+                fallos += 1
+                print(f"  ERROR: {url} hace {consultas} consultas (máximo {maximo})")
+
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
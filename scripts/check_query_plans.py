@@ -0,0 +1,125 @@
+"""
+Verifica que las consultas de los endpoints principales usan índices.
+
+Uso:
+    python scripts/check_query_plans.py [--user-id 1]
+
+Contra una base local con datos (DATABASE_URL) y con migrations/indices_consultas.sql
+aplicado. Llama a los endpoints de consultas(), captura sus SELECT y los vuelve a
+planificar con EXPLAIN y enable_seqscan = off: así el planificador solo recurre a
+un Seq Scan si ningún índice sirve para la consulta, sea cual sea el tamaño de la
+tabla. Termina con código 1 si alguna consulta recorre entera una tabla de TABLAS.
+Los ids de los filtros se toman de la última venta, pago y movimiento.
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+
+from app import app
+from extensions import db
+from models import Movimiento, Pago, Venta
+
+TABLAS = {'ventas', 'venta_detalles', 'pagos', 'movimientos', 'users'}
+
+
+def consultas(venta, pago, movimiento):
+    """(método, url, cuerpo JSON) de cada petición a revisar."""
+    return [
+        ('GET', '/ventas', None),
+        ('GET', f'/ventas?almacen_id={venta.almacen_id}', None),
+        ('GET', f'/ventas?vendedor_id={venta.vendedor_id}', None),
+        ('GET', f'/ventas?cliente_id={venta.cliente_id}', None),
+        ('GET', '/ventas?estado_pago=pendiente,parcial', None),
+        ('GET', f'/ventas/{venta.id}', None),
+        ('GET', '/pagos', None),
+        ('GET', f'/pagos?venta_id={pago.venta_id}', None),
+        ('GET', f'/pagos?usuario_id={pago.usuario_id}', None),
+        ('GET', '/movimientos', None),
+        ('GET', f'/movimientos?presentacion_id={movimiento.presentacion_id}', None),
+        ('GET', f'/movimientos?lote_id={movimiento.lote_id}', None),
+        ('GET', '/dashboard', None),
+        ('POST', '/auth', {'username': 'usuario_inexistente', 'password': 'no-importa-123'}),
+    ]
+
+
+def capturar(engine, client, headers, metodo, url, cuerpo):
+    """Ejecuta la petición y devuelve los SELECT enviados (sentencia, parámetros)."""
+    capturadas = []
+
+    def _capturar(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            capturadas.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', _capturar)
+    try:
+        response = client.open(url, method=metodo, headers=headers, json=cuerpo)
+    finally:
+        event.remove(engine, 'before_cursor_execute', _capturar)
+    if response.status_code >= 500:
+        raise SystemExit(f"{metodo} {url} respondió {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    return capturadas
+
+
+def recorridos_secuenciales(plan):
+    """Tablas de TABLAS que el plan recorre con Seq Scan."""
+    tablas = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in TABLAS:
+        tablas.append(plan['Relation Name'])
+    for hijo in plan.get('Plans', []):
+        tablas.extend(recorridos_secuenciales(hijo))
+    return tablas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user-id', default='1', help='ID de un usuario admin para el token')
+    args = parser.parse_args()
+
+    with app.app_context():
+        token = create_access_token(identity=str(args.user_id), additional_claims={'rol': 'admin', 'almacen_id': None})
+        venta = Venta.query.order_by(Venta.id.desc()).first()
+        pago = Pago.query.order_by(Pago.id.desc()).first()
+        movimiento = Movimiento.query.filter(Movimiento.lote_id.isnot(None)).order_by(Movimiento.id.desc()).first()
+        if not (venta and pago and movimiento):
+            raise SystemExit("La base necesita al menos una venta, un pago y un movimiento con lote")
+        peticiones = consultas(venta, pago, movimiento)
+        engine = db.engine
+        db.session.remove()
+    headers = {'Authorization': f'Bearer {token}'}
+
+    fallos = 0
+    with app.test_client() as client:
+        for metodo, url, cuerpo in peticiones:
+            capturadas = capturar(engine, client, headers, metodo, url, cuerpo)
+            conexion = engine.raw_connection()
+            try:
+                cursor = conexion.cursor()
+                cursor.execute("SET enable_seqscan = off")
+                problemas = []
+                for statement, parameters in capturadas:
+                    cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                    plan = cursor.fetchone()[0]
+                    plan = json.loads(plan) if isinstance(plan, str) else plan
+                    tablas = recorridos_secuenciales(plan[0]['Plan'])
+                    if tablas:
+                        problemas.append((sorted(set(tablas)), statement))
+            finally:
+                conexion.rollback()
+                conexion.close()
+
+            print(f"{metodo:<4} {url:<45} consultas={len(capturadas):<3} seq_scans={len(problemas)}")
+            for tablas, statement in problemas:
+                fallos += 1
+                print(f"  ERROR: Seq Scan en {', '.join(tablas)}: {' '.join(statement.split())[:300]}")
+
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
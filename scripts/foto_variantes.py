@@ -0,0 +1,114 @@
+"""
+Backfill de variantes (thumb/medium) para las fotos de presentaciones existentes.
+
+Uso:
+    flask backfill-foto-variantes [--workers 8] [--force] [--dry-run]
+
+Para cada `url_foto` descarga la imagen completa, genera las variantes con
+transcode_image_variants y las sube bajo sus claves predecibles (variant_key).
+Las claves que ya tienen todas sus variantes se omiten salvo con --force.
+Las presentaciones cuyas variantes quedan disponibles se marcan con
+foto_variantes = true para que los listados firmen la miniatura.
+"""
+import io
+import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import ClientError
+from flask import current_app
+from flask.cli import with_appcontext
+
+from extensions import db
+from models import PresentacionProducto
+from utils.file_handlers import (
+    IMAGE_VARIANTS, get_s3_client, variant_key, transcode_image_variants,
+    invalidate_presigned_url
+)
+
+# Variantes derivadas: la 'full' ya es el objeto original
+DERIVED_VARIANTS = {name: width for name, width in IMAGE_VARIANTS.items() if name != 'full'}
+
+
+def _existe(s3_client, bucket_name, key):
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def _procesar_clave(s3_client, bucket_name, key, force, dry_run):
+    """Genera y sube las variantes de una clave. Devuelve 'creada', 'omitida' o 'simulada'."""
+    if not force and all(_existe(s3_client, bucket_name, variant_key(key, v)) for v in DERIVED_VARIANTS):
+        return 'omitida'
+    if dry_run:
+        return 'simulada'
+
+    original = io.BytesIO()
+    s3_client.download_fileobj(bucket_name, key, original)
+    original.seek(0)
+    buffers = transcode_image_variants(original, variants=DERIVED_VARIANTS)
+    for name, buffer in buffers.items():
+        derived_key = variant_key(key, name)
+        s3_client.upload_fileobj(buffer, bucket_name, derived_key, ExtraArgs={'ContentType': 'image/webp'})
+        invalidate_presigned_url(derived_key)
+    return 'creada'
+
+
+@click.command('backfill-foto-variantes')
+@click.option('--workers', default=8, show_default=True, help='Claves procesadas en paralelo.')
+@click.option('--force', is_flag=True, help='Regenerar aunque las variantes ya existan.')
+@click.option('--dry-run', is_flag=True, help='Solo informar qué claves se procesarían.')
+@with_appcontext
+def backfill_foto_variantes_command(workers, force, dry_run):
+    """Genera variantes thumb/medium para las url_foto existentes."""
+    s3_client = get_s3_client()
+    bucket_name = current_app.config.get('S3_BUCKET')
+    if not s3_client or not bucket_name:
+        raise click.ClickException("Configuración S3 incompleta (cliente o bucket).")
+
+    claves = [
+        row.url_foto for row in
+        db.session.query(PresentacionProducto.url_foto)
+        .filter(PresentacionProducto.url_foto.isnot(None), PresentacionProducto.url_foto != '')
+        .distinct()
+    ]
+    # Toda imagen subida se guarda como WebP; el resto (PDF) no tiene variantes
+    claves = [k for k in claves if k.lower().endswith('.webp')]
+    click.echo(f"Claves a revisar: {len(claves)} (workers={workers}{', dry-run' if dry_run else ''})")
+
+    resumen = {'creada': 0, 'omitida': 0, 'simulada': 0, 'error': 0}
+    con_variantes = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_procesar_clave, s3_client, bucket_name, key, force, dry_run): key
+            for key in claves
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                resultado = future.result()
+                resumen[resultado] += 1
+                if resultado in ('creada', 'omitida'):
+                    con_variantes.append(key)
+            except Exception as e:
+                resumen['error'] += 1
+                click.echo(f"  Error en {key}: {e}", err=True)
+
+    if con_variantes:
+        marcadas = PresentacionProducto.query.filter(
+            PresentacionProducto.url_foto.in_(con_variantes),
+            PresentacionProducto.foto_variantes.is_(False)
+        ).update({PresentacionProducto.foto_variantes: True}, synchronize_session=False)
+        db.session.commit()
+        click.echo(f"Presentaciones marcadas con variantes: {marcadas}")
+
+    click.echo(
+        f"Variantes creadas: {resumen['creada']}, omitidas: {resumen['omitida']}, "
+        f"simuladas: {resumen['simulada']}, errores: {resumen['error']}"
+    )
+
+
+def add_commands(app):
+    app.cli.add_command(backfill_foto_variantes_command)
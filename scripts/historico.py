@@ -0,0 +1,90 @@
+"""
+Archivo histórico de ventas pagadas antiguas.
+
+Uso:
+    flask archivar-ventas [--meses 18] [--chunk-size 500] [--dry-run] [--verificar]
+
+Mueve a ventas_historico / venta_detalles_historico / pagos_historico /
+movimientos_historico (migrations/historico.sql) las ventas pagadas con fecha
+anterior a now() - meses, con sus detalles, pagos y movimientos. Una
+transacción por bloque; las ventas bloqueadas por otra operación se saltan y
+quedan para la siguiente ejecución. Conviene correr antes
+`flask backfill-movimientos-origen` para que los movimientos antiguos tengan venta_id.
+
+Con --verificar compara, antes y después, los totales de las tablas (actual +
+histórico) y el resumen financiero sin filtros; termina con error si cambian.
+Solo es concluyente si no hay escrituras mientras corre.
+"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func
+
+from extensions import db
+from models import Movimiento, Pago, Venta, VentaDetalle
+from services.historico import archivar_bloque, con_historico, corte_historico
+
+
+def _totales():
+    V = con_historico(Venta)
+    D = con_historico(VentaDetalle)
+    P = con_historico(Pago)
+    M = con_historico(Movimiento)
+    totales = {
+        'ventas': tuple(db.session.query(func.count(V.id), func.coalesce(func.sum(V.total), 0)).one()),
+        'venta_detalles': tuple(db.session.query(
+            func.count(D.id), func.coalesce(func.sum(D.cantidad * D.precio_unitario), 0)).one()),
+        'pagos': tuple(db.session.query(func.count(P.id), func.coalesce(func.sum(P.monto), 0)).one()),
+        'movimientos': tuple(db.session.query(func.count(M.id), func.coalesce(func.sum(M.cantidad), 0)).one()),
+    }
+    from resources.reporte_financiero_resource import _calcular_resumen_financiero
+    totales['resumen_financiero'] = _calcular_resumen_financiero(None, None, None, None)['formatted']
+    db.session.rollback()
+    return totales
+
+
+@click.command('archivar-ventas')
+@click.option('--meses', type=int, default=None, help='Antigüedad mínima (por defecto HISTORICO_MESES).')
+@click.option('--chunk-size', default=500, show_default=True, help='Ventas por bloque/transacción.')
+@click.option('--dry-run', is_flag=True, help='Solo contar las ventas que se archivarían.')
+@click.option('--verificar', is_flag=True, help='Comparar totales antes y después.')
+@with_appcontext
+def archivar_ventas_command(meses, chunk_size, dry_run, verificar):
+    """Mueve al histórico las ventas pagadas antiguas."""
+    meses = meses or current_app.config.get('HISTORICO_MESES', 18)
+    corte = corte_historico(meses)
+    click.echo(f"Archivando ventas pagadas anteriores a {corte.isoformat()}")
+
+    if dry_run:
+        pendientes = Venta.query.filter(Venta.estado_pago == 'pagado', Venta.fecha < corte).count()
+        click.echo(f"Ventas a archivar: {pendientes}")
+        return
+
+    antes = _totales() if verificar else None
+    ultimo_id = 0
+    resumen = {}
+    while True:
+        ultimo_id, movidas = archivar_bloque(corte, ultimo_id, chunk_size)
+        if ultimo_id is None:
+            db.session.rollback()
+            break
+        db.session.commit()
+        for tabla, filas in movidas.items():
+            resumen[tabla] = resumen.get(tabla, 0) + filas
+        click.echo(f"  Hasta venta {ultimo_id}: {movidas['ventas']} ventas, {movidas['pagos']} pagos, "
+                   f"{movidas['movimientos']} movimientos")
+
+    click.echo("Archivadas: " + (", ".join(f"{tabla}={filas}" for tabla, filas in resumen.items()) or "nada"))
+
+    if verificar:
+        despues = _totales()
+        diferencias = [clave for clave in antes if antes[clave] != despues[clave]]
+        for clave in diferencias:
+            click.echo(f"  DIFERENCIA en {clave}: antes {antes[clave]}, después {despues[clave]}", err=True)
+        if diferencias:
+            raise click.ClickException("Los totales cambiaron al archivar")
+        click.echo("Totales verificados: sin diferencias")
+
+
+def add_commands(app):
+    app.cli.add_command(archivar_ventas_command)
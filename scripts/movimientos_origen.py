@@ -0,0 +1,105 @@
+"""
+Backfill de venta_id / pedido_id / ensamblaje_id en movimientos existentes.
+
+Uso:
+    flask backfill-movimientos-origen [--chunk-size 5000] [--dry-run]
+
+Antes de migrations/movimientos_origen.sql el origen de un movimiento solo
+quedaba en el texto de `motivo`:
+    "Venta ID: 123 - Cliente: ..."            -> venta_id=123
+    "Venta ID: 123 - ... (desde pedido 45)"   -> venta_id=123, pedido_id=45
+    "Ensamblaje <uuid>: ..."                  -> ensamblaje_id=<uuid>
+Recorre la tabla por id en bloques (una transacción por bloque) y solo toca
+filas que aún no tienen origen. Las ventas/pedidos que ya no existen se omiten.
+"""
+import re
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import or_, update
+
+from extensions import db
+from models import Movimiento, Pedido, Venta
+
+VENTA_RE = re.compile(r'^Venta ID: (\d+)\b')
+PEDIDO_RE = re.compile(r'\(desde pedido (\d+)\)')
+ENSAMBLAJE_RE = re.compile(r'^Ensamblaje ([0-9a-fA-F-]{36}):')
+
+
+def parse_motivo(motivo):
+    """Devuelve {venta_id, pedido_id, ensamblaje_id} deducidos de `motivo` (solo los encontrados)."""
+    origen = {}
+    if not motivo:
+        return origen
+    if m := VENTA_RE.match(motivo):
+        origen['venta_id'] = int(m.group(1))
+        if p := PEDIDO_RE.search(motivo):
+            origen['pedido_id'] = int(p.group(1))
+    elif m := ENSAMBLAJE_RE.match(motivo):
+        origen['ensamblaje_id'] = m.group(1).lower()
+    return origen
+
+
+def _existentes(model, ids):
+    if not ids:
+        return set()
+    return {row.id for row in db.session.query(model.id).filter(model.id.in_(ids))}
+
+
+@click.command('backfill-movimientos-origen')
+@click.option('--chunk-size', default=5000, show_default=True, help='Movimientos por bloque/transacción.')
+@click.option('--dry-run', is_flag=True, help='Solo contar lo que se actualizaría.')
+@with_appcontext
+def backfill_movimientos_origen_command(chunk_size, dry_run):
+    """Rellena las columnas de origen de movimientos a partir de `motivo`."""
+    ultimo_id = 0
+    resumen = {'revisados': 0, 'actualizados': 0, 'huerfanos': 0}
+    while True:
+        filas = (
+            db.session.query(Movimiento.id, Movimiento.motivo)
+            .filter(
+                Movimiento.id > ultimo_id,
+                Movimiento.venta_id.is_(None),
+                Movimiento.ensamblaje_id.is_(None),
+                or_(Movimiento.motivo.like('Venta ID: %'), Movimiento.motivo.like('Ensamblaje %')),
+            )
+            .order_by(Movimiento.id)
+            .limit(chunk_size)
+            .all()
+        )
+        if not filas:
+            break
+        ultimo_id = filas[-1].id
+        resumen['revisados'] += len(filas)
+
+        origenes = {fila.id: parse_motivo(fila.motivo) for fila in filas}
+        ventas = _existentes(Venta, {o['venta_id'] for o in origenes.values() if 'venta_id' in o})
+        pedidos = _existentes(Pedido, {o['pedido_id'] for o in origenes.values() if 'pedido_id' in o})
+
+        cambios = []
+        for mov_id, origen in origenes.items():
+            if 'venta_id' in origen and origen['venta_id'] not in ventas:
+                resumen['huerfanos'] += 1
+                continue
+            if 'pedido_id' in origen and origen['pedido_id'] not in pedidos:
+                origen.pop('pedido_id')
+            if origen:
+                cambios.append({'id': mov_id, 'venta_id': None, 'pedido_id': None,
+                                'ensamblaje_id': None, **origen})
+
+        if cambios and not dry_run:
+            # UPDATE ... WHERE id = :id en un solo executemany por bloque
+            db.session.execute(update(Movimiento), cambios)
+            db.session.commit()
+        else:
+            db.session.rollback()
+        resumen['actualizados'] += len(cambios)
+        click.echo(f"  Hasta id {ultimo_id}: {len(cambios)} de {len(filas)} movimientos")
+
+    click.echo(
+        f"Revisados: {resumen['revisados']}, {'a actualizar' if dry_run else 'actualizados'}: "
+        f"{resumen['actualizados']}, venta inexistente: {resumen['huerfanos']}"
+    )
+
+
+def add_commands(app):
+    app.cli.add_command(backfill_movimientos_origen_command)
@@ -0,0 +1,43 @@
+"""
+Verificación y reconstrucción de stock_resumen.
+
+Uso:
+    flask reconstruir-stock-resumen [--solo-verificar]
+
+Compara stock_resumen (services/stock_resumen.py) con la suma de inventario
+por (presentacion, almacen) y lista las diferencias. Sin --solo-verificar
+reconstruye la tabla en una transacción; con --solo-verificar termina con
+error si hay diferencias (útil en un cron de control).
+"""
+import click
+from flask.cli import with_appcontext
+
+from extensions import db
+from services import stock_resumen
+
+
+@click.command('reconstruir-stock-resumen')
+@click.option('--solo-verificar', is_flag=True, help='Solo listar diferencias, sin reconstruir.')
+@with_appcontext
+def reconstruir_stock_resumen_command(solo_verificar):
+    """Compara stock_resumen con inventario y lo reconstruye."""
+    diferencias = stock_resumen.diferencias()
+    for fila in diferencias:
+        click.echo(f"  Presentación {fila.presentacion_id}, almacén {fila.almacen_id}: "
+                   f"unidades {fila.actual} (esperado {fila.esperado}), "
+                   f"stock mínimo {fila.stock_minimo_actual} (esperado {fila.stock_minimo_esperado})")
+    click.echo(f"Diferencias: {len(diferencias)}")
+
+    if solo_verificar:
+        db.session.rollback()
+        if diferencias:
+            raise click.ClickException("stock_resumen no coincide con inventario")
+        return
+
+    filas = stock_resumen.reconstruir()
+    db.session.commit()
+    click.echo(f"stock_resumen reconstruido: {filas} pares")
+
+
+def add_commands(app):
+    app.cli.add_command(reconstruir_stock_resumen_command)
@@ -0,0 +1,171 @@
+"""
+Prueba de concurrencia del descuento de stock.
+
+Uso (¡solo contra una base de pruebas: modifica inventario y crea ventas!):
+    python scripts/stress_stock.py --inventario-id 12 --cliente-id 3 --confirmar
+        [--stock 50] [--ventas 200] [--threads 16] [--almacen-destino 2] [--limpiar]
+
+Pone el inventario indicado en --stock unidades y lanza --ventas peticiones
+POST /ventas de 1 unidad desde --threads hilos a la vez. Con --almacen-destino
+intercala transferencias de ida y vuelta entre ambos almacenes, que compiten
+por las mismas filas en orden inverso.
+
+Comprueba que:
+- no se vende más de lo que había (ventas aceptadas <= stock inicial),
+- el stock final cuadra: inicial - vendidas == final (sumando ambos almacenes),
+- ninguna petición terminó en 5xx (un deadlock no reintentado sería un 500).
+Informa también cuántos reintentos hizo retry_on_deadlock. Termina con código
+1 si alguna comprobación falla. Con --limpiar elimina las ventas creadas
+(DELETE /ventas/<id>, que devuelve el stock). Ajusta DEFAULT_RATE_LIMIT para
+que el limitador no corte la prueba con 429.
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+
+sys.path.append(os.getcwd())
+
+from flask_jwt_extended import create_access_token
+
+from app import app
+from extensions import db
+from models import Inventario
+
+
+class ContadorReintentos(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        if 'Conflicto de concurrencia' in record.getMessage():
+            with self._lock:
+                self.total += 1
+
+
+def stock_total(presentacion_id, almacenes):
+    return db.session.query(db.func.coalesce(db.func.sum(Inventario.cantidad), 0)).filter(
+        Inventario.presentacion_id == presentacion_id,
+        Inventario.almacen_id.in_(almacenes)
+    ).scalar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inventario-id', type=int, required=True, help='Inventario (con lote) a vender')
+    parser.add_argument('--cliente-id', type=int, required=True)
+    parser.add_argument('--user-id', default='1', help='ID de un usuario admin para el token')
+    parser.add_argument('--stock', type=int, default=50)
+    parser.add_argument('--ventas', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--almacen-destino', type=int, help='Intercalar transferencias con este almacén')
+    parser.add_argument('--limpiar', action='store_true', help='Eliminar las ventas creadas al terminar')
+    parser.add_argument('--confirmar', action='store_true', help='Confirma que la base es de pruebas')
+    args = parser.parse_args()
+    if not args.confirmar:
+        raise SystemExit("Este script modifica datos: ejecútalo con --confirmar contra una base de pruebas")
+
+    reintentos = ContadorReintentos()
+    logging.getLogger('common').addHandler(reintentos)
+
+    with app.app_context():
+        inventario = db.session.get(Inventario, args.inventario_id)
+        if inventario is None or inventario.lote_id is None:
+            raise SystemExit("El inventario no existe o no tiene lote asignado")
+        almacen_id, presentacion_id = inventario.almacen_id, inventario.presentacion_id
+        inventario.cantidad = args.stock
+        db.session.commit()
+        almacenes = [almacen_id] + ([args.almacen_destino] if args.almacen_destino else [])
+        stock_inicial = Decimal(stock_total(presentacion_id, almacenes))
+        token = create_access_token(identity=str(args.user_id),
+                                    additional_claims={'rol': 'admin', 'almacen_id': almacen_id})
+    headers = {'Authorization': f'Bearer {token}'}
+
+    venta_payload = {
+        "cliente_id": args.cliente_id,
+        "almacen_id": almacen_id,
+        "tipo_pago": "contado",
+        "fecha": datetime.now(timezone.utc).isoformat(),
+        "detalles": [{"presentacion_id": presentacion_id, "cantidad": 1}],
+    }
+    resultados = {'vendidas': [], 'sin_stock': 0, 'transferencias': 0, 'errores': []}
+    lock = threading.Lock()
+    local = threading.local()
+
+    def cliente():
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        return local.client
+
+    def vender(_):
+        response = cliente().post('/ventas', json=venta_payload, headers=headers)
+        with lock:
+            if response.status_code == 201:
+                resultados['vendidas'].append(response.get_json()['id'])
+            elif response.status_code == 400:
+                resultados['sin_stock'] += 1
+            else:
+                resultados['errores'].append((response.status_code, response.get_data(as_text=True)[:200]))
+
+    def transferir(i):
+        origen, destino = (almacen_id, args.almacen_destino) if i % 2 == 0 else (args.almacen_destino, almacen_id)
+        response = cliente().post('/inventario/transferir', headers=headers, json={
+            "almacen_origen_id": origen,
+            "almacen_destino_id": destino,
+            "transferencias": [{"presentacion_id": presentacion_id, "cantidad": "1"}],
+        })
+        with lock:
+            if response.status_code == 200:
+                resultados['transferencias'] += 1
+            elif response.status_code != 400:
+                resultados['errores'].append((response.status_code, response.get_data(as_text=True)[:200]))
+
+    tareas = [(vender, i) for i in range(args.ventas)]
+    if args.almacen_destino:
+        # Una transferencia cada tres ventas, alternando el sentido
+        for i in range(args.ventas // 3):
+            tareas.insert(i * 4, (transferir, i))
+
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(lambda tarea: tarea[0](tarea[1]), tareas))
+
+    with app.app_context():
+        stock_final = Decimal(stock_total(presentacion_id, almacenes))
+        negativos = Inventario.query.filter(
+            Inventario.presentacion_id == presentacion_id, Inventario.cantidad < 0
+        ).count()
+
+    vendidas = len(resultados['vendidas'])
+    print(f"Stock inicial: {stock_inicial}  vendidas: {vendidas}  sin stock: {resultados['sin_stock']}  "
+          f"transferencias: {resultados['transferencias']}  stock final: {stock_final}  "
+          f"reintentos por deadlock: {reintentos.total}")
+
+    fallos = []
+    if vendidas > stock_inicial:
+        fallos.append(f"sobreventa: {vendidas} ventas con {stock_inicial} unidades")
+    if stock_inicial - vendidas != stock_final:
+        fallos.append(f"el stock no cuadra: {stock_inicial} - {vendidas} != {stock_final}")
+    if negativos:
+        fallos.append(f"{negativos} filas de inventario en negativo")
+    if resultados['errores']:
+        fallos.append(f"{len(resultados['errores'])} respuestas con error, p. ej. {resultados['errores'][0]}")
+
+    if args.limpiar:
+        with app.test_client() as client:
+            for venta_id in resultados['vendidas']:
+                client.delete(f'/ventas/{venta_id}', headers=headers)
+        print(f"Eliminadas {vendidas} ventas de prueba")
+
+    for fallo in fallos:
+        print(f"  ERROR: {fallo}")
+    sys.exit(1 if fallos else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import hashlib
+import logging
+
+from sqlalchemy import delete, exists, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import ArchivoContenido, Pago, PresentacionProducto, pagos_historico
+from services.s3_delete_queue import queue_delete
+from utils.streaming_upload import StreamedUpload
+from utils.upload_worker import mark_upload_completed, save_file_async
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def clave_referenciada(s3_key):
+    """True si algún pago o presentación apunta a la clave (su subida no falló)."""
+    return db.session.query(or_(
+        exists().where(Pago.url_comprobante == s3_key),
+        exists().where(PresentacionProducto.url_foto == s3_key),
+    )).scalar()
+
+
+def limpiar_referencias_fallidas(s3_key):
+    """
+    Quita la clave de los pagos y presentaciones que la usan y su fila de
+    archivos_contenido cuando la subida en segundo plano falló. Va en su propia
+    transacción: se llama desde el callback del pool, fuera de la petición.
+    """
+    with db.engine.begin() as conn:
+        pagos = conn.execute(
+            update(Pago.__table__).where(Pago.__table__.c.url_comprobante == s3_key).values(url_comprobante=None)
+        ).rowcount
+        presentaciones = conn.execute(
+            update(PresentacionProducto.__table__).where(PresentacionProducto.__table__.c.url_foto == s3_key)
+            .values(url_foto=None, foto_variantes=False)
+        ).rowcount
+        conn.execute(delete(ArchivoContenido.__table__).where(ArchivoContenido.__table__.c.s3_key == s3_key))
+    if pagos or presentaciones:
+        logger.warning(f"Subida fallida de {s3_key}: referencia eliminada en {pagos} pagos y {presentaciones} presentaciones")
+
+
+def hash_file(file):
+    """SHA-256 del contenido original de un FileStorage, leyendo por bloques. Deja el stream al inicio."""
+    digest = hashlib.sha256()
+    stream = file.stream
+    stream.seek(0)
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class ArchivoService:
+    """
+    Comprobantes direccionados por contenido: un mismo archivo se guarda una vez
+    y su fila en archivos_contenido cuenta cuántos pagos lo referencian.
+    """
+
+    @staticmethod
+    def store(file, subfolder, refs=1):
+        """
+        Guarda `file` o reutiliza la clave S3 de un archivo idéntico ya subido.
+        Suma `refs` referencias. Devuelve (s3_key, creado); `creado` indica si se
+        subió un objeto nuevo (el llamador lo elimina si la operación falla).
+        """
+        sha256 = file.sha256 if isinstance(file, StreamedUpload) else hash_file(file)
+
+        existente = ArchivoContenido.query.filter_by(sha256=sha256).with_for_update().first()
+        if existente:
+            existente.ref_count += refs
+            if isinstance(file, StreamedUpload):
+                # Ya se subió durante el parseo: descartar la copia duplicada
+                queue_delete(file.s3_key)
+            logger.info(f"Comprobante duplicado, se reutiliza {existente.s3_key}")
+            mark_upload_completed(existente.s3_key)
+            return existente.s3_key, False
+
+        s3_key = save_file_async(file, subfolder)
+        if not s3_key:
+            return None, False
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(ArchivoContenido(sha256=sha256, s3_key=s3_key, ref_count=refs))
+        except IntegrityError:
+            # Otra petición registró el mismo contenido en paralelo: usar su clave
+            queue_delete(s3_key)
+            existente = ArchivoContenido.query.filter_by(sha256=sha256).with_for_update().one()
+            existente.ref_count += refs
+            mark_upload_completed(existente.s3_key)
+            return existente.s3_key, False
+        return s3_key, True
+
+    @staticmethod
+    def retain(s3_key, refs=1):
+        """Suma referencias a una clave ya registrada (p. ej. al asignarla a más pagos)."""
+        if not s3_key or refs <= 0:
+            return
+        archivo = ArchivoContenido.query.filter_by(s3_key=s3_key).with_for_update().first()
+        if archivo:
+            archivo.ref_count += refs
+        else:
+            db.session.add(ArchivoContenido(s3_key=s3_key, ref_count=refs))
+
+    @staticmethod
+    def release(s3_key, exclude_pago_id=None):
+        """
+        Resta una referencia y borra el objeto de S3 cuando ya nadie lo usa.
+        Las claves sin fila (anteriores a la migración) se cuentan en pagos.
+        """
+        if not s3_key:
+            return
+        archivo = ArchivoContenido.query.filter_by(s3_key=s3_key).with_for_update().first()
+        if archivo is None:
+            otros = db.session.query(Pago.id).filter(
+                Pago.url_comprobante == s3_key, Pago.id != exclude_pago_id
+            ).first()
+            if otros is None:
+                # Pagos de ventas archivadas (services/historico.py)
+                otros = db.session.query(pagos_historico.c.id).filter(
+                    pagos_historico.c.url_comprobante == s3_key
+                ).first()
+            if otros is None:
+                queue_delete(s3_key)
+            return
+
+        archivo.ref_count -= 1
+        if archivo.ref_count <= 0:
+            db.session.delete(archivo)
+            queue_delete(s3_key)
+
+    @staticmethod
+    def discard_if_unused(s3_key):
+        """Elimina la fila y el objeto de una clave recién guardada que terminó sin referencias."""
+        archivo = ArchivoContenido.query.filter_by(s3_key=s3_key).with_for_update().first()
+        if archivo and archivo.ref_count <= 0:
+            db.session.delete(archivo)
+            queue_delete(s3_key)
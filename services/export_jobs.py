@@ -0,0 +1,328 @@
+"""
+Exportaciones en segundo plano.
+
+Con ?async=true los endpoints /exportar registran un ExportJob y responden
+202 de inmediato. Un pool de hilos por proceso genera el archivo con el motor
+de utils/export_engine.py y lo guarda en S3 (o en disco si S3 no está
+configurado). El cliente consulta /exportaciones/<id> hasta obtener el enlace
+de descarga. Los resultados vencen a los EXPORT_RESULT_TTL_SECONDS y un hilo
+en segundo plano los elimina.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app, url_for
+from flask_jwt_extended import get_jwt
+from werkzeug.utils import get_content_type
+
+from extensions import db
+from models import ExportJob, Users
+from services.s3_delete_queue import queue_delete
+from utils.export_engine import (
+    FORMATOS, ExportCancelled, export_filename, get_export_format, write_csv, write_xlsx
+)
+from utils.file_handlers import get_presigned_url, get_s3_client
+
+logger = logging.getLogger(__name__)
+
+ESTADO_PENDIENTE = 'pendiente'
+ESTADO_PROCESANDO = 'procesando'
+ESTADO_COMPLETADO = 'completado'
+ESTADO_ERROR = 'error'
+ESTADO_CANCELADO = 'cancelado'
+ESTADO_EXPIRADO = 'expirado'
+ESTADOS_ACTIVOS = (ESTADO_PENDIENTE, ESTADO_PROCESANDO)
+
+S3_PREFIX = 'exportaciones'
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_futures = {}
+_cleanup_thread = None
+
+
+class ExportJobLimitError(Exception):
+    """El usuario ya tiene el máximo de exportaciones en curso."""
+    pass
+
+
+def _builders():
+    # Import diferido: cada constructor vive junto a su recurso, que a su vez importa este módulo
+    from resources.venta_resource import build_ventas_export
+    from resources.pago_resource import build_pagos_export
+    from resources.gasto_resource import build_gastos_export
+    from resources.cliente_resource import build_clientes_export, build_clientes_proyeccion_export
+    return {
+        'ventas': build_ventas_export,
+        'pagos': build_pagos_export,
+        'gastos': build_gastos_export,
+        'clientes': build_clientes_export,
+        'clientes_proyecciones': build_clientes_proyeccion_export,
+    }
+
+
+def _get_executor():
+    """Pool de hilos del proceso (uno por worker de gunicorn, creado al primer uso)."""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is not None and _executor_pid == pid:
+        return _executor
+    with _executor_lock:
+        if _executor is None or _executor_pid != pid:
+            workers = int(current_app.config.get('EXPORT_JOB_WORKERS', 2))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='export-job')
+            _executor_pid = pid
+            _futures.clear()
+            logger.info(f"Pool de exportaciones iniciado ({workers} hilos).")
+        return _executor
+
+
+def submit_export_job(tipo, args, claims, formato):
+    """
+    Registra una exportación y la encola en el pool. `args` son los filtros del
+    endpoint y `claims` los del JWT (se guardan para aplicar el mismo filtro por rol).
+    Lanza ExportJobLimitError si el usuario ya tiene EXPORT_JOBS_MAX_PER_USER en curso.
+    """
+    usuario_id = int(claims.get('sub'))
+    limite = int(current_app.config.get('EXPORT_JOBS_MAX_PER_USER', 2))
+
+    # Bloquear la fila del usuario serializa las solicitudes concurrentes del mismo usuario
+    db.session.query(Users.id).filter(Users.id == usuario_id).with_for_update().one()
+    activos = ExportJob.query.filter(
+        ExportJob.usuario_id == usuario_id, ExportJob.estado.in_(ESTADOS_ACTIVOS)
+    ).count()
+    if activos >= limite:
+        db.session.rollback()
+        raise ExportJobLimitError(f"Ya tienes {activos} exportaciones en curso (máximo {limite}).")
+
+    job = ExportJob(
+        id=str(uuid.uuid4()),
+        usuario_id=usuario_id,
+        tipo=tipo,
+        formato=formato,
+        parametros={
+            "args": {k: v for k, v in dict(args).items() if v is not None},
+            "claims": {k: claims.get(k) for k in ('sub', 'rol', 'almacen_id')},
+        },
+        estado=ESTADO_PENDIENTE,
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    app = current_app._get_current_object()
+    future = _get_executor().submit(_run_job, app, job.id)
+    _futures[job.id] = future
+    future.add_done_callback(lambda _f, job_id=job.id: _futures.pop(job_id, None))
+    logger.info(f"Exportación {job.id} ({tipo}, {formato}) encolada para el usuario {usuario_id}")
+    return job
+
+
+def submit_export_request(tipo, args):
+    """Respuesta de los endpoints /exportar con ?async=true: 202 con el id del trabajo."""
+    formato = get_export_format()
+    if formato is None:
+        return {"error": "Formato no soportado. Usa 'xlsx' o 'csv'"}, 400
+    args = {k: v for k, v in dict(args).items() if k not in ('async', 'formato')}
+    try:
+        job = submit_export_job(tipo, args, get_jwt(), formato)
+    except ExportJobLimitError as e:
+        return {"error": str(e)}, 429
+    return {
+        "job_id": job.id,
+        "estado": job.estado,
+        "estado_url": url_for('exportacionresource', job_uuid=job.id),
+    }, 202
+
+
+# --- Ejecución en el pool ---
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _is_cancelled(job_id):
+    return db.session.query(ExportJob.estado).filter(ExportJob.id == job_id).scalar() == ESTADO_CANCELADO
+
+
+def _store_result(job, filename, fileobj):
+    """Sube el archivo generado a S3 (o lo copia a EXPORT_LOCAL_DIR). Devuelve las columnas a guardar."""
+    s3_client = get_s3_client()
+    bucket_name = current_app.config.get('S3_BUCKET')
+    if s3_client and bucket_name:
+        # El nombre de descarga va al final de la clave para que el navegador lo use
+        s3_key = f"{S3_PREFIX}/{job.id}/{filename}"
+        s3_client.upload_fileobj(fileobj, bucket_name, s3_key, ExtraArgs={'ContentType': get_content_type(FORMATOS[job.formato], 'utf-8')})
+        return {"s3_key": s3_key}
+
+    directorio = current_app.config.get('EXPORT_LOCAL_DIR') or os.path.join(tempfile.gettempdir(), S3_PREFIX)
+    os.makedirs(directorio, exist_ok=True)
+    ruta = os.path.join(directorio, f"{job.id}.{job.formato}")
+    with open(ruta, 'wb') as destino:
+        shutil.copyfileobj(fileobj, destino)
+    return {"ruta_local": ruta}
+
+
+def _discard_result(s3_key=None, ruta_local=None):
+    """Elimina el archivo de un trabajo (S3 vía la cola de eliminación, o disco)."""
+    if s3_key:
+        queue_delete(s3_key)
+    if ruta_local:
+        try:
+            os.remove(ruta_local)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"No se pudo eliminar la exportación local {ruta_local}: {e}")
+
+
+def _run_job(app, job_id):
+    with app.app_context():
+        try:
+            job = db.session.get(ExportJob, job_id)
+            if job is None or job.estado != ESTADO_PENDIENTE:
+                return  # Cancelado antes de empezar
+            job.estado = ESTADO_PROCESANDO
+            job.started_at = _now()
+            db.session.commit()
+
+            spec = _builders()[job.tipo](job.parametros.get('args', {}), job.parametros.get('claims', {}))
+            writer = write_xlsx if job.formato == 'xlsx' else write_csv
+            with tempfile.TemporaryFile() as output:
+                filas = writer(spec, output, check_cancel=lambda: _is_cancelled(job_id))
+                output.seek(0)
+                resultado = _store_result(job, export_filename(spec, job.formato), output)
+
+            ahora = _now()
+            ttl = int(app.config.get('EXPORT_RESULT_TTL_SECONDS', 86400))
+            # Solo se marca completado si nadie lo canceló mientras se subía
+            actualizados = ExportJob.query.filter(
+                ExportJob.id == job_id, ExportJob.estado == ESTADO_PROCESANDO
+            ).update({
+                "estado": ESTADO_COMPLETADO, "filas": filas, "finished_at": ahora,
+                "expires_at": ahora + timedelta(seconds=ttl), **resultado,
+            }, synchronize_session=False)
+            if not actualizados:
+                _discard_result(**resultado)
+            db.session.commit()
+            logger.info(f"Exportación {job_id} completada: {filas} filas")
+        except ExportCancelled:
+            db.session.rollback()
+            logger.info(f"Exportación {job_id} cancelada durante el procesamiento")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error en la exportación {job_id}: {e}")
+            ExportJob.query.filter(
+                ExportJob.id == job_id, ExportJob.estado.in_(ESTADOS_ACTIVOS)
+            ).update({"estado": ESTADO_ERROR, "error": str(e)[:1000], "finished_at": _now()},
+                     synchronize_session=False)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+# --- Consulta, cancelación y limpieza ---
+
+def cancel_export_job(job):
+    """Cancela un trabajo pendiente o en curso. Devuelve False si ya había terminado."""
+    if job.estado not in ESTADOS_ACTIVOS:
+        return False
+    future = _futures.get(job.id)
+    if future is not None:
+        future.cancel()  # Solo tiene efecto si aún no empezó
+    job.estado = ESTADO_CANCELADO
+    job.finished_at = _now()
+    db.session.commit()
+    return True
+
+
+def export_job_payload(job):
+    payload = {
+        "id": job.id,
+        "tipo": job.tipo,
+        "formato": job.formato,
+        "estado": job.estado,
+        "filas": job.filas,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "expires_at": job.expires_at.isoformat() if job.expires_at else None,
+        "descarga_url": None,
+    }
+    if job.estado == ESTADO_COMPLETADO:
+        if job.s3_key:
+            restante = int((job.expires_at - _now()).total_seconds()) if job.expires_at else 3600
+            payload["descarga_url"] = get_presigned_url(job.s3_key, expiration=max(60, min(3600, restante)))
+        elif job.ruta_local:
+            payload["descarga_url"] = url_for('exportaciondescargaresource', job_uuid=job.id)
+    return payload
+
+
+def cleanup_export_jobs():
+    """
+    - Elimina los archivos vencidos (expires_at) y marca el trabajo como expirado.
+    - Marca como error los trabajos activos que superaron EXPORT_JOB_TIMEOUT_SECONDS
+      (p. ej. el worker que los procesaba se reinició).
+    - Borra los registros terminados hace más de EXPORT_JOB_RETENTION_DAYS.
+    Devuelve el número de archivos eliminados.
+    """
+    config = current_app.config
+    ahora = _now()
+
+    vencidos = ExportJob.query.filter(
+        ExportJob.estado == ESTADO_COMPLETADO, ExportJob.expires_at < ahora
+    ).with_for_update(skip_locked=True).all()
+    for job in vencidos:
+        _discard_result(job.s3_key, job.ruta_local)
+        job.estado = ESTADO_EXPIRADO
+        job.s3_key = None
+        job.ruta_local = None
+
+    limite_activos = ahora - timedelta(seconds=int(config.get('EXPORT_JOB_TIMEOUT_SECONDS', 3600)))
+    ExportJob.query.filter(
+        ExportJob.estado.in_(ESTADOS_ACTIVOS), ExportJob.created_at < limite_activos
+    ).update({"estado": ESTADO_ERROR, "error": "Tiempo de procesamiento agotado", "finished_at": ahora},
+             synchronize_session=False)
+
+    limite_registros = ahora - timedelta(days=int(config.get('EXPORT_JOB_RETENTION_DAYS', 7)))
+    ExportJob.query.filter(
+        ExportJob.estado.notin_(ESTADOS_ACTIVOS + (ESTADO_COMPLETADO,)),
+        ExportJob.finished_at < limite_registros
+    ).delete(synchronize_session=False)
+
+    db.session.commit()
+    if vencidos:
+        logger.info(f"Exportaciones vencidas eliminadas: {len(vencidos)}")
+    return len(vencidos)
+
+
+def start_export_cleanup_worker(app, interval_seconds):
+    """Lanza el hilo daemon que limpia exportaciones vencidas cada `interval_seconds`."""
+    global _cleanup_thread
+    if interval_seconds <= 0:
+        return None
+    if _cleanup_thread is not None and _cleanup_thread.is_alive():
+        return _cleanup_thread
+
+    def _run():
+        while True:
+            time.sleep(interval_seconds)
+            with app.app_context():
+                try:
+                    cleanup_export_jobs()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error limpiando exportaciones: {e}")
+                finally:
+                    db.session.remove()
+
+    _cleanup_thread = threading.Thread(target=_run, name='export-jobs-cleanup', daemon=True)
+    _cleanup_thread.start()
+    return _cleanup_thread
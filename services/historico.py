@@ -0,0 +1,131 @@
+"""
+Archivo histórico de ventas.
+
+Las ventas pagadas con más de HISTORICO_MESES (por defecto 18) casi no se
+consultan, pero ocupan las tablas e índices que recorren todos los listados y
+reportes. `flask archivar-ventas` las mueve por bloques, junto con sus
+detalles, pagos y movimientos, a las tablas *_historico (migrations/historico.sql),
+que conservan columnas e ids.
+
+Lectura: `historico_alcanzado` dice si un filtro de fecha llega a filas
+archivadas y `con_historico` devuelve la entidad a consultar: el modelo tal
+cual o un alias del modelo sobre `tabla UNION ALL tabla_historico`. Las
+consultas ORM existentes funcionan igual sobre el alias, así que un reporte da
+los mismos totales antes y después de archivar.
+"""
+import logging
+from collections import defaultdict
+
+from sqlalchemy import delete, func, insert, select, union_all
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from extensions import db
+from models import (
+    Movimiento, Pago, Venta, VentaDetalle,
+    movimientos_historico, pagos_historico, venta_detalles_historico, ventas_historico,
+)
+
+logger = logging.getLogger(__name__)
+
+HISTORICO = {
+    Venta: ventas_historico,
+    VentaDetalle: venta_detalles_historico,
+    Pago: pagos_historico,
+    Movimiento: movimientos_historico,
+}
+
+# Hijos de una venta que se archivan con ella. Se mueven antes que la venta:
+# borrarla primero dispararía el ON DELETE CASCADE / SET NULL de sus claves.
+HIJOS_VENTA = (Movimiento, Pago, VentaDetalle)
+
+
+def historico_alcanzado(columna, desde=None):
+    """
+    True si hay filas archivadas con `columna` >= `desde` (p. ej. Venta.fecha).
+    Sin `desde`, si hay alguna fila archivada. Va por el índice de la columna.
+    """
+    tabla = HISTORICO[columna.class_]
+    consulta = select(tabla.c.id)
+    if desde is not None:
+        consulta = consulta.where(tabla.c[columna.key] >= desde)
+    return db.session.query(consulta.exists()).scalar()
+
+
+def con_historico(modelo, incluir=True):
+    """
+    `modelo` o, con `incluir`, un alias de `modelo` sobre la unión de su tabla
+    y la histórica. Los filtros, joins y opciones de carga se escriben contra
+    la entidad devuelta.
+    """
+    if not incluir:
+        return modelo
+    tabla = modelo.__table__
+    historica = HISTORICO[modelo]
+    union = union_all(
+        select(*tabla.c),
+        select(*[historica.c[c.name] for c in tabla.c]),
+    ).subquery(f"{tabla.name}_con_historico")
+    return aliased(modelo, union, adapt_on_names=True)
+
+
+def cargar_hijos_historicos(padres, relacion, cargar=()):
+    """
+    Completa `relacion` (p. ej. Venta.detalles) en los `padres` archivados.
+    La carga normal de la relación solo mira la tabla actual y los deja vacíos.
+    `cargar` son relaciones del hijo a traer en el mismo SELECT.
+    """
+    if not padres:
+        return
+    prop = relacion.property
+    modelo_hijo = prop.mapper.class_
+    fk = next(iter(prop.remote_side)).key
+    Hijo = aliased(modelo_hijo, HISTORICO[modelo_hijo].alias(), adapt_on_names=True)
+
+    hijos_por_padre = defaultdict(list)
+    consulta = db.session.query(Hijo).options(*[joinedload(getattr(Hijo, nombre)) for nombre in cargar])
+    for hijo in consulta.filter(getattr(Hijo, fk).in_({padre.id for padre in padres})).order_by(Hijo.id):
+        hijos_por_padre[getattr(hijo, fk)].append(hijo)
+
+    for padre in padres:
+        if padre.id in hijos_por_padre:
+            set_committed_value(padre, prop.key, hijos_por_padre[padre.id])
+
+
+def corte_historico(meses):
+    """Fecha límite: se archivan las ventas anteriores a now() - `meses`."""
+    return db.session.query(func.now() - func.make_interval(0, meses)).scalar()
+
+
+def _mover(modelo, columna, ids):
+    """DELETE ... RETURNING de las filas con `columna` en `ids` e INSERT en su tabla histórica."""
+    tabla = modelo.__table__
+    nombres = [c.name for c in tabla.c]
+    movidas = delete(tabla).where(columna.in_(ids)).returning(*tabla.c).cte('movidas')
+    resultado = db.session.execute(
+        insert(HISTORICO[modelo]).from_select(nombres, select(*[movidas.c[n] for n in nombres]))
+    )
+    return resultado.rowcount
+
+
+def archivar_bloque(corte, desde_id, limite):
+    """
+    Mueve al histórico hasta `limite` ventas pagadas con fecha < `corte` e
+    id > `desde_id`, con sus detalles, pagos y movimientos. No hace commit.
+    Devuelve (último id procesado o None si no quedan, {tabla: filas movidas}).
+    """
+    ids = [
+        fila.id for fila in db.session.query(Venta.id)
+        .filter(Venta.estado_pago == 'pagado', Venta.fecha < corte, Venta.id > desde_id)
+        .order_by(Venta.id)
+        .limit(limite)
+        .with_for_update(skip_locked=True)
+    ]
+    if not ids:
+        return None, {}
+
+    movidas = {}
+    for modelo in HIJOS_VENTA:
+        movidas[modelo.__tablename__] = _mover(modelo, modelo.venta_id, ids)
+    movidas[Venta.__tablename__] = _mover(Venta, Venta.id, ids)
+    return ids[-1], movidas
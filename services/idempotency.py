@@ -0,0 +1,211 @@
+"""
+Cabecera Idempotency-Key en endpoints de escritura.
+
+El móvil reintenta POST /ventas, /pagos, ... cuando pierde la respuesta, y cada
+reintento creaba otra venta o pago. Con `@idempotente`, una petición que trae
+Idempotency-Key guarda su respuesta en `idempotency_keys` durante
+IDEMPOTENCY_TTL_SECONDS; un reintento con la misma clave (por usuario) recibe
+esa respuesta con la cabecera Idempotent-Replayed sin volver a ejecutar el
+endpoint. Si la clave llega con otro cuerpo se responde 422.
+
+Peticiones simultáneas con la misma clave: la primera inserta la fila en una
+conexión aparte y no confirma hasta tener la respuesta; el INSERT de las demás
+queda esperando en el índice único (como mucho IDEMPOTENCY_WAIT_SECONDS) y al
+liberarse devuelven la respuesta guardada. Las respuestas 5xx no se guardan:
+la fila se descarta y el siguiente reintento vuelve a ejecutar el endpoint.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import current_app, request
+from flask_jwt_extended import get_jwt
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from extensions import db
+from models import IdempotencyKey
+from utils.streaming_upload import should_stream_request
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+LOCK_NOT_AVAILABLE = '55P03'
+
+_cleanup_thread = None
+
+# Reserva la clave. Una fila vencida se reutiliza; si otra transacción tiene la
+# clave sin confirmar, PostgreSQL hace esperar a este INSERT hasta que termine.
+_RESERVAR_SQL = text("""
+    INSERT INTO idempotency_keys
+        (usuario_id, clave, endpoint, request_hash, status_code, created_at, expires_at)
+    VALUES (:usuario_id, :clave, :endpoint, :request_hash, 0, :ahora, :expira)
+    ON CONFLICT (usuario_id, clave) DO UPDATE SET
+        endpoint = EXCLUDED.endpoint,
+        request_hash = EXCLUDED.request_hash,
+        status_code = 0,
+        respuesta = NULL,
+        created_at = EXCLUDED.created_at,
+        expires_at = EXCLUDED.expires_at
+    WHERE idempotency_keys.expires_at < EXCLUDED.created_at
+    RETURNING id
+""")
+
+_GUARDAR_SQL = text("""
+    UPDATE idempotency_keys SET status_code = :status_code, respuesta = CAST(:respuesta AS JSON)
+    WHERE id = :id
+""")
+
+_GUARDADA_SQL = text("""
+    SELECT request_hash, status_code, respuesta FROM idempotency_keys
+    WHERE usuario_id = :usuario_id AND clave = :clave
+""")
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _request_hash():
+    """SHA-256 de método, ruta y cuerpo de la petición actual."""
+    h = hashlib.sha256(f"{request.method} {request.full_path}\n".encode())
+    if request.mimetype == 'multipart/form-data':
+        if should_stream_request():
+            # El cuerpo se parsea en streaming dentro del endpoint y no puede leerse dos veces
+            h.update(f"{request.mimetype} {request.content_length}".encode())
+        else:
+            for nombre, valor in sorted(request.form.items(multi=True)):
+                h.update(f"{nombre}={valor}\n".encode())
+            for nombre, archivo in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+                h.update(f"{nombre}:{archivo.filename}:".encode())
+                for bloque in iter(lambda: archivo.stream.read(64 * 1024), b''):
+                    h.update(bloque)
+                archivo.stream.seek(0)
+    else:
+        h.update(request.get_data(cache=True))
+    return h.hexdigest()
+
+
+def _normalizar_respuesta(resultado):
+    """(cuerpo, status, headers) de lo que devuelve un método de Resource; None si no es JSON."""
+    if not isinstance(resultado, tuple):
+        resultado = (resultado,)
+    cuerpo, status, headers = (tuple(resultado) + (200, None))[:3]
+    if not isinstance(cuerpo, (dict, list)):
+        return None
+    return cuerpo, int(status), headers
+
+
+def _replay(fila):
+    return fila.respuesta, fila.status_code, {'Idempotent-Replayed': 'true'}
+
+
+def idempotente(func):
+    """
+    Aplica Idempotency-Key al método decorado. Va debajo de @jwt_required()
+    (la clave es por usuario) y encima de @handle_db_errors, para guardar la
+    respuesta final. Sin cabecera el endpoint se ejecuta como siempre.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        clave = (request.headers.get(IDEMPOTENCY_HEADER) or '').strip()
+        if not clave:
+            return func(*args, **kwargs)
+        if len(clave) > MAX_KEY_LENGTH:
+            return {"error": f"{IDEMPOTENCY_HEADER} no puede superar {MAX_KEY_LENGTH} caracteres"}, 400
+
+        config = current_app.config
+        ahora = _now()
+        params = {
+            "usuario_id": int(get_jwt().get('sub')),
+            "clave": clave,
+            "endpoint": (request.endpoint or request.path)[:100],
+            "request_hash": _request_hash(),
+            "ahora": ahora,
+            "expira": ahora + timedelta(seconds=int(config.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))),
+        }
+        espera_ms = int(config.get('IDEMPOTENCY_WAIT_SECONDS', 30)) * 1000
+
+        # Conexión propia: la reserva no debe mezclarse con la transacción del endpoint
+        conn = db.engine.connect()
+        trans = conn.begin()
+        try:
+            conn.execute(text(f"SET LOCAL lock_timeout = '{espera_ms}ms'"))
+            reserva_id = conn.execute(_RESERVAR_SQL, params).scalar()
+            if reserva_id is None:
+                fila = conn.execute(_GUARDADA_SQL, params).first()
+                trans.rollback()
+                if fila.request_hash != params['request_hash']:
+                    return {"error": f"{IDEMPOTENCY_HEADER} ya usada con una petición distinta"}, 422
+                return _replay(fila)
+        except DBAPIError as e:
+            trans.rollback()
+            conn.close()
+            if getattr(getattr(e, 'orig', None), 'pgcode', None) == LOCK_NOT_AVAILABLE:
+                return {"error": f"Hay otra petición en curso con la misma {IDEMPOTENCY_HEADER}"}, 409
+            raise
+        except Exception:
+            trans.rollback()
+            conn.close()
+            raise
+
+        try:
+            resultado = func(*args, **kwargs)
+            respuesta = _normalizar_respuesta(resultado)
+            if respuesta is None or respuesta[1] >= 500:
+                trans.rollback()
+            else:
+                conn.execute(_GUARDAR_SQL, {
+                    "id": reserva_id,
+                    "status_code": respuesta[1],
+                    "respuesta": json.dumps(respuesta[0], default=str),
+                })
+                trans.commit()
+            return resultado
+        except Exception:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+    return wrapper
+
+
+def cleanup_idempotency_keys():
+    """Borra las claves vencidas. Devuelve cuántas se eliminaron."""
+    eliminadas = IdempotencyKey.query.filter(
+        IdempotencyKey.expires_at < _now()
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if eliminadas:
+        logger.info(f"Claves de idempotencia vencidas eliminadas: {eliminadas}")
+    return eliminadas
+
+
+def start_idempotency_cleanup_worker(app, interval_seconds):
+    """Lanza el hilo daemon que borra claves vencidas cada `interval_seconds`."""
+    global _cleanup_thread
+    if interval_seconds <= 0:
+        return None
+    if _cleanup_thread is not None and _cleanup_thread.is_alive():
+        return _cleanup_thread
+
+    def _run():
+        while True:
+            time.sleep(interval_seconds)
+            with app.app_context():
+                try:
+                    cleanup_idempotency_keys()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error limpiando claves de idempotencia: {e}")
+                finally:
+                    db.session.remove()
+
+    _cleanup_thread = threading.Thread(target=_run, name='idempotency-cleanup', daemon=True)
+    _cleanup_thread.start()
+    return _cleanup_thread
@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import event, func, insert
+from sqlalchemy.orm import Session
+
+from extensions import db
+from models import S3DeleteQueue
+from utils.file_handlers import IMAGE_VARIANTS, get_s3_client, invalidate_presigned_url, variant_key
+
+logger = logging.getLogger(__name__)
+
+# Límite de claves por llamada a delete_objects impuesto por S3
+MAX_KEYS_PER_DELETE = 1000
+
+# Contadores del proceso (se suman a la profundidad de cola en las métricas)
+_metrics = {"eliminados": 0, "fallidos": 0, "lotes": 0, "ultimo_flush": None}
+_metrics_lock = threading.Lock()
+_worker_thread = None
+
+# Claves en subida cuya cancelación espera al commit de la sesión: (clave, with_variants)
+_DESCARTES = 's3_delete_queue.descartes_pendientes'
+
+
+def _expand_keys(s3_keys, with_variants):
+    keys = []
+    for key in s3_keys:
+        if not key:
+            continue
+        if with_variants:
+            keys.extend(variant_key(key, name) for name in IMAGE_VARIANTS)
+        else:
+            keys.append(key)
+    return keys
+
+
+def queue_delete(s3_keys, with_variants=False, independent=False):
+    """
+    Encola claves S3 para eliminarlas en segundo plano.
+    - Por defecto la fila se añade a la sesión actual: el borrado solo ocurre si
+      la transacción del endpoint se confirma.
+    - Con `independent=True` se inserta en su propia transacción (rutas de
+      rollback, donde la sesión se va a descartar).
+    Las claves que aún se están subiendo en segundo plano se cancelan en su lugar,
+    también solo cuando la transacción se confirma (o de inmediato con `independent`).
+    """
+    from utils.upload_worker import ESTADO_PENDIENTE, discard_pending_upload, get_upload_status
+
+    if isinstance(s3_keys, str):
+        s3_keys = [s3_keys]
+    s3_keys = [k for k in s3_keys if k]
+    if independent:
+        keys = [k for k in s3_keys if not discard_pending_upload(k)]
+    else:
+        keys = []
+        for k in s3_keys:
+            status = get_upload_status(k)
+            if status and status['estado'] == ESTADO_PENDIENTE:
+                db.session.info.setdefault(_DESCARTES, []).append((k, with_variants))
+            else:
+                keys.append(k)
+    keys = _expand_keys(keys, with_variants)
+    if not keys:
+        return 0
+
+    for key in keys:
+        invalidate_presigned_url(key)
+    if independent:
+        with db.engine.begin() as conn:
+            conn.execute(insert(S3DeleteQueue), [{"s3_key": key} for key in keys])
+    else:
+        db.session.add_all([S3DeleteQueue(s3_key=key) for key in keys])
+    logger.debug(f"Encoladas {len(keys)} claves S3 para eliminar")
+    return len(keys)
+
+
+@event.listens_for(Session, 'after_commit')
+def _descartar_subidas(session):
+    """Cancela las subidas pendientes cuyo borrado se confirmó; si ya terminaron, encola el objeto."""
+    from utils.upload_worker import discard_pending_upload
+
+    for key, with_variants in session.info.pop(_DESCARTES, []):
+        if not discard_pending_upload(key):
+            queue_delete(key, with_variants=with_variants, independent=True)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _olvidar_descartes(session, previous_transaction):
+    # Un savepoint revertido no descarta lo encolado fuera de él
+    if not previous_transaction.nested:
+        session.info.pop(_DESCARTES, None)
+
+
+def _backoff(intentos):
+    base = int(current_app.config.get('S3_DELETE_QUEUE_BACKOFF_SECONDS', 30))
+    return timedelta(seconds=min(base * (2 ** (intentos - 1)), 3600))
+
+
+def flush_delete_queue(batch_size=MAX_KEYS_PER_DELETE):
+    """
+    Procesa un lote de la cola: toma hasta `batch_size` filas vencidas con
+    FOR UPDATE SKIP LOCKED (varios workers pueden vaciarla a la vez), las borra
+    con una sola llamada delete_objects y reprograma las que fallen.
+    Devuelve el número de filas procesadas.
+    """
+    s3_client = get_s3_client()
+    bucket_name = current_app.config.get('S3_BUCKET')
+    if not s3_client or not bucket_name:
+        return 0
+
+    max_intentos = int(current_app.config.get('S3_DELETE_QUEUE_MAX_ATTEMPTS', 8))
+    now = datetime.now(timezone.utc)
+    filas = (
+        S3DeleteQueue.query
+        .filter(S3DeleteQueue.proximo_intento <= now)
+        .order_by(S3DeleteQueue.id)
+        .limit(min(batch_size, MAX_KEYS_PER_DELETE))
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not filas:
+        db.session.commit()
+        return 0
+
+    errores = {}
+    try:
+        # Claves repetidas en la cola se envían una sola vez
+        claves = sorted({f.s3_key for f in filas})
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={'Objects': [{'Key': k} for k in claves], 'Quiet': True}
+        )
+        errores = {e['Key']: f"{e.get('Code')}: {e.get('Message')}" for e in response.get('Errors', [])}
+    except Exception as e:
+        logger.error(f"Error en delete_objects para {len(filas)} claves: {e}")
+        errores = {f.s3_key: str(e) for f in filas}
+
+    eliminados = fallidos = 0
+    for fila in filas:
+        error = errores.get(fila.s3_key)
+        if error is None:
+            db.session.delete(fila)
+            eliminados += 1
+            continue
+        fallidos += 1
+        fila.intentos += 1
+        fila.ultimo_error = error[:1000]
+        if fila.intentos >= max_intentos:
+            fila.proximo_intento = None
+            logger.error(f"Clave S3 {fila.s3_key} sin eliminar tras {fila.intentos} intentos: {error}")
+        else:
+            fila.proximo_intento = now + _backoff(fila.intentos)
+    db.session.commit()
+
+    with _metrics_lock:
+        _metrics["eliminados"] += eliminados
+        _metrics["fallidos"] += fallidos
+        _metrics["lotes"] += 1
+        _metrics["ultimo_flush"] = now.isoformat()
+    if eliminados:
+        logger.info(f"Cola S3: {eliminados} objetos eliminados, {fallidos} reprogramados")
+    return len(filas)
+
+
+def delete_queue_metrics():
+    """Profundidad de la cola (pendientes, agotados, antigüedad) y contadores del proceso."""
+    pendientes, mas_antiguo = db.session.query(
+        func.count(S3DeleteQueue.id), func.min(S3DeleteQueue.created_at)
+    ).filter(S3DeleteQueue.proximo_intento.isnot(None)).one()
+    agotados = db.session.query(func.count(S3DeleteQueue.id)).filter(
+        S3DeleteQueue.proximo_intento.is_(None)
+    ).scalar()
+    with _metrics_lock:
+        proceso = dict(_metrics)
+    return {
+        "pendientes": pendientes,
+        "agotados": agotados,
+        "antiguedad_max_segundos": (
+            int((datetime.now(timezone.utc) - mas_antiguo).total_seconds()) if mas_antiguo else 0
+        ),
+        "proceso": proceso,
+    }
+
+
+def start_delete_queue_worker(app, interval_seconds):
+    """Lanza el hilo daemon que vacía la cola cada `interval_seconds` (uno por proceso)."""
+    global _worker_thread
+    if interval_seconds <= 0:
+        return None
+    if _worker_thread is not None and _worker_thread.is_alive():
+        return _worker_thread
+
+    def _run():
+        while True:
+            time.sleep(interval_seconds)
+            with app.app_context():
+                try:
+                    # Vaciar mientras haya lotes completos pendientes
+                    while flush_delete_queue() >= MAX_KEYS_PER_DELETE:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error procesando la cola de eliminación S3: {e}")
+                finally:
+                    db.session.remove()
+
+    _worker_thread = threading.Thread(target=_run, name='s3-delete-queue', daemon=True)
+    _worker_thread.start()
+    return _worker_thread
@@ -0,0 +1,224 @@
+"""
+Resumen de stock por (presentacion, almacen).
+
+La tabla stock_resumen (migrations/stock_resumen.sql) guarda por par las
+unidades, el mayor stock_minimo de sus filas de inventario y una copia de
+capacidad_kg / precio_venta; kg y valor_venta son columnas generadas. Los
+reportes leen de aquí en vez de sumar inventario en cada petición.
+
+Se mantiene en la misma transacción que el cambio de inventario:
+- aplicar_cambios_stock (UPDATE directo) llama a registrar_deltas.
+- Los cambios ORM sobre Inventario (alta, ajuste, borrado) y sobre
+  capacidad_kg / precio_venta de PresentacionProducto se recogen en los
+  eventos de flush de la sesión, registrados al importar este módulo.
+Las unidades se aplican como incremento (unidades = unidades + delta), así
+que dos transacciones concurrentes sobre el mismo par no se pisan.
+Cualquier otra escritura directa sobre inventario debe llamar a registrar_deltas.
+
+`flask reconstruir-stock-resumen` (scripts/stock_resumen.py) compara la tabla
+con inventario y la reconstruye.
+"""
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+
+from extensions import db
+from models import Inventario, PresentacionProducto
+
+logger = logging.getLogger(__name__)
+
+STOCK_MINIMO_POR_DEFECTO = 10
+_PENDIENTE = 'stock_resumen_pendiente'
+
+# Agregado de inventario con las mismas columnas que stock_resumen
+_AGREGADO = """
+    SELECT i.presentacion_id, i.almacen_id, sum(i.cantidad) AS unidades,
+           max(i.stock_minimo) AS stock_minimo, p.capacidad_kg, p.precio_venta
+    FROM inventario i
+    JOIN presentaciones_producto p ON p.id = i.presentacion_id
+    GROUP BY i.presentacion_id, i.almacen_id, p.capacidad_kg, p.precio_venta
+"""
+
+
+def _values_pares(pares, con_delta=False):
+    filas, params = [], {}
+    for i, par in enumerate(pares):
+        almacen_id, presentacion_id = par
+        columnas = [f"CAST(:a{i} AS INTEGER)", f"CAST(:p{i} AS INTEGER)"]
+        params.update({f'a{i}': almacen_id, f'p{i}': presentacion_id})
+        if con_delta:
+            columnas.append(f"CAST(:d{i} AS NUMERIC)")
+            params[f'd{i}'] = pares[par]
+        filas.append(f"({', '.join(columnas)})")
+    return ', '.join(filas), params
+
+
+def registrar_deltas(deltas):
+    """
+    Suma `deltas` ({(almacen_id, presentacion_id): unidades}) a stock_resumen,
+    creando los pares que falten, y recalcula su stock_minimo. Un delta 0
+    también crea el par (p. ej. filas de inventario nuevas en 0).
+    Los pares se escriben en orden (almacen, presentacion), el mismo en que
+    aplicar_cambios_stock bloquea el inventario.
+    """
+    deltas = {par: delta for par, delta in deltas.items() if None not in par}
+    if not deltas:
+        return
+    values, params = _values_pares(dict(sorted(deltas.items())), con_delta=True)
+    params['minimo'] = STOCK_MINIMO_POR_DEFECTO
+    db.session.execute(text(f"""
+        INSERT INTO stock_resumen AS s
+            (presentacion_id, almacen_id, unidades, stock_minimo, capacidad_kg, precio_venta, actualizado_en)
+        SELECT v.presentacion_id, v.almacen_id, v.delta,
+               COALESCE((SELECT max(i.stock_minimo) FROM inventario i
+                         WHERE i.almacen_id = v.almacen_id AND i.presentacion_id = v.presentacion_id), :minimo),
+               p.capacidad_kg, p.precio_venta, now()
+        FROM (VALUES {values}) AS v(almacen_id, presentacion_id, delta)
+        JOIN presentaciones_producto p ON p.id = v.presentacion_id
+        ORDER BY v.almacen_id, v.presentacion_id
+        ON CONFLICT (presentacion_id, almacen_id) DO UPDATE
+        SET unidades = s.unidades + EXCLUDED.unidades,
+            stock_minimo = EXCLUDED.stock_minimo,
+            capacidad_kg = EXCLUDED.capacidad_kg,
+            precio_venta = EXCLUDED.precio_venta,
+            actualizado_en = EXCLUDED.actualizado_en
+    """), params)
+
+
+def eliminar_pares_vacios(pares):
+    """Borra de stock_resumen los `pares` que ya no tienen filas de inventario."""
+    pares = sorted(par for par in set(pares) if None not in par)
+    if not pares:
+        return
+    values, params = _values_pares(pares)
+    db.session.execute(text(f"""
+        DELETE FROM stock_resumen s
+        USING (VALUES {values}) AS v(almacen_id, presentacion_id)
+        WHERE s.almacen_id = v.almacen_id AND s.presentacion_id = v.presentacion_id
+          AND NOT EXISTS (SELECT 1 FROM inventario i
+                          WHERE i.almacen_id = v.almacen_id AND i.presentacion_id = v.presentacion_id)
+    """), params)
+
+
+def actualizar_presentaciones(presentacion_ids):
+    """Copia capacidad_kg y precio_venta actuales de las presentaciones a sus pares."""
+    if not presentacion_ids:
+        return
+    db.session.execute(text("""
+        UPDATE stock_resumen s
+        SET capacidad_kg = p.capacidad_kg, precio_venta = p.precio_venta, actualizado_en = now()
+        FROM presentaciones_producto p
+        WHERE p.id = s.presentacion_id AND p.id = ANY(:ids)
+    """), {'ids': sorted(presentacion_ids)})
+
+
+def diferencias():
+    """
+    Pares en que stock_resumen no coincide con el agregado de inventario.
+    Una sola consulta: ve una foto consistente aunque haya escrituras en curso.
+    """
+    return db.session.execute(text(f"""
+        WITH base AS ({_AGREGADO})
+        SELECT COALESCE(b.presentacion_id, s.presentacion_id) AS presentacion_id,
+               COALESCE(b.almacen_id, s.almacen_id) AS almacen_id,
+               b.unidades AS esperado, s.unidades AS actual,
+               b.stock_minimo AS stock_minimo_esperado, s.stock_minimo AS stock_minimo_actual
+        FROM base b
+        FULL OUTER JOIN stock_resumen s
+          ON s.presentacion_id = b.presentacion_id AND s.almacen_id = b.almacen_id
+        WHERE b.unidades IS DISTINCT FROM s.unidades
+           OR b.stock_minimo IS DISTINCT FROM s.stock_minimo
+           OR b.capacidad_kg IS DISTINCT FROM s.capacidad_kg
+           OR b.precio_venta IS DISTINCT FROM s.precio_venta
+        ORDER BY 2, 1
+    """)).all()
+
+
+def reconstruir():
+    """
+    Vuelve a calcular stock_resumen desde inventario. No hace commit.
+    El LOCK hace esperar a las escrituras concurrentes del resumen: las que ya
+    lo tocaron terminan antes y las demás aplican su delta sobre lo reconstruido.
+    """
+    db.session.execute(text("LOCK TABLE stock_resumen IN SHARE ROW EXCLUSIVE MODE"))
+    db.session.execute(text("DELETE FROM stock_resumen"))
+    return db.session.execute(text(f"""
+        INSERT INTO stock_resumen (presentacion_id, almacen_id, unidades, stock_minimo, capacidad_kg, precio_venta)
+        SELECT presentacion_id, almacen_id, unidades, stock_minimo, capacidad_kg, precio_venta
+        FROM ({_AGREGADO}) AS base
+    """)).rowcount
+
+
+# --- Cambios ORM ---
+
+def _valor(obj, atributo, anterior):
+    """Valor anterior (según el historial) o actual de `atributo`; cargarlo si está expirado."""
+    getattr(obj, atributo)
+    historia = inspect(obj).attrs[atributo].history
+    valores = historia.non_added() if anterior else historia.non_deleted()
+    return valores[0] if valores else None
+
+
+def _fila(obj, anterior):
+    return (
+        (_valor(obj, 'almacen_id', anterior), _valor(obj, 'presentacion_id', anterior)),
+        _valor(obj, 'cantidad', anterior) or Decimal('0'),
+    )
+
+
+@event.listens_for(Session, 'before_flush')
+def _recoger_borrados(session, flush_context, instances):
+    """Los borrados se leen antes del flush: después la fila ya no existe para cargar sus valores."""
+    borrados = [
+        _fila(obj, anterior=True) for obj in session.deleted
+        if isinstance(obj, Inventario) and inspect(obj).persistent
+    ]
+    if borrados:
+        session.info.setdefault(_PENDIENTE, []).extend(borrados)
+
+
+@event.listens_for(Session, 'after_flush')
+def _aplicar_cambios_orm(session, flush_context):
+    """Las altas y ajustes se leen después del flush, con los ids ya asignados."""
+    deltas = defaultdict(Decimal)
+    vaciados = set()
+    for par, cantidad in session.info.pop(_PENDIENTE, []):
+        deltas[par] -= cantidad
+        vaciados.add(par)
+
+    presentaciones = set()
+    for obj in session.new:
+        if isinstance(obj, Inventario):
+            par, cantidad = _fila(obj, anterior=False)
+            deltas[par] += cantidad
+    for obj in session.dirty:
+        if isinstance(obj, Inventario):
+            estado = inspect(obj).attrs
+            if not any(estado[a].history.has_changes()
+                       for a in ('almacen_id', 'presentacion_id', 'cantidad', 'stock_minimo')):
+                continue
+            par_anterior, cantidad_anterior = _fila(obj, anterior=True)
+            par, cantidad = _fila(obj, anterior=False)
+            deltas[par_anterior] -= cantidad_anterior
+            deltas[par] += cantidad
+            if par != par_anterior:
+                vaciados.add(par_anterior)
+        elif isinstance(obj, PresentacionProducto):
+            estado = inspect(obj).attrs
+            if estado.capacidad_kg.history.has_changes() or estado.precio_venta.history.has_changes():
+                presentaciones.add(obj.id)
+
+    if deltas:
+        registrar_deltas(deltas)
+    if vaciados:
+        eliminar_pares_vacios(vaciados)
+    if presentaciones:
+        actualizar_presentaciones(presentaciones)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _descartar_pendientes(session, previous_transaction):
+    session.info.pop(_PENDIENTE, None)
@@ -0,0 +1,276 @@
+"""
+Mutaciones de stock por lotes.
+
+Todos los endpoints que mueven inventario (ventas, pedidos, transferencias,
+ensamblajes, movimientos manuales) describen sus cambios como una lista de
+CambioStock y llaman a aplicar_cambios_stock:
+- Los deltas se agrupan por (almacen, presentacion, lote) y se aplican con un
+  único UPDATE ... FROM (VALUES ...) condicional: si alguna fila quedaría en
+  negativo (o no existe) no se modifica ninguna y se lanza StockInsuficienteError.
+  Las filas se bloquean en orden (almacen, presentacion, lote), igual en todos
+  los endpoints, así que no hay deadlocks entre ellos; los que aun así ocurran
+  (p. ej. con filas de lotes) los reintenta common.retry_on_deadlock.
+- Los Movimiento correspondientes se insertan con un solo INSERT multi-fila.
+- stock_resumen recibe los mismos deltas, agrupados por (almacen, presentacion).
+Nada se confirma aquí: el commit/rollback sigue siendo del endpoint.
+"""
+import logging
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from sqlalchemy import insert, text, tuple_
+
+from extensions import db
+from models import Inventario, Movimiento
+from services.stock_resumen import STOCK_MINIMO_POR_DEFECTO, registrar_deltas
+
+logger = logging.getLogger(__name__)
+
+
+class StockInsuficienteError(ValueError):
+    """Algún cambio del lote dejaría el inventario en negativo o no tiene inventario."""
+
+    def __init__(self, faltantes):
+        self.faltantes = faltantes
+        super().__init__(self._mensaje())
+
+    def _mensaje(self):
+        if not self.faltantes:
+            return "Stock insuficiente"
+        f = self.faltantes[0]
+        if f['disponible'] is None:
+            mensaje = f"No existe inventario para '{f['presentacion']}' en el almacén {f['almacen_id']}"
+        else:
+            mensaje = (f"Stock insuficiente para '{f['presentacion']}'. "
+                       f"Requerido: {f['requerido']}, Disponible: {f['disponible']}")
+        if len(self.faltantes) > 1:
+            mensaje += f" (y {len(self.faltantes) - 1} más)"
+        return mensaje
+
+    def to_dict(self):
+        return {"error": str(self), "detalles": self.faltantes}
+
+
+class CambioStock:
+    """
+    Cambio de `delta` unidades (negativo = salida) en el inventario de
+    (almacen_id, presentacion_id, lote_id).
+    - `movimiento`: campos de Movimiento propios de este cambio; se combinan
+      con los comunes del lote (motivo, usuario_id, venta_id, ...). Con False
+      el cambio ajusta stock sin registrar Movimiento.
+    - `stock_minimo`: para filas de inventario creadas con crear_faltantes.
+    """
+    __slots__ = ('almacen_id', 'presentacion_id', 'lote_id', 'delta', 'movimiento', 'stock_minimo')
+
+    def __init__(self, almacen_id, presentacion_id, lote_id, delta, movimiento=None, stock_minimo=None):
+        self.almacen_id = int(almacen_id)
+        self.presentacion_id = int(presentacion_id)
+        self.lote_id = int(lote_id) if lote_id is not None else None
+        self.delta = Decimal(str(delta))
+        self.movimiento = movimiento if movimiento is False else (movimiento or {})
+        self.stock_minimo = stock_minimo
+
+    @property
+    def clave(self):
+        return (self.almacen_id, self.presentacion_id, self.lote_id)
+
+
+def _orden_bloqueo(clave):
+    """(almacen, presentacion, lote) con lote NULL primero: el mismo orden que ORDER BY del UPDATE."""
+    almacen_id, presentacion_id, lote_id = clave
+    return (almacen_id, presentacion_id, lote_id is not None, lote_id or 0)
+
+
+def _agrupar(cambios):
+    """
+    Suma los deltas por clave y devuelve las claves en orden de bloqueo.
+    Omite claves con delta neto 0.
+    """
+    netos = {}
+    for cambio in cambios:
+        neto = netos.setdefault(cambio.clave, {'delta': Decimal('0'), 'stock_minimo': cambio.stock_minimo})
+        neto['delta'] += cambio.delta
+        if neto['stock_minimo'] is None:
+            neto['stock_minimo'] = cambio.stock_minimo
+    return OrderedDict(
+        (clave, netos[clave]) for clave in sorted(netos, key=_orden_bloqueo) if netos[clave]['delta'] != 0
+    )
+
+
+def _values(netos, con_stock_minimo=False):
+    """VALUES tipados (los lote_id NULL necesitan CAST para que Postgres infiera el tipo)."""
+    filas, params = [], {}
+    for i, ((almacen_id, presentacion_id, lote_id), neto) in enumerate(netos.items()):
+        columnas = [f"CAST(:a{i} AS INTEGER)", f"CAST(:p{i} AS INTEGER)",
+                    f"CAST(:l{i} AS INTEGER)", f"CAST(:d{i} AS NUMERIC)"]
+        params.update({f'a{i}': almacen_id, f'p{i}': presentacion_id, f'l{i}': lote_id, f'd{i}': neto['delta']})
+        if con_stock_minimo:
+            columnas.append(f"CAST(:m{i} AS INTEGER)")
+            params[f'm{i}'] = neto['stock_minimo'] if neto['stock_minimo'] is not None else STOCK_MINIMO_POR_DEFECTO
+        filas.append(f"({', '.join(columnas)})")
+    return ', '.join(filas), params
+
+
+_MISMA_FILA = (
+    "i.almacen_id = v.almacen_id AND i.presentacion_id = v.presentacion_id "
+    "AND i.lote_id IS NOT DISTINCT FROM v.lote_id"
+)
+
+
+def _crear_faltantes(netos, ahora):
+    """Crea en 0 las filas de inventario que recibirán entradas y aún no existen."""
+    entradas = OrderedDict((clave, neto) for clave, neto in netos.items() if neto['delta'] > 0)
+    if not entradas:
+        return
+    values, params = _values(entradas, con_stock_minimo=True)
+    params['ahora'] = ahora
+    db.session.execute(text(f"""
+        INSERT INTO inventario (almacen_id, presentacion_id, lote_id, cantidad, stock_minimo, ultima_actualizacion)
+        SELECT v.almacen_id, v.presentacion_id, v.lote_id, 0, v.stock_minimo, :ahora
+        FROM (VALUES {values}) AS v(almacen_id, presentacion_id, lote_id, delta, stock_minimo)
+        WHERE NOT EXISTS (SELECT 1 FROM inventario i WHERE {_MISMA_FILA})
+        ON CONFLICT DO NOTHING
+    """), params)
+
+
+def _aplicar_deltas(netos, ahora):
+    """
+    UPDATE condicional de todas las filas; solo escribe si existen todas y ninguna
+    queda en negativo. Devuelve las filas actualizadas.
+    Las filas se bloquean siempre en orden (almacen, presentacion, lote): dos
+    operaciones concurrentes sobre las mismas filas (p. ej. una venta y una
+    transferencia) esperan una a la otra en vez de bloquearse mutuamente.
+    """
+    values, params = _values(netos)
+    params.update({'ahora': ahora, 'n': len(netos)})
+    return db.session.execute(text(f"""
+        WITH v(almacen_id, presentacion_id, lote_id, delta) AS (VALUES {values}),
+        objetivo AS (
+            SELECT i.id, i.cantidad + v.delta AS nueva
+            FROM inventario i JOIN v ON {_MISMA_FILA}
+            ORDER BY i.almacen_id, i.presentacion_id, i.lote_id NULLS FIRST, i.id
+            FOR UPDATE OF i
+        )
+        UPDATE inventario AS i
+        SET cantidad = o.nueva, ultima_actualizacion = :ahora
+        FROM objetivo o
+        WHERE i.id = o.id
+          AND (SELECT count(*) FROM objetivo) = :n
+          AND NOT EXISTS (SELECT 1 FROM objetivo WHERE nueva < 0)
+        RETURNING i.id, i.almacen_id, i.presentacion_id, i.lote_id, i.cantidad
+    """), params).all()
+
+
+def _diagnosticar(netos):
+    """Solo en la ruta de error: qué claves no tienen stock suficiente."""
+    values, params = _values(netos)
+    filas = db.session.execute(text(f"""
+        WITH v(almacen_id, presentacion_id, lote_id, delta) AS (VALUES {values})
+        SELECT v.almacen_id, v.presentacion_id, v.lote_id, v.delta,
+               count(i.id) AS filas, max(i.cantidad) AS disponible, max(p.nombre) AS nombre
+        FROM v
+        LEFT JOIN inventario i ON {_MISMA_FILA}
+        LEFT JOIN presentaciones_producto p ON p.id = v.presentacion_id
+        GROUP BY v.almacen_id, v.presentacion_id, v.lote_id, v.delta
+    """), params).all()
+
+    faltantes, duplicados = [], []
+    for fila in filas:
+        if fila.filas > 1:
+            duplicados.append((fila.almacen_id, fila.presentacion_id, fila.lote_id))
+        elif fila.filas == 0 or fila.disponible + fila.delta < 0:
+            faltantes.append({
+                "almacen_id": fila.almacen_id,
+                "presentacion_id": fila.presentacion_id,
+                "lote_id": fila.lote_id,
+                "presentacion": fila.nombre or f"ID {fila.presentacion_id}",
+                "requerido": str(-fila.delta),
+                "disponible": str(fila.disponible) if fila.filas else None,
+            })
+    if not faltantes and duplicados:
+        # Sin lote, la restricción única no evita filas repetidas: no se puede elegir una
+        raise RuntimeError(f"Inventario duplicado para (almacen, presentacion, lote): {duplicados}")
+    return faltantes
+
+
+def _expirar_inventarios(ids):
+    """Las instancias Inventario ya cargadas en la sesión no ven el UPDATE directo."""
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, Inventario) and obj.id in ids:
+            db.session.expire(obj, ['cantidad', 'ultima_actualizacion'])
+
+
+def _filas_movimiento(cambios, comunes, ahora):
+    filas = []
+    for cambio in cambios:
+        if cambio.delta == 0 or cambio.movimiento is False:
+            continue
+        fila = {
+            'tipo': 'entrada' if cambio.delta > 0 else 'salida',
+            'presentacion_id': cambio.presentacion_id,
+            'lote_id': cambio.lote_id,
+            'cantidad': abs(cambio.delta),
+            'fecha': ahora,
+            **comunes,
+            **cambio.movimiento,
+        }
+        filas.append(fila)
+    # Mismas columnas en todas las filas para que se envíen como un único INSERT multi-fila
+    columnas = set().union(*filas) if filas else set()
+    return [{columna: fila.get(columna) for columna in columnas} for fila in filas]
+
+
+def bloquear_inventarios(pares):
+    """
+    Bloquea (FOR UPDATE) y devuelve las filas de inventario de los pares
+    (almacen_id, presentacion_id), en el mismo orden que aplicar_cambios_stock.
+    Sirve para decidir qué operaciones de un lote caben en el stock antes de aplicarlas.
+    """
+    pares = {(int(a), int(p)) for a, p in pares}
+    if not pares:
+        return []
+    return Inventario.query.filter(
+        tuple_(Inventario.almacen_id, Inventario.presentacion_id).in_(sorted(pares))
+    ).order_by(
+        Inventario.almacen_id, Inventario.presentacion_id, Inventario.lote_id.nullsfirst(), Inventario.id
+    ).with_for_update().populate_existing().all()
+
+
+def aplicar_cambios_stock(cambios, crear_faltantes=False, registrar_movimientos=True, **movimiento_comun):
+    """
+    Aplica un lote de CambioStock de forma atómica dentro de la transacción actual.
+    - `crear_faltantes`: crea las filas de inventario que reciben entradas y no existen.
+    - `registrar_movimientos`: inserta un Movimiento por cambio (tipo según el signo del delta).
+    - `movimiento_comun`: campos de Movimiento compartidos (motivo, usuario_id, tipo_operacion, venta_id, ...).
+    Devuelve {(almacen_id, presentacion_id, lote_id): cantidad resultante}.
+    Lanza StockInsuficienteError (subclase de ValueError) sin modificar nada si algún cambio no es posible.
+    """
+    cambios = list(cambios)
+    netos = _agrupar(cambios)
+    ahora = movimiento_comun.pop('fecha', None) or datetime.now(timezone.utc)
+
+    # Las filas pendientes (p. ej. la venta recién creada) deben existir antes de referenciarlas
+    db.session.flush()
+
+    resultado = {}
+    if netos:
+        if crear_faltantes:
+            _crear_faltantes(netos, ahora)
+        filas = _aplicar_deltas(netos, ahora)
+        if len(filas) != len(netos):
+            raise StockInsuficienteError(_diagnosticar(netos))
+        _expirar_inventarios({fila.id for fila in filas})
+        por_par = defaultdict(Decimal)
+        for (almacen_id, presentacion_id, _), neto in netos.items():
+            por_par[(almacen_id, presentacion_id)] += neto['delta']
+        registrar_deltas(por_par)
+        resultado = {(fila.almacen_id, fila.presentacion_id, fila.lote_id): fila.cantidad for fila in filas}
+
+    if registrar_movimientos:
+        movimientos = _filas_movimiento(cambios, movimiento_comun, ahora)
+        if movimientos:
+            db.session.execute(insert(Movimiento), movimientos)
+
+    logger.debug(f"Stock: {len(netos)} filas de inventario, {len(cambios)} cambios aplicados")
+    return resultado
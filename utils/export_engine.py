@@ -0,0 +1,162 @@
+# utils/export_engine.py
+"""
+Motor de exportación compartido por los endpoints /exportar.
+
+Cada endpoint describe su exportación con un ExportSpec (consulta filtrada,
+orden keyset y columnas). El motor recorre la consulta en bloques de
+EXPORT_CHUNK_SIZE filas y escribe cada bloque antes de pedir el siguiente,
+así que la memoria no crece con el número de filas:
+- CSV: se genera en streaming directamente en la respuesta.
+- XLSX: openpyxl en modo write-only vuelca las filas a un archivo temporal
+  en disco, que luego se envía por bloques.
+"""
+import csv
+import io
+import logging
+import tempfile
+from datetime import datetime
+
+from flask import Response, current_app, request, send_file, stream_with_context
+from openpyxl import Workbook
+
+from common import iter_keyset_chunks
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+# Mimetypes sin charset: Werkzeug añade "; charset=utf-8" a los text/* al responder
+FORMATOS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+}
+
+
+class ExportCancelled(Exception):
+    """La exportación se canceló mientras se generaba."""
+    pass
+
+
+class ExportSpec:
+    """
+    Definición de una exportación.
+    - `columnas`: lista de (encabezado, función que recibe la fila y devuelve el valor).
+    - `sort_keys`/`id_column`: orden keyset con el que se recorre la consulta.
+    - `preparar`: opcional, recibe cada bloque de objetos antes de convertirlo
+      (p. ej. para completar relaciones que la consulta no carga).
+    """
+
+    def __init__(self, nombre, hoja, query, columnas, sort_keys, id_column, preparar=None):
+        self.nombre = nombre
+        self.hoja = hoja
+        self.query = query
+        self.columnas = columnas
+        self.sort_keys = sort_keys
+        self.id_column = id_column
+        self.preparar = preparar
+
+    @property
+    def encabezados(self):
+        return [encabezado for encabezado, _ in self.columnas]
+
+
+def _chunk_size():
+    return int(current_app.config.get('EXPORT_CHUNK_SIZE', 1000))
+
+
+def iter_export_chunks(spec, chunk_size=None, check_cancel=None):
+    """
+    Produce bloques de filas ya convertidas a valores de celda.
+    `check_cancel` se consulta entre bloques; si devuelve True se lanza ExportCancelled.
+    """
+    for items in iter_keyset_chunks(spec.query, spec.sort_keys, spec.id_column, chunk_size or _chunk_size()):
+        if spec.preparar is not None:
+            spec.preparar(items)
+        yield [[getter(item) for _, getter in spec.columnas] for item in items]
+        if check_cancel is not None and check_cancel():
+            raise ExportCancelled()
+
+
+def has_rows(spec):
+    return db.session.query(spec.query.order_by(None).exists()).scalar()
+
+
+def write_xlsx(spec, fileobj, chunk_size=None, check_cancel=None):
+    """Escribe la exportación como XLSX (write-only) en `fileobj`. Devuelve el número de filas."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(spec.hoja)
+    sheet.append(spec.encabezados)
+    total = 0
+    for rows in iter_export_chunks(spec, chunk_size, check_cancel):
+        for row in rows:
+            sheet.append(row)
+        total += len(rows)
+    workbook.save(fileobj)
+    return total
+
+
+def iter_csv(spec, chunk_size=None, check_cancel=None):
+    """Genera el CSV por bloques de bytes (UTF-8 con BOM para que Excel respete los acentos)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(spec.encabezados)
+    yield ('\ufeff' + buffer.getvalue()).encode('utf-8')
+    for rows in iter_export_chunks(spec, chunk_size, check_cancel):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_csv(spec, fileobj, chunk_size=None, check_cancel=None):
+    """Escribe la exportación como CSV en el archivo binario `fileobj`. Devuelve el número de filas."""
+    text = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(spec.encabezados)
+    total = 0
+    for rows in iter_export_chunks(spec, chunk_size, check_cancel):
+        writer.writerows(rows)
+        total += len(rows)
+    text.flush()
+    text.detach()  # No cerrar `fileobj` junto con el wrapper
+    return total
+
+
+def export_filename(spec, formato):
+    return f'{spec.nombre}_{datetime.now().strftime("%Y%m%d")}.{formato}'
+
+
+def get_export_format():
+    """Formato pedido con ?formato=xlsx|csv (por defecto xlsx); None si no es válido."""
+    formato = (request.args.get('formato') or 'xlsx').lower()
+    return formato if formato in FORMATOS else None
+
+
+def export_response(spec, mensaje_vacio):
+    """
+    Respuesta de descarga para `spec` en el formato de ?formato=.
+    Devuelve 400 si el formato no es válido y 404 con `mensaje_vacio` si no hay filas.
+    """
+    formato = get_export_format()
+    if formato is None:
+        return {"error": "Formato no soportado. Usa 'xlsx' o 'csv'"}, 400
+    if not has_rows(spec):
+        return {"message": mensaje_vacio}, 404
+
+    download_name = export_filename(spec, formato)
+    if formato == 'csv':
+        return Response(
+            stream_with_context(iter_csv(spec)),
+            mimetype=FORMATOS['csv'],
+            headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+        )
+
+    # El XLSX debe cerrarse (zip) antes de enviarse: se arma en disco, no en memoria
+    output = tempfile.TemporaryFile()
+    try:
+        filas = write_xlsx(spec, output)
+    except Exception:
+        output.close()
+        raise
+    output.seek(0)
+    logger.info(f"Exportación {spec.nombre}: {filas} filas en XLSX")
+    return send_file(output, mimetype=FORMATOS['xlsx'], as_attachment=True, download_name=download_name)
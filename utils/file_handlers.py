@@ -1,13 +1,17 @@
 # utils/file_handlers.py
 import os
 import uuid
+import time
 import logging
+import threading
+from collections import OrderedDict
 from werkzeug.utils import secure_filename
 from flask import current_app
 import boto3
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError, NoCredentialsError
 from urllib.parse import urlparse
-from PIL import Image # <--- Importar Pillow
+from PIL import Image, ImageOps # <--- Importar Pillow
 import io # <--- Importar io para manejo en memoria
 
 # Configurar logging
@@ -55,29 +59,241 @@ def safe_filename(filename, force_extension=None):
     unique_name = f"{base}_{uuid.uuid4().hex}.{final_extension}"
     return unique_name
 
+# --- Cliente S3 compartido por proceso ---
+# boto3 crea clientes thread-safe, pero construir uno nuevo por llamada cuesta
+# (carga de modelos de servicio + list_buckets de red). Se crea uno solo por
+# proceso (cada worker de gunicorn tiene el suyo) y se comparte entre hilos.
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+_s3_credentials_ok = None
+_s3_probe_thread = None
+
+
+def _build_s3_client(region, max_pool_connections):
+    """Construye un cliente S3 con un pool de conexiones acotado."""
+    session = boto3.session.Session()
+    return session.client(
+        's3',
+        region_name=region,
+        config=BotoConfig(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': 3, 'mode': 'standard'},
+        ),
+    )
+
+
 def get_s3_client():
     """
-    Crea y devuelve un cliente S3 de Boto3.
+    Devuelve el cliente S3 compartido del proceso, creándolo la primera vez.
     Prioriza el Rol IAM asociado a la instancia EC2.
+    No realiza llamadas de red: las credenciales se verifican en el arranque
+    (verify_s3_credentials) o con la sonda periódica (start_s3_credentials_probe).
     """
+    global _s3_client, _s3_client_pid
+    pid = os.getpid()
+    if _s3_client is not None and _s3_client_pid == pid:
+        return _s3_client
+
     region = current_app.config.get('S3_REGION')
     if not region:
         logger.error("AWS_REGION (S3_REGION) no está configurado.")
         return None
+
+    with _s3_client_lock:
+        # Re-chequear dentro del lock; el pid cubre procesos creados con fork
+        if _s3_client is not None and _s3_client_pid == pid:
+            return _s3_client
+        try:
+            max_pool = int(current_app.config.get('S3_MAX_POOL_CONNECTIONS', 10))
+            _s3_client = _build_s3_client(region, max_pool)
+            _s3_client_pid = pid
+            logger.info(f"Cliente S3 creado (región {region}, max_pool_connections={max_pool}).")
+            return _s3_client
+        except Exception as e:
+            logger.error(f"Error inesperado al crear cliente S3: {e}")
+            return None
+
+
+def verify_s3_credentials():
+    """
+    Verifica las credenciales S3 con una llamada ligera al bucket configurado.
+    Pensado para ejecutarse una vez al arrancar o desde la sonda periódica,
+    nunca por cada operación. Devuelve True/False y guarda el último resultado.
+    """
+    global _s3_credentials_ok
+    s3_client = get_s3_client()
+    bucket_name = current_app.config.get('S3_BUCKET')
+    if not s3_client or not bucket_name:
+        _s3_credentials_ok = False
+        return False
     try:
-        s3_client = boto3.client('s3', region_name=region)
-        s3_client.list_buckets() # Verificar credenciales del rol/entorno
-        logger.debug("Cliente S3 creado usando credenciales del entorno/rol IAM.")
-        return s3_client
+        s3_client.head_bucket(Bucket=bucket_name)
+        if _s3_credentials_ok is not True:
+            logger.info("Credenciales S3 verificadas correctamente.")
+        _s3_credentials_ok = True
     except (NoCredentialsError, ClientError) as e:
-        logger.error(f"No se pudieron obtener credenciales S3 (ni rol IAM ni explícitas): {e}")
-        return None
+        logger.error(f"No se pudieron verificar credenciales S3 (ni rol IAM ni explícitas): {e}")
+        _s3_credentials_ok = False
     except Exception as e:
-         logger.error(f"Error inesperado al crear cliente S3: {e}")
-         return None
+        logger.error(f"Error inesperado verificando credenciales S3: {e}")
+        _s3_credentials_ok = False
+    return _s3_credentials_ok
+
+
+def s3_credentials_ok():
+    """Último resultado conocido de la verificación de credenciales (None si no se ha verificado)."""
+    return _s3_credentials_ok
+
+
+def start_s3_credentials_probe(app, interval_seconds):
+    """
+    Lanza un hilo daemon que verifica las credenciales S3 cada `interval_seconds`.
+    Solo se inicia una sonda por proceso.
+    """
+    global _s3_probe_thread
+    if interval_seconds <= 0:
+        return None
+    if _s3_probe_thread is not None and _s3_probe_thread.is_alive():
+        return _s3_probe_thread
+
+    def _probe():
+        while True:
+            time.sleep(interval_seconds)
+            with app.app_context():
+                verify_s3_credentials()
+
+    _s3_probe_thread = threading.Thread(target=_probe, name='s3-credentials-probe', daemon=True)
+    _s3_probe_thread.start()
+    return _s3_probe_thread
+
+
+def _is_transcodable_image(content_type):
+    """Las imágenes (salvo las que ya son WebP) se convierten a WebP antes de subir."""
+    return is_image(content_type) and not content_type.endswith('webp')
+
+
+def is_image(content_type):
+    """Cualquier imagen, WebP incluida: las subidas con variantes las generan para todas."""
+    return bool(content_type) and content_type.startswith('image/')
+
+
+# Variantes de imagen generadas al subir fotos de presentaciones: nombre -> ancho máximo.
+# 'full' conserva la clave original; el resto añade un sufijo (foto_abc.webp -> foto_abc_thumb.webp).
+IMAGE_VARIANTS = {'thumb': 320, 'medium': 800, 'full': 1920}
+
+
+def variant_key(s3_object_key, variant):
+    """Clave S3 predecible de una variante de imagen."""
+    if not s3_object_key or not variant or variant == 'full':
+        return s3_object_key
+    base, sep, extension = s3_object_key.rpartition('.')
+    if not sep:
+        return f"{s3_object_key}_{variant}"
+    return f"{base}_{variant}.{extension}"
+
+
+def _encode_webp(img, quality):
+    """Codifica una imagen Pillow a WebP en memoria."""
+    webp_buffer = io.BytesIO()
+    # Manejar RGBA (ej. PNG con transparencia)
+    if img.mode == 'RGBA':
+         # WebP soporta transparencia, guardar como está
+         img.save(webp_buffer, format='WEBP', quality=quality, lossless=False) # Ajustar lossless si se prefiere
+    else:
+         # Convertir a RGB si no lo es (ej. P, L) antes de guardar como WebP
+         img.convert('RGB').save(webp_buffer, format='WEBP', quality=quality)
+    webp_buffer.seek(0)
+    return webp_buffer
+
+
+def _resize_to_width(img, max_width):
+    """Reduce la imagen a `max_width` conservando la proporción (nunca amplía)."""
+    img_width, img_height = img.size
+    if img_width <= max_width:
+        return img
+    ratio = max_width / float(img_width)
+    new_height = int(float(img_height) * float(ratio))
+    return img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+
+
+# Orientaciones EXIF que intercambian ancho y alto
+_EXIF_ORIENTATION_TAG = 0x0112
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def open_image_for_width(stream, target_width):
+    """
+    Abre una imagen lista para redimensionar a `target_width`:
+    - JPEG: decodifica a escala reducida (draft de Pillow: 1/2, 1/4 u 1/8) sin bajar
+      del ancho objetivo, evitando el decode completo de fotos de 12 MP.
+    - Aplica la orientación EXIF y descarta los metadatos (EXIF, XMP, ICC) en la misma pasada.
+    """
+    img = Image.open(stream)
+    if img.format == 'JPEG':
+        stored_width, stored_height = img.size
+        orientation = img.getexif().get(_EXIF_ORIENTATION_TAG, 1)
+        display_width = stored_height if orientation in _ROTATED_ORIENTATIONS else stored_width
+        if display_width > target_width:
+            scale = target_width / float(display_width)
+            # draft elige la mayor reducción cuyo tamaño sigue cubriendo el solicitado
+            img.draft('RGB', (int(stored_width * scale) + 1, int(stored_height * scale) + 1))
+    img = ImageOps.exif_transpose(img)
+    img.load()
+    img.info = {}
+    return img
+
+
+def transcode_image_variants(stream, quality=80, variants=IMAGE_VARIANTS):
+    """
+    Decodifica la imagen una sola vez y genera cada variante en WebP,
+    de la más grande a la más pequeña (cada una parte de la anterior).
+    Devuelve {variante: BytesIO}.
+    """
+    img = open_image_for_width(stream, max(variants.values()))
+    result = {}
+    for name, width in sorted(variants.items(), key=lambda item: item[1], reverse=True):
+        img = _resize_to_width(img, width)
+        result[name] = _encode_webp(img, quality)
+    return result
+
+
+def transcode_image_to_webp(stream, quality=80, max_width=1920):
+    """
+    Decodifica una imagen, la redimensiona (LANCZOS) si supera `max_width`
+    y la codifica a WebP. Devuelve un BytesIO posicionado al inicio.
+    No depende del contexto de Flask (se usa también en el pool de subidas).
+    """
+    img = _resize_to_width(open_image_for_width(stream, max_width), max_width)
+    return _encode_webp(img, quality)
+
+
+def build_s3_object_key(filename, subfolder, content_type):
+    """
+    Decide la clave S3 final de un archivo antes de procesarlo:
+    las imágenes transcodificables terminan en .webp, el resto conserva su extensión.
+    """
+    target_extension = "webp" if _is_transcodable_image(content_type) else None
+    unique_filename = safe_filename(filename, force_extension=target_extension)
+    if not unique_filename:
+        return None
+    clean_subfolder = subfolder.strip('/') if subfolder else ''
+    return f"{clean_subfolder}/{unique_filename}" if clean_subfolder else unique_filename
+
+
+def upload_image_variants(s3_client, bucket_name, s3_object_key, buffers):
+    """
+    Sube las variantes WebP de una imagen bajo sus claves predecibles.
+    La variante 'full' se sube al final, bajo la clave original, para que
+    su existencia implique que las derivadas ya están disponibles.
+    """
+    for name in sorted(buffers, key=lambda n: n == 'full'):
+        key = variant_key(s3_object_key, name)
+        s3_client.upload_fileobj(buffers[name], bucket_name, key, ExtraArgs={'ContentType': 'image/webp'})
+        invalidate_presigned_url(key)
 
 
-def save_file(file, subfolder, quality=80, max_width=1920):
+def save_file(file, subfolder, quality=80, max_width=1920, variants=None):
     """
     Procesa y guarda un archivo en S3 de forma segura (privado).
     - Si es imagen (jpg, png, gif): Redimensiona, convierte a WebP y sube.
@@ -88,6 +304,8 @@ def save_file(file, subfolder, quality=80, max_width=1920):
         subfolder: Prefijo de "carpeta" dentro del bucket S3
         quality (int): Calidad para la conversión a WebP (0-100).
         max_width (int): Ancho máximo al que redimensionar la imagen.
+        variants (dict): Si se indica (ej. IMAGE_VARIANTS), genera una variante por
+            ancho y las sube con variant_key(); 'full' usa la clave devuelta.
 
     Returns:
         str: Clave del objeto S3 (ej: 'pagos/nombre_unico.webp' o 'pagos/doc.pdf') si fue exitoso, o None si hay error.
@@ -110,36 +328,19 @@ def save_file(file, subfolder, quality=80, max_width=1920):
     # Determinar tipo y procesar condicionalmente
     content_type = file.content_type
     file_to_upload = file.stream # Por defecto, subir el stream original
-    target_extension = None # Para forzar extensión en safe_filename
     upload_content_type = content_type # ContentType para S3
+    variant_buffers = None
 
-    if content_type and content_type.startswith('image/') and not content_type.endswith('webp'):
+    if _is_transcodable_image(content_type) or (variants and is_image(content_type)):
         # --- Procesamiento de Imagen a WebP ---
         logger.info(f"Procesando imagen: {file.filename} ({content_type})")
         try:
-            img = Image.open(file.stream)
-            img_width, img_height = img.size
-            if img_width > max_width:
-                ratio = max_width / float(img_width)
-                new_height = int(float(img_height) * float(ratio))
-                img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
-                logger.info(f"Imagen redimensionada a {max_width}x{new_height}")
-
-            webp_buffer = io.BytesIO()
-            # Manejar RGBA (ej. PNG con transparencia)
-            if img.mode == 'RGBA':
-                 # WebP soporta transparencia, guardar como está
-                 img.save(webp_buffer, format='WEBP', quality=quality, lossless=False) # Ajustar lossless si se prefiere
+            if variants:
+                variant_buffers = transcode_image_variants(file.stream, quality, variants)
             else:
-                 # Convertir a RGB si no lo es (ej. P, L) antes de guardar como WebP
-                 img.convert('RGB').save(webp_buffer, format='WEBP', quality=quality)
-
-            webp_buffer.seek(0)
-            file_to_upload = webp_buffer # Cambiar el stream a subir
-            target_extension = "webp" # Forzar extensión .webp
+                file_to_upload = transcode_image_to_webp(file.stream, quality, max_width)
             upload_content_type = "image/webp" # ContentType para S3
             logger.info(f"Imagen convertida a WebP con calidad {quality}")
-
         except Exception as e:
             logger.error(f"Error procesando imagen con Pillow: {e}")
             return None
@@ -158,18 +359,18 @@ def save_file(file, subfolder, quality=80, max_width=1920):
         # Podrías descomentar la siguiente línea para rechazar tipos no esperados:
         # return None
 
-    # Generar nombre seguro (forzando .webp si es imagen, sino usa original)
-    unique_filename = safe_filename(file.filename, force_extension=target_extension)
-    if not unique_filename:
+    # Construir la clave del objeto S3 (forzando .webp si es imagen, sino usa original)
+    s3_object_key = build_s3_object_key(file.filename, subfolder, content_type)
+    if not s3_object_key:
         logger.error("No se pudo generar un nombre de archivo seguro.")
         return None
 
-    # Limpiar subfolder
-    clean_subfolder = subfolder.strip('/') if subfolder else ''
-    # Construir la clave del objeto S3
-    s3_object_key = f"{clean_subfolder}/{unique_filename}" if clean_subfolder else unique_filename
-
     try:
+        if variant_buffers:
+            upload_image_variants(s3_client, bucket_name, s3_object_key, variant_buffers)
+            logger.info(f"Imagen subida a S3 con variantes {list(variant_buffers)}. Clave: {s3_object_key}")
+            return s3_object_key
+
         # Subir el buffer correspondiente (original o webp) a S3
         file_to_upload.seek(0) # Asegurar que el stream esté al inicio
         s3_client.upload_fileobj(
@@ -178,6 +379,7 @@ def save_file(file, subfolder, quality=80, max_width=1920):
             s3_object_key,
             ExtraArgs={'ContentType': upload_content_type} # Usar el ContentType determinado
         )
+        invalidate_presigned_url(s3_object_key)  # Por si la clave reemplaza un objeto existente
         logger.info(f"Archivo subido exitosamente a S3 (privado). Clave: {s3_object_key}, Tipo: {upload_content_type}")
         # Devolver la CLAVE del objeto
         return s3_object_key
@@ -188,16 +390,117 @@ def save_file(file, subfolder, quality=80, max_width=1920):
         logger.error(f"Error inesperado guardando archivo S3: {str(e)}")
         return None
 
-# --- Funciones get_presigned_url y delete_file (sin cambios) ---
+# --- Caché de URLs pre-firmadas ---
+
+class PresignedUrlCache:
+    """
+    Caché LRU en proceso de URLs pre-firmadas, indexada por clave S3 y
+    expiración solicitada (una URL firmada por 1 hora no sirve a quien pide 1 día).
+    Devuelve la URL existente mientras le quede suficiente validez y
+    obliga a re-firmar cuando está cerca de expirar.
+    """
+
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # clave S3 -> {expiration: (url, expira_en)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, s3_object_key, expiration, min_remaining_seconds):
+        """
+        Devuelve la URL cacheada para esa expiración si le quedan al menos
+        `min_remaining_seconds` de validez.
+        """
+        with self._lock:
+            urls = self._entries.get(s3_object_key)
+            entry = urls.get(expiration) if urls else None
+            if entry is not None:
+                url, expires_at = entry
+                if expires_at - time.time() >= min_remaining_seconds:
+                    self._entries.move_to_end(s3_object_key)
+                    self.hits += 1
+                    return url
+                # Cerca de expirar: descartar y re-firmar
+                del urls[expiration]
+                if not urls:
+                    del self._entries[s3_object_key]
+            self.misses += 1
+            return None
+
+    def set(self, s3_object_key, expiration, url, expires_at):
+        with self._lock:
+            self._entries.setdefault(s3_object_key, {})[expiration] = (url, expires_at)
+            self._entries.move_to_end(s3_object_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, s3_object_key):
+        """Elimina una clave (p. ej. cuando el objeto se reemplaza o se borra)."""
+        with self._lock:
+            self._entries.pop(s3_object_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+_presigned_url_cache = None
+_presigned_url_cache_lock = threading.Lock()
+
+
+def _get_presigned_url_cache():
+    """Devuelve la caché del proceso, creándola con el tamaño configurado."""
+    global _presigned_url_cache
+    if _presigned_url_cache is None:
+        with _presigned_url_cache_lock:
+            if _presigned_url_cache is None:
+                max_size = int(current_app.config.get('PRESIGNED_URL_CACHE_SIZE', 2048))
+                _presigned_url_cache = PresignedUrlCache(max_size=max_size)
+    return _presigned_url_cache
+
+
+def invalidate_presigned_url(s3_object_key):
+    """Expulsa una clave de la caché de URLs pre-firmadas."""
+    if s3_object_key and _presigned_url_cache is not None:
+        _presigned_url_cache.invalidate(s3_object_key)
+
+
+def presigned_url_cache_stats():
+    """Contadores de aciertos/fallos y ocupación de la caché de URLs pre-firmadas."""
+    return _get_presigned_url_cache().stats()
+
 
 def get_presigned_url(s3_object_key, expiration=3600):
     """
     Genera una URL pre-firmada para acceder a un objeto S3 privado.
+    Reutiliza la URL cacheada para la misma `expiration` mientras le quede
+    suficiente validez (PRESIGNED_URL_MIN_TTL_SECONDS, acotado a la mitad de `expiration`).
     """
     if not s3_object_key:
         logger.warning("Intento de generar URL pre-firmada para clave vacía.")
         return None
 
+    cache = _get_presigned_url_cache()
+    min_remaining = min(
+        int(current_app.config.get('PRESIGNED_URL_MIN_TTL_SECONDS', 900)),
+        expiration // 2
+    )
+    cached_url = cache.get(s3_object_key, expiration, min_remaining)
+    if cached_url:
+        return cached_url
+
     s3_client = get_s3_client()
     bucket_name = current_app.config.get('S3_BUCKET')
 
@@ -206,12 +509,14 @@ def get_presigned_url(s3_object_key, expiration=3600):
         return None
 
     try:
+        signed_at = time.time()
         response = s3_client.generate_presigned_url(
             'get_object',
             Params={'Bucket': bucket_name, 'Key': s3_object_key},
             ExpiresIn=expiration
         )
-        logger.info(f"URL pre-firmada generada para: {s3_object_key}")
+        cache.set(s3_object_key, expiration, response, signed_at + expiration)
+        logger.debug(f"URL pre-firmada generada para: {s3_object_key}")
         return response
     except ClientError as e:
         if e.response['Error']['Code'] == 'NoSuchKey':
@@ -224,14 +529,71 @@ def get_presigned_url(s3_object_key, expiration=3600):
         return None
 
 
-def delete_file(s3_object_key):
+# Campos de las respuestas serializadas que guardan una clave S3
+PRESIGNED_KEY_FIELDS = ('url_foto', 'url_comprobante')
+
+
+def get_presigned_urls(s3_object_keys, expiration=3600):
+    """
+    Firma un lote de claves S3. Las claves repetidas o vacías se descartan,
+    de modo que cada clave distinta se firma una sola vez.
+    Devuelve un diccionario {clave: url} (url es None si no se pudo firmar).
+    """
+    urls = {}
+    for key in s3_object_keys:
+        if key and key not in urls:
+            urls[key] = get_presigned_url(key, expiration)
+    return urls
+
+
+def presign_payload(payload, fields=PRESIGNED_KEY_FIELDS, expiration=3600, foto_variant=None):
+    """
+    Reemplaza, en un único recorrido, las claves S3 de un payload serializado
+    (dicts y listas anidados) por URLs pre-firmadas obtenidas en lote.
+    Con `foto_variant` ('thumb', 'medium'), los campos url_foto apuntan a esa variante
+    cuando el mismo objeto tiene `foto_variantes`; si no, se firma la foto completa.
+    Modifica el payload en sitio y lo devuelve.
+    """
+    pendientes = []  # (contenedor, campo, clave)
+    stack = [payload]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for field, value in node.items():
+                if field in fields:
+                    if isinstance(value, str) and value:
+                        if field == 'url_foto' and foto_variant and node.get('foto_variantes'):
+                            value = variant_key(value, foto_variant)
+                        pendientes.append((node, field, value))
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
+        elif isinstance(node, list):
+            stack.extend(item for item in node if isinstance(item, (dict, list)))
+
+    if not pendientes:
+        return payload
+
+    urls = get_presigned_urls((key for _, _, key in pendientes), expiration)
+    for container, field, key in pendientes:
+        container[field] = urls.get(key)
+    return payload
+
+
+def delete_file(s3_object_key, with_variants=False):
     """
     Elimina un archivo de S3 usando su clave de objeto.
+    Con `with_variants`, elimina también las variantes de imagen derivadas.
     """
     if not s3_object_key:
         logger.warning("Intento de eliminar archivo con clave S3 vacía.")
         return False
 
+    # Si el archivo aún se está procesando en segundo plano, cancelarlo o borrarlo al terminar
+    from utils.upload_worker import discard_pending_upload
+    if discard_pending_upload(s3_object_key):
+        logger.info(f"Subida pendiente cancelada/marcada para eliminar: {s3_object_key}")
+        return True
+
     s3_client = get_s3_client()
     bucket_name = current_app.config.get('S3_BUCKET')
 
@@ -239,7 +601,18 @@ def delete_file(s3_object_key):
         logger.error("Configuración S3 incompleta (cliente o bucket) para eliminar archivo.")
         return False
 
+    invalidate_presigned_url(s3_object_key)
     try:
+        if with_variants:
+            keys = [variant_key(s3_object_key, name) for name in IMAGE_VARIANTS]
+            for key in keys:
+                invalidate_presigned_url(key)
+            s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+            logger.info(f"Solicitud de eliminación enviada a S3 para: {s3_object_key} y sus variantes")
+            return True
         s3_client.delete_object(Bucket=bucket_name, Key=s3_object_key)
         logger.info(f"Solicitud de eliminación enviada a S3 para: {s3_object_key}")
         return True
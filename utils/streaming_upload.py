@@ -0,0 +1,217 @@
+# utils/streaming_upload.py
+"""
+Subida en streaming de comprobantes grandes.
+
+Werkzeug parsea todo el cuerpo multipart antes de que el endpoint vea
+request.files. Para peticiones grandes, este módulo lee directamente la
+entrada WSGI por bloques con el MultipartDecoder de Werkzeug y envía los
+PDFs a S3 mediante multipart upload con partes de tamaño fijo, de modo que
+la memoria por subida queda acotada por S3_MULTIPART_CHUNK_SIZE sin
+importar el tamaño del archivo.
+
+Las imágenes no pueden subirse en streaming (hay que transcodificarlas):
+se vuelcan a un SpooledTemporaryFile (memoria acotada, luego disco) y se
+entregan como un FileStorage normal.
+"""
+import hashlib
+import logging
+import tempfile
+
+from flask import current_app, request
+from werkzeug.datastructures import FileStorage, Headers
+from werkzeug.exceptions import BadRequest
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+from utils.file_handlers import allowed_file, build_s3_object_key, get_s3_client
+
+logger = logging.getLogger(__name__)
+
+# S3 exige partes de al menos 5 MB (salvo la última)
+MIN_S3_PART_SIZE = 5 * 1024 * 1024
+READ_BLOCK_SIZE = 64 * 1024
+# Tamaño en memoria antes de volcar a disco las imágenes recibidas en streaming
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+class StreamedUpload:
+    """Archivo que ya se subió a S3 durante el parseo de la petición."""
+
+    def __init__(self, filename, content_type, s3_key, size, sha256=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.s3_key = s3_key
+        self.size = size
+        self.sha256 = sha256  # Hash del contenido, calculado mientras se subía
+
+
+class S3MultipartWriter:
+    """Acumula bytes y los envía a S3 en partes de `part_size` (multipart upload)."""
+
+    def __init__(self, s3_client, bucket_name, s3_object_key, content_type, part_size):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_object_key = s3_object_key
+        self.part_size = max(part_size, MIN_S3_PART_SIZE)
+        self._buffer = bytearray()
+        self._parts = []
+        self._digest = hashlib.sha256()
+        self.size = 0
+        response = s3_client.create_multipart_upload(
+            Bucket=bucket_name, Key=s3_object_key, ContentType=content_type
+        )
+        self._upload_id = response['UploadId']
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._digest.update(data)
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            with memoryview(self._buffer) as view:
+                chunk = bytes(view[:self.part_size])  # Una sola copia de la parte
+            del self._buffer[:self.part_size]
+            self._upload_part(chunk)
+
+    def _upload_part(self, chunk):
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name, Key=self.s3_object_key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=chunk
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def complete(self):
+        if self._buffer or not self._parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.s3_object_key, UploadId=self._upload_id,
+            MultipartUpload={'Parts': self._parts}
+        )
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def abort(self):
+        self._buffer.clear()
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.s3_object_key, UploadId=self._upload_id
+            )
+        except Exception as e:
+            logger.error(f"No se pudo abortar la subida multipart de {self.s3_object_key}: {e}")
+
+
+def should_stream_request():
+    """Usar el parseo en streaming para multipart por encima de STREAMING_UPLOAD_THRESHOLD."""
+    if request.mimetype != 'multipart/form-data':
+        return False
+    threshold = int(current_app.config.get('STREAMING_UPLOAD_THRESHOLD', 8 * 1024 * 1024))
+    return (request.content_length or 0) >= threshold
+
+
+def parse_multipart_streaming(stream, boundary, file_field, subfolder, s3_client, bucket_name,
+                              part_size, max_form_memory_size=500 * 1024):
+    """
+    Parsea un cuerpo multipart leyendo `stream` por bloques.
+    - Los campos de texto se devuelven en un dict.
+    - Si `file_field` es un PDF, se sube a S3 en streaming y se devuelve un StreamedUpload.
+    - Si es otro tipo permitido, se devuelve un FileStorage respaldado por un archivo temporal.
+    No depende del contexto de Flask (lo usa también scripts/bench_streaming_upload.py).
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=max_form_memory_size)
+    form = {}
+    uploaded = None
+
+    current = None  # ('field', nombre, bytearray) | ('pdf', writer, meta) | ('spool', archivo, meta) | ('skip',)
+    try:
+        while True:
+            chunk = stream.read(READ_BLOCK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, Field):
+                    current = ('field', event.name, bytearray())
+                elif isinstance(event, File):
+                    current = _start_file(event, file_field, subfolder, s3_client, bucket_name, part_size)
+                elif isinstance(event, Data):
+                    current, uploaded = _consume_data(current, event, form, uploaded)
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+    except Exception:
+        if current and current[0] == 'pdf':
+            current[1].abort()
+        if isinstance(uploaded, StreamedUpload):
+            # El PDF ya se completó pero el resto del cuerpo es inválido
+            s3_client.delete_object(Bucket=bucket_name, Key=uploaded.s3_key)
+        raise
+
+    return form, uploaded
+
+
+def _start_file(event, file_field, subfolder, s3_client, bucket_name, part_size):
+    if event.name != file_field or not event.filename:
+        return ('skip',)
+    if not allowed_file(event.filename):
+        raise BadRequest(f"Tipo de archivo no permitido: {event.filename}")
+    content_type = event.headers.get('Content-Type', 'application/octet-stream')
+    meta = {'filename': event.filename, 'content_type': content_type, 'name': event.name}
+    if content_type == 'application/pdf':
+        s3_object_key = build_s3_object_key(event.filename, subfolder, content_type)
+        writer = S3MultipartWriter(s3_client, bucket_name, s3_object_key, content_type, part_size)
+        return ('pdf', writer, meta)
+    return ('spool', tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY), meta)
+
+
+def _consume_data(current, event, form, uploaded):
+    kind = current[0] if current else 'skip'
+    if kind == 'field':
+        current[2].extend(event.data)
+        if not event.more_data:
+            form[current[1]] = current[2].decode('utf-8', errors='replace')
+    elif kind == 'pdf':
+        writer, meta = current[1], current[2]
+        writer.write(event.data)
+        if not event.more_data:
+            writer.complete()
+            logger.info(f"PDF subido en streaming a S3: {writer.s3_object_key} ({writer.size} bytes)")
+            uploaded = StreamedUpload(
+                meta['filename'], meta['content_type'], writer.s3_object_key, writer.size, writer.sha256
+            )
+    elif kind == 'spool':
+        spool, meta = current[1], current[2]
+        spool.write(event.data)
+        if not event.more_data:
+            spool.seek(0)
+            uploaded = FileStorage(
+                stream=spool, filename=meta['filename'], name=meta['name'],
+                headers=Headers({'Content-Type': meta['content_type']})
+            )
+    if not event.more_data:
+        current = None
+    return current, uploaded
+
+
+def parse_upload_request(file_field, subfolder):
+    """
+    Devuelve (form, archivo) de una petición multipart.
+    Por encima del umbral usa el parseo en streaming; si no, request.form/request.files.
+    `archivo` puede ser un FileStorage, un StreamedUpload o None.
+    """
+    if not should_stream_request():
+        return request.form.to_dict(), request.files.get(file_field)
+
+    boundary = request.mimetype_params.get('boundary')
+    if not boundary:
+        raise BadRequest("Falta el boundary del cuerpo multipart.")
+    s3_client = get_s3_client()
+    bucket_name = current_app.config.get('S3_BUCKET')
+    if not s3_client or not bucket_name:
+        raise BadRequest("Almacenamiento no configurado para subidas.")
+    part_size = int(current_app.config.get('S3_MULTIPART_CHUNK_SIZE', 8 * 1024 * 1024))
+    return parse_multipart_streaming(
+        request.stream, boundary.encode('latin-1'), file_field, subfolder,
+        s3_client, bucket_name, part_size,
+        max_form_memory_size=current_app.config.get('MAX_FORM_MEMORY_SIZE') or 500 * 1024
+    )
@@ -0,0 +1,327 @@
+# utils/upload_worker.py
+"""
+Pool de procesos para transcodificar y subir archivos fuera del hilo de la petición.
+
+El endpoint decide la clave S3 final antes de encolar (build_s3_object_key),
+la guarda en BD de inmediato y el cliente puede consultar el estado del
+procesamiento en /archivos/estado. Si la subida falla, las filas que apuntan a
+esa clave se limpian (services/archivo_service.py) para no dejar referencias rotas. La cola está acotada: si hay demasiadas
+subidas pendientes se lanza UploadQueueFullError (el endpoint responde 503).
+"""
+import os
+import io
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+from utils.file_handlers import (
+    allowed_file, build_s3_object_key, _is_transcodable_image, is_image,
+    transcode_image_to_webp, transcode_image_variants, upload_image_variants,
+    _build_s3_client, invalidate_presigned_url, get_s3_client
+)
+
+from utils.streaming_upload import StreamedUpload
+
+logger = logging.getLogger(__name__)
+
+# Estados de procesamiento
+ESTADO_PENDIENTE = 'pendiente'
+ESTADO_COMPLETADO = 'completado'
+ESTADO_ERROR = 'error'
+ESTADO_CANCELADO = 'cancelado'
+
+
+class UploadQueueFullError(Exception):
+    """La cola de subidas en segundo plano está llena; el cliente debe reintentar."""
+    pass
+
+
+# --- Código que corre en el proceso hijo (sin contexto de Flask) ---
+
+_worker_s3_client = None
+
+
+def _init_worker(region, max_pool_connections):
+    """Inicializador de cada proceso del pool: un cliente S3 por proceso."""
+    global _worker_s3_client
+    _worker_s3_client = _build_s3_client(region, max_pool_connections)
+
+
+def _transcode_and_upload(data, content_type, bucket_name, s3_object_key, quality, max_width, variants=None):
+    """Transcodifica (si es imagen) y sube el archivo. Se ejecuta en el proceso hijo."""
+    upload_content_type = content_type
+    file_to_upload = io.BytesIO(data)
+    if variants and is_image(content_type):
+        buffers = transcode_image_variants(file_to_upload, quality, variants)
+        upload_image_variants(_worker_s3_client, bucket_name, s3_object_key, buffers)
+        return s3_object_key
+    if _is_transcodable_image(content_type):
+        file_to_upload = transcode_image_to_webp(file_to_upload, quality, max_width)
+        upload_content_type = 'image/webp'
+
+    _worker_s3_client.upload_fileobj(
+        file_to_upload,
+        bucket_name,
+        s3_object_key,
+        ExtraArgs={'ContentType': upload_content_type}
+    )
+    return s3_object_key
+
+
+# --- Estado del pool en el proceso de la app ---
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = None  # BoundedSemaphore: limita las subidas en vuelo (backpressure)
+_uploads = OrderedDict()  # clave S3 -> {"estado", "error", "future", "eliminar", "variantes"}
+_uploads_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    Crea el pool (con contexto 'spawn') la primera vez que se usa en este proceso,
+    o de nuevo tras _reset_executor. El semáforo de la cola se crea una vez por
+    proceso: las subidas del pool anterior siguen liberando sus huecos.
+    """
+    global _executor, _executor_pid, _slots
+    pid = os.getpid()
+    if _executor is not None and _executor_pid == pid:
+        return _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == pid:
+            return _executor
+        config = current_app.config
+        processes = int(config.get('UPLOAD_WORKER_PROCESSES', 2))
+        max_pending = int(config.get('UPLOAD_QUEUE_MAX_PENDING', 16))
+        _executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(config.get('S3_REGION'), int(config.get('S3_MAX_POOL_CONNECTIONS', 10))),
+        )
+        if _slots is None or _executor_pid != pid:
+            _slots = threading.BoundedSemaphore(max_pending)
+        _executor_pid = pid
+        logger.info(f"Pool de subidas iniciado ({processes} procesos, cola máx. {max_pending}).")
+        return _executor
+
+
+def _reset_executor(roto):
+    """
+    Descarta un pool roto (un proceso hijo murió: OOM, segfault al decodificar)
+    para que la siguiente subida cree uno nuevo. Sus subidas en vuelo terminan
+    con BrokenProcessPool y sus callbacks las marcan como error.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not roto:
+            return  # Otro hilo ya lo reemplazó
+        _executor = None
+    logger.error("El pool de subidas se rompió (un proceso hijo terminó inesperadamente); se recreará.")
+    roto.shutdown(wait=False, cancel_futures=True)
+
+
+def _on_upload_done(app, executor, s3_object_key, future):
+    """Callback en el proceso de la app: libera el hueco y actualiza el estado."""
+    _slots.release()
+
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        _reset_executor(executor)
+
+    if future.cancelled():
+        estado, error = ESTADO_CANCELADO, None
+    elif future.exception() is not None:
+        estado, error = ESTADO_ERROR, str(future.exception())
+        logger.error(f"Error en subida en segundo plano de {s3_object_key}: {error}")
+    else:
+        estado, error = ESTADO_COMPLETADO, None
+        invalidate_presigned_url(s3_object_key)
+        logger.info(f"Subida en segundo plano completada: {s3_object_key}")
+
+    with _uploads_lock:
+        entry = _uploads.get(s3_object_key)
+        eliminar = entry is not None and entry['eliminar']
+        if eliminar and estado == ESTADO_COMPLETADO:
+            estado = ESTADO_CANCELADO
+        if entry is not None:
+            entry.update(estado=estado, error=error, future=None)
+        _prune_finished(int(app.config.get('UPLOAD_STATUS_RETENTION', 1000)))
+
+    if estado == ESTADO_ERROR:
+        # La clave nunca existirá en S3: no dejar pagos ni presentaciones apuntando a ella
+        _limpiar_referencias(app, s3_object_key)
+
+    if eliminar and future.done() and not future.cancelled() and future.exception() is None:
+        # Se pidió borrar mientras se subía: borrar ahora que el objeto existe
+        with app.app_context():
+            from utils.file_handlers import delete_file
+            delete_file(s3_object_key, with_variants=entry['variantes'])
+
+
+def _limpiar_referencias(app, s3_object_key):
+    from services.archivo_service import limpiar_referencias_fallidas
+    try:
+        with app.app_context():
+            limpiar_referencias_fallidas(s3_object_key)
+    except Exception as e:
+        logger.error(f"No se pudieron limpiar las referencias a {s3_object_key}: {e}")
+
+
+def _registrar(s3_object_key, estado, variantes=False):
+    """Registra el estado de una clave (llamar con _uploads_lock tomado)."""
+    _uploads[s3_object_key] = {
+        "estado": estado, "error": None, "future": None,
+        "eliminar": False, "variantes": variantes
+    }
+    _uploads.move_to_end(s3_object_key)
+
+
+def _prune_finished(retention):
+    """Descarta los estados terminados más antiguos (llamar con _uploads_lock tomado)."""
+    excedente = len(_uploads) - retention
+    if excedente <= 0:
+        return
+    for key in [k for k, v in _uploads.items() if v['estado'] != ESTADO_PENDIENTE][:excedente]:
+        del _uploads[key]
+
+
+def submit_upload(file, subfolder, quality=80, max_width=1920, variants=None):
+    """
+    Encola la transcodificación y subida de `file` y devuelve la clave S3 final
+    sin esperar a que termine. Devuelve None si el archivo no es válido.
+    Lanza UploadQueueFullError si la cola está llena.
+    """
+    if not file or not file.filename:
+        logger.warning("Intento de guardar archivo vacío o sin nombre")
+        return None
+    if not allowed_file(file.filename):
+        logger.warning(f"Intento de subir archivo con tipo original no permitido: {file.filename}")
+        return None
+
+    bucket_name = current_app.config.get('S3_BUCKET')
+    if not bucket_name or not get_s3_client():
+        logger.error("Configuración S3 incompleta (cliente o bucket). No se puede guardar archivo.")
+        return None
+
+    s3_object_key = build_s3_object_key(file.filename, subfolder, file.content_type)
+    if not s3_object_key:
+        logger.error("No se pudo generar un nombre de archivo seguro.")
+        return None
+
+    _get_executor()
+    if not _slots.acquire(blocking=False):
+        raise UploadQueueFullError("Demasiados archivos en procesamiento. Intente nuevamente en unos segundos.")
+
+    # Registrar antes de encolar para que el callback siempre encuentre la entrada
+    with _uploads_lock:
+        _registrar(s3_object_key, ESTADO_PENDIENTE, variantes=bool(variants))
+
+    try:
+        data = file.read()
+        argumentos = (data, file.content_type, bucket_name, s3_object_key, quality, max_width, variants)
+        executor = _get_executor()
+        try:
+            future = executor.submit(_transcode_and_upload, *argumentos)
+        except BrokenProcessPool:
+            # El pool murió desde la última subida: recrearlo y reintentar una vez
+            _reset_executor(executor)
+            executor = _get_executor()
+            future = executor.submit(_transcode_and_upload, *argumentos)
+    except Exception:
+        _slots.release()
+        with _uploads_lock:
+            _uploads.pop(s3_object_key, None)
+        raise
+
+    with _uploads_lock:
+        entry = _uploads.get(s3_object_key)
+        if entry is not None and entry['estado'] == ESTADO_PENDIENTE:
+            entry['future'] = future
+        cancelar = entry is not None and entry['eliminar']
+    if cancelar:
+        # Se descartó entre el registro y el submit
+        future.cancel()
+
+    app = current_app._get_current_object()
+    future.add_done_callback(lambda f: _on_upload_done(app, executor, s3_object_key, f))
+    logger.info(f"Archivo encolado para subida en segundo plano: {s3_object_key}")
+    return s3_object_key
+
+
+def mark_upload_completed(s3_object_key, variantes=False):
+    """
+    Registra como completada una clave que ya está en S3 (subida síncrona,
+    streaming o reutilizada por contenido), salvo que este proceso ya la conozca.
+    """
+    if not s3_object_key:
+        return
+    with _uploads_lock:
+        if s3_object_key not in _uploads:
+            _registrar(s3_object_key, ESTADO_COMPLETADO, variantes=variantes)
+
+
+def get_upload_status(s3_object_key):
+    """
+    Estado del procesamiento de una clave conocida por este proceso,
+    o None si la subida no pasó por este worker.
+    """
+    with _uploads_lock:
+        entry = _uploads.get(s3_object_key)
+        if entry is None:
+            return None
+        return {"estado": entry['estado'], "error": entry['error']}
+
+
+def discard_pending_upload(s3_object_key):
+    """
+    Si la clave sigue en procesamiento, la cancela o la marca para borrarse
+    al terminar. Devuelve True si la clave estaba pendiente.
+    """
+    with _uploads_lock:
+        entry = _uploads.get(s3_object_key)
+        if entry is None or entry['estado'] != ESTADO_PENDIENTE:
+            return False
+        entry['eliminar'] = True
+        future = entry['future']
+    if future is not None:
+        future.cancel()  # Si ya empezó, el callback borrará el objeto al terminar
+    return True
+
+
+def save_file_async(file, subfolder, quality=80, max_width=1920, variants=None):
+    """
+    Variante de save_file para endpoints: encola el procesamiento si
+    ASYNC_UPLOADS_ENABLED está activo y, si no, sube de forma síncrona.
+    Los StreamedUpload (PDFs grandes) ya están en S3 y solo devuelven su clave.
+    """
+    if isinstance(file, StreamedUpload):
+        # Ya se subió a S3 en streaming durante el parseo de la petición
+        mark_upload_completed(file.s3_key)
+        return file.s3_key
+    if current_app.config.get('ASYNC_UPLOADS_ENABLED', True):
+        return submit_upload(file, subfolder, quality, max_width, variants)
+    from utils.file_handlers import save_file
+    s3_object_key = save_file(file, subfolder, quality, max_width, variants)
+    mark_upload_completed(s3_object_key, variantes=bool(variants))
+    return s3_object_key
+
+
+def upload_status_payload(s3_object_key):
+    """
+    Bloque que los endpoints añaden a la respuesta para que el cliente consulte el estado.
+    Una clave que este proceso no registró se informa como error.
+    """
+    if not s3_object_key:
+        return None
+    status = get_upload_status(s3_object_key)
+    estado = status['estado'] if status else ESTADO_ERROR
+    if estado == ESTADO_ERROR and status:
+        # Falló antes de que el endpoint confirmara la referencia: limpiarla ahora
+        _limpiar_referencias(current_app._get_current_object(), s3_object_key)
+    return {"clave": s3_object_key, "estado": estado}